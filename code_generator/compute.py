@@ -1,6 +1,7 @@
 from collections import Counter
 
 from . import main, data
+from .cse import CommonSubexpressions
 from .classes import Diagram, HalfLine, Operator
 from .tensor import Tensor
 
@@ -11,11 +12,16 @@ max_degree = 4 # Going above 4 gets slow, rapidly.
 param_ranks = [2]
 weight_rule = data.WeightRule.unitary
 spinintegrate = False
+restricted = False # With spinintegrate, write only the spin blocks of a closed-shell reference. The rest are spin flips.
+eliminate_subexpressions = False # Factor binary contractions shared between terms into intermediates.
+factorize = False # Print each term as pairwise contractions in the optimal order, instead of one einsum.
 ###
 
+cse = CommonSubexpressions(factorize=factorize) if eliminate_subexpressions else None
+
 def variational(counter: Operator) -> list[list[Tensor]]:
     """ Given the central RDM operator, compute the RDM parameterization and its stationarity conditions. """
-    return main.compute_rdm_param(counter, max_degree, param_ranks, weight_rule, spinintegrate=spinintegrate)
+    return main.compute_rdm_param(counter, max_degree, param_ranks, weight_rule, spinintegrate=spinintegrate, cse=cse, factorize=factorize, restricted=restricted)
 
 def extract_cumulant(rdm_param):
     return [degree_n.get("Connected (Strong)", []) + degree_n.get("Connected (Weak)", []) for degree_n in rdm_param]
@@ -41,5 +47,8 @@ d_dict = {
         "vv": {"o": extract_cumulant(results["ov ov"]), "v": extract_cumulant(results["vv vv"])}
 }
 
-main.compute_cumulant_partial_trace(d_dict)
+main.compute_cumulant_partial_trace(d_dict, cse, factorize, restricted)
+
+if cse is not None:
+    cse.write()
 
@@ -0,0 +1,145 @@
+from collections import Counter
+from collections.abc import Iterable
+import itertools
+
+from .classes import Amplitude, Spin, Symbol
+from .factorize import print_code
+from .helper import write_files
+from .tensor import Tensor
+
+PairKey = tuple
+
+class Intermediate(Amplitude):
+    """ A product of two amplitudes, stored under its own name. Its open indices need not form two rows
+    of equal length, so all of them are kept in upper. """
+
+    def __init__(self, symbols: list[Symbol], name: str):
+        self.upper = list(symbols)
+        self.lower = []
+        self.name = name
+        self.rank = len(self.upper)
+        self.spin = [symbol.spin for symbol in self.upper]
+        self.spinorbital = all(x == Spin.NONE for x in self.spin)
+        self.include_orbspace = False
+
+    def full_name(self) -> str:
+        return self.name
+
+    def reduced_str(self) -> str:
+        return "".join(x.letter for x in self.upper)
+
+
+class CommonSubexpressions:
+    """ Collects the tensors of every file a method writes, finds binary sub-contractions shared between them,
+    and writes the shared pieces as named intermediates, computed once per iteration.
+
+    Intermediates built only from amplitudes are written to "intermediates", to be computed before the RDMs.
+    Intermediates that involve anything else (integrals, the generalized Fock matrix...) are written to
+    "residual_intermediates", to be computed before the residuals. """
+
+    def __init__(self, prefix: str = "x", min_count: int = 2, factorize: bool = False):
+        self.prefix = prefix
+        self.factorize = factorize
+        self.min_count = min_count
+        self.files = [] # List of (filename, list of (Tensor, variable))
+        self.intermediates = [] # List of (Intermediate, defining Tensor), in order of definition
+
+    def add(self, filename: str, terms: Iterable[tuple[Tensor, str]]):
+        """ Queue tensors for writing. Nothing is written until write is called. """
+        self.files.append((filename, list(terms)))
+
+    def tensors(self) -> list[Tensor]:
+        return [tensor for _, terms in self.files for tensor, _ in terms]
+
+    def eliminate(self):
+        """ Greedily replace the most common pair of amplitudes by an intermediate until no pair is shared. """
+        while True:
+            counts = Counter()
+            for tensor in self.tensors():
+                counts.update({key for key, _ in candidate_pairs(tensor)})
+            if not counts:
+                return
+            key, count = counts.most_common(1)[0]
+            if count < self.min_count:
+                return
+            self.define_intermediate(key)
+
+    def define_intermediate(self, key: PairKey):
+        """ Create the intermediate for the pair with the given key, and substitute it into every tensor. """
+        name = f"{self.prefix}{len(self.intermediates) + 1}"
+        defined = False
+        for filename, terms in self.files:
+            for j, (tensor, variable) in enumerate(terms):
+                for pair_key, (a, b, open_symbols) in candidate_pairs(tensor):
+                    if pair_key != key:
+                        continue
+                    if not defined:
+                        self.intermediates.append((Intermediate(open_symbols, name), Tensor([a, b], 1, [], set())))
+                        defined = True
+                    amplitudes = [x for x in tensor.amplitudes if x is not a and x is not b]
+                    amplitudes.append(Intermediate(open_symbols, name))
+                    terms[j] = (Tensor(amplitudes, tensor.weight, tensor.external_indices, tensor.antisymmetrizers), variable)
+                    break
+
+    def is_amplitude_only(self, amplitude: Amplitude) -> bool:
+        """ Can this amplitude be computed before the RDMs are? """
+        if isinstance(amplitude, Intermediate):
+            definition = next(definition for x, definition in self.intermediates if x.name == amplitude.name)
+            return all(self.is_amplitude_only(x) for x in definition.amplitudes)
+        return amplitude.name.startswith("t")
+
+    def write(self):
+        """ Eliminate common subexpressions, then write the intermediates and every queued file. """
+        self.eliminate()
+        stages = {"intermediates": [], "residual_intermediates": []}
+        for intermediate, definition in self.intermediates:
+            stage = "intermediates" if self.is_amplitude_only(intermediate) else "residual_intermediates"
+            stages[stage].append(print_intermediate(intermediate, definition))
+        for filename, prints in stages.items():
+            if prints:
+                write_files(filename, "\n".join(prints))
+        for filename, terms in self.files:
+            write_files(filename, "\n".join(print_code(tensor, variable, self.factorize) for tensor, variable in terms))
+
+
+def candidate_pairs(tensor: Tensor) -> list[tuple[PairKey, tuple[Amplitude, Amplitude, list[Symbol]]]]:
+    """ Return every pair of amplitudes in the tensor that share a contracted index and leave at least one, but no more
+    than the larger factor has, indices open, together with a key that is the same for any two pairs that differ only by index labels. """
+    pairs = []
+    for a, b in itertools.combinations(tensor.amplitudes, 2):
+        a_symbols = a.upper + a.lower
+        b_symbols = b.upper + b.lower
+        contracted = set(a_symbols) & set(b_symbols)
+        open_count = len(a_symbols) + len(b_symbols) - 2 * len(contracted)
+        # An intermediate bigger than both of its factors costs more memory than it saves.
+        if not contracted or not open_count or open_count > max(len(a_symbols), len(b_symbols)):
+            continue
+        pairs.append(min((pair_key(x, y, contracted) for x, y in [(a, b), (b, a)]), key=lambda x: x[0]))
+    return [(key, (x, y, open_symbols)) for key, x, y, open_symbols in pairs]
+
+def pair_key(a: Amplitude, b: Amplitude, contracted: set[Symbol]) -> tuple[PairKey, Amplitude, Amplitude, list[Symbol]]:
+    """ Relabel the symbols of a then b in order of first appearance. Two pairs with equal keys are the same
+    contraction, and their open symbols, in order of relabeling, correspond position by position. """
+    labels = {}
+    open_symbols = []
+    key = []
+    for amplitude in (a, b):
+        rows = []
+        for row in (amplitude.upper, amplitude.lower):
+            signature = []
+            for symbol in row:
+                if symbol not in labels:
+                    labels[symbol] = len(labels)
+                    if symbol not in contracted:
+                        open_symbols.append(symbol)
+                signature.append((labels[symbol], symbol.occupied, symbol.spin.value, symbol in contracted))
+            rows.append(tuple(signature))
+        key.append((amplitude.full_name(), tuple(rows)))
+    return tuple(key), a, b, open_symbols
+
+def print_intermediate(intermediate: Intermediate, definition: Tensor) -> str:
+    """ Print the code that computes an intermediate, in the multilinear.einsum form the plan compiler reads. """
+    ws = " " * 4
+    subscripts = ", ".join(x.reduced_str() for x in definition.amplitudes) + " -> " + intermediate.reduced_str()
+    operands = ", ".join("i[\"" + x.full_name() + "\"]" for x in definition.amplitudes)
+    return ws + f"i[\"{intermediate.name}\"] = mla.einsum(\"{subscripts}\", {operands})"
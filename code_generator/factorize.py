@@ -0,0 +1,117 @@
+from __future__ import annotations
+import itertools
+
+import sympy
+
+from .classes import Symbol
+from .helper import tensor_flip
+from .tensor import Tensor
+
+o, v = sympy.symbols("o v", positive=True)
+# Orbital space sizes used to compare contraction orders. Only the ratio matters for large systems.
+reference_sizes = {o: 10, v: 40}
+
+Tree = tuple # Either an int, the index of an amplitude, or a pair of Trees.
+
+def dimension(symbol: Symbol) -> sympy.Symbol:
+    return o if symbol.occupied else v
+
+def step_cost(symbols: set[Symbol]) -> sympy.Expr:
+    """ The cost of a pairwise contraction is the product of the dimensions of all indices involved. """
+    return sympy.Mul(*[dimension(symbol) for symbol in symbols])
+
+
+class Factorization:
+    """ The optimal pairwise contraction order for a Tensor, under a cost model in symbolic o and v. """
+
+    def __init__(self, tensor: Tensor, sizes: dict[sympy.Symbol, int] = reference_sizes):
+        self.tensor = tensor
+        self.sizes = sizes
+        self.operands = [amplitude.upper + amplitude.lower for amplitude in tensor.amplitudes]
+        self.output = list(itertools.chain(*tensor_flip(tensor.external_indices))) if tensor.external_indices else []
+        self.tree, self.costs = self.optimize()
+
+    def kept(self, mask: int) -> list[Symbol]:
+        """ Return the indices of the product of the amplitudes in mask that survive the product:
+        those also present in another amplitude or in the output. Order is by first appearance. """
+        inside = [symbol for k, operand in enumerate(self.operands) if mask >> k & 1 for symbol in operand]
+        outside = set(self.output)
+        outside.update(symbol for k, operand in enumerate(self.operands) if not mask >> k & 1 for symbol in operand)
+        return list(dict.fromkeys(symbol for symbol in inside if symbol in outside))
+
+    def optimize(self) -> tuple[Tree, list[sympy.Expr]]:
+        """ Find the cheapest order of pairwise contractions by dynamic programming over subsets of amplitudes. """
+        n = len(self.operands)
+        best = {1 << k: (0, k, []) for k in range(n)}
+        for mask in sorted(range(1, 1 << n), key=lambda x: bin(x).count("1")):
+            if mask in best:
+                continue
+            sub = (mask - 1) & mask
+            while sub:
+                other = mask ^ sub
+                if sub < other:
+                    cost = step_cost(set(self.kept(sub)) | set(self.kept(other)))
+                    total = best[sub][0] + best[other][0] + cost.subs(self.sizes)
+                    if mask not in best or total < best[mask][0]:
+                        best[mask] = (total, (best[sub][1], best[other][1]), best[sub][2] + best[other][2] + [cost])
+                sub = (sub - 1) & mask
+        _, tree, costs = best[(1 << n) - 1]
+        return tree, costs
+
+    def scaling(self) -> sympy.Expr:
+        """ The cost of the most expensive step, e.g. o**2*v**4. """
+        if not self.costs:
+            return step_cost(set(self.operands[0]))
+        return max(self.costs, key=lambda x: x.subs(self.sizes))
+
+    def print_code(self, variable: str) -> str:
+        """ Print the contraction as explicit pairwise steps with named temporaries, for use in the pilot implementation. """
+        ws = " " * 4
+        lines = [ws + f"# Scaling: {self.scaling()}"]
+        if isinstance(self.tree, int):
+            # Nothing to factorize. Defer to the usual printing.
+            return lines[0] + "\n" + self.tensor.print_code(variable)
+        expression, indices = self.print_tree(self.tree, lines)
+        weight = "" if self.tensor.weight == 1 else f"{self.tensor.weight} * "
+        permutation = tuple(indices.index(symbol) for symbol in self.output)
+        if permutation != tuple(range(len(permutation))):
+            expression += f".transpose{permutation}"
+        lines.append(ws + f"temp = {weight}{expression}")
+        return "\n".join(lines) + "\n" + self.tensor.print_accumulation(variable)
+
+    def print_tree(self, tree: Tree, lines: list[str]) -> tuple[str, list[Symbol]]:
+        """ Print the steps needed to evaluate the tree. Return the name of the result and its indices. """
+        if isinstance(tree, int):
+            return "i[\"" + self.tensor.amplitudes[tree].full_name() + "\"]", self.operands[tree]
+        left, left_indices = self.print_tree(tree[0], lines)
+        right, right_indices = self.print_tree(tree[1], lines)
+        mask = leaves(tree)
+        kept = self.kept(mask)
+        common = [symbol for symbol in left_indices if symbol in right_indices]
+        ws = " " * 4
+        name = f"temp{len([x for x in lines if x.startswith(ws + 'temp')]) + 1}"
+        is_tensordot = (
+                not set(common) & set(kept) and # Hadamard-type index
+                len(set(left_indices)) == len(left_indices) and # Trace within an operand
+                len(set(right_indices)) == len(right_indices))
+        if is_tensordot:
+            left_axes = [left_indices.index(symbol) for symbol in common]
+            right_axes = [right_indices.index(symbol) for symbol in common]
+            indices = [x for x in left_indices if x not in common] + [x for x in right_indices if x not in common]
+            lines.append(ws + f"{name} = np.tensordot({left}, {right}, axes=({left_axes}, {right_axes}))")
+        else:
+            indices = kept
+            subscripts = ", ".join("".join(x.letter for x in row) for row in (left_indices, right_indices))
+            subscripts += " -> " + "".join(x.letter for x in indices)
+            lines.append(ws + f"{name} = einsum(\"{subscripts}\", {left}, {right})")
+        return name, indices
+
+def print_code(tensor: Tensor, variable: str, factorize: bool = False) -> str:
+    """ Print the code for a tensor, either as one einsum or as factorized pairwise steps. """
+    return Factorization(tensor).print_code(variable) if factorize else tensor.print_code(variable)
+
+def leaves(tree: Tree) -> int:
+    """ Return the bitmask of amplitudes in the tree. """
+    if isinstance(tree, int):
+        return 1 << tree
+    return leaves(tree[0]) | leaves(tree[1])
@@ -7,11 +7,13 @@ from typing import Callable
 from .classes import Amplitude, Diagram, Operator, Spin, Symbol
 from .tensor import Tensor
 from . import commutator
-from .spin_integrate import spin_integrate
+from .spin_integrate import is_closed_shell_canonical, spin_integrate
 from .helper import get_space_count, get_space_string, find_parity, multinomial, swap_symbols, write_files
 from . import data, helper
 from .tensor_helper import expand_antisymmetrizers, expand_antisymmetrizer_row, seek_equivalents
 from .construct_tensor import tensor_from_diagram
+from .cse import CommonSubexpressions
+from .factorize import print_code
 
 Stringlist = list[list[list[str], list[str]]]
 
@@ -102,13 +104,20 @@ def product_rule(tensors: Iterable[Tensor], is_differentiable_name: Callable[str
             differentiated_tensors.append(Tensor(amplitudes, weight, external, antisymmetrizers))
     return differentiated_tensors
 
-def compute_rdm_param(SQ: Operator, max_commutator: int, cluster_ranks: list[int], weight_rule: data.WeightRule, spinintegrate: bool = False) -> list[dict[str, list[Tensor]]]:
+def compute_rdm_param(SQ: Operator, max_commutator: int, cluster_ranks: list[int], weight_rule: data.WeightRule, spinintegrate: bool = False, cse: CommonSubexpressions = None, factorize: bool = False, restricted: bool = False) -> list[dict[str, list[Tensor]]]:
     """
     Input
     -----
     SQ:
         Represents a second quantized operator of generic indices. Each Counter should store only generic
         indices. The first represents the top row, and the second the bottom row.
+    cse:
+        If given, tensors are queued there for common subexpression elimination instead of written immediately.
+    factorize:
+        If True, print each tensor as explicit pairwise contractions in the optimal order.
+    restricted:
+        If True, with spinintegrate, write only the spin blocks a closed-shell reference needs. The rest equal
+        their spin-flipped blocks. All blocks still enter the energy, so the residuals are differentiated from all of them.
 
     Output
     ------
@@ -166,30 +175,34 @@ def compute_rdm_param(SQ: Operator, max_commutator: int, cluster_ranks: list[int
                 tensors = list(itertools.chain(*[spin_integrate(tensor) for tensor in tensors]))
                 tensors = seek_equivalents(tensors)
             tensors_to_differentiate = []
-            tensor_prints = []
+            tensor_terms = []
             for new_tensor in tensors:
                 prefix = "c" if diagram_class.startswith("Connected") and diagram_rank == 2 else "rdm"
                 new_ext = helper.tensor_flip(new_tensor.external_indices)
                 varname = f"i[\"{prefix}_{get_space_string(new_ext)}{new_tensor.spin_suffix()}\"]"
                 tensors_to_differentiate.append(new_tensor)
-                tensor_prints.append(new_tensor.print_code(varname))
+                if not restricted or is_closed_shell_canonical(new_tensor):
+                    tensor_terms.append((new_tensor, varname))
                 returns[-1][diagram_class].append(new_tensor)
-            write_files(f"{commutator_number}_{diagram_class.lower()}", "\n".join(tensor_prints))
+            write_tensors(f"{commutator_number}_{diagram_class.lower()}", tensor_terms, cse, factorize)
 
             # Differentiate.
             if tensors_to_differentiate:
-                rdm_to_en_deriv(tensors_to_differentiate, "g" if diagram_rank == 2 else "f", f"{commutator_number}_{diagram_class.lower()}")
+                rdm_to_en_deriv(tensors_to_differentiate, "g" if diagram_rank == 2 else "f", f"{commutator_number}_{diagram_class.lower()}", cse, factorize, restricted)
 
         # Use diagrams from n commutators to get those for n+1 commutators
         starting_diagrams = open_diagrams
     return returns
 
-def rdm_to_en_deriv(tensors: Iterable[Tensor], symbol: str, filename: str =""):
+def rdm_to_en_deriv(tensors: Iterable[Tensor], symbol: str, filename: str ="", cse: CommonSubexpressions = None, factorize: bool = False, restricted: bool = False):
     """ Given RDM tensors, print out the tensors for the energy derivatives, assuming a simple product rule.
 
     tensors: The Tensor objects to differentiate.
     symbol: The symbol of the non-amplitude coefficient. Usually an integral.
     name: name of the file to write to
+    cse: if given, queue the tensors there for common subexpression elimination
+    factorize: whether to print the tensors as pairwise contractions
+    restricted: whether to print only the residual blocks of a closed-shell reference
     """
     tensors = [full_contract(tensor, symbol) for tensor in tensors]
     tensors = product_rule(tensors, lambda x: x.startswith("t"))
@@ -200,10 +213,19 @@ def rdm_to_en_deriv(tensors: Iterable[Tensor], symbol: str, filename: str =""):
     # is sped up. (See commutator.py.)
     #tensors = list(itertools.chain(*[spin_integrate(tensor) for tensor in tensors]))
     #tensors = seek_equivalents(tensors)
-    tensor_prints = [tensor.print_code(f"i[\"r{tensor.rank()}{tensor.spin_suffix()}\"]") for tensor in tensors]
-    write_files(f"{filename}_residual", "\n".join(tensor_prints))
-
-def compute_cumulant_partial_trace(data: dict[str, dict[str: list[Tensor]]]):
+    if restricted:
+        tensors = [tensor for tensor in tensors if is_closed_shell_canonical(tensor)]
+    tensor_terms = [(tensor, f"i[\"r{tensor.rank()}{tensor.spin_suffix()}\"]") for tensor in tensors]
+    write_tensors(f"{filename}_residual", tensor_terms, cse, factorize)
+
+def write_tensors(filename: str, terms: list[tuple[Tensor, str]], cse: CommonSubexpressions = None, factorize: bool = False):
+    """ Write the code for each (tensor, variable) pair, or queue them in cse to be written later. """
+    if cse is None:
+        write_files(filename, "\n".join(print_code(tensor, variable, factorize) for tensor, variable in terms))
+    else:
+        cse.add(filename, terms)
+
+def compute_cumulant_partial_trace(data: dict[str, dict[str: list[Tensor]]], cse: CommonSubexpressions = None, factorize: bool = False, restricted: bool = False):
     """ Compute the d (2-RDM cumulant partial trace) terms of DCT.
 
     Input
@@ -212,6 +234,12 @@ def compute_cumulant_partial_trace(data: dict[str, dict[str: list[Tensor]]]):
         A structured dictionary. Key one (e.g., "oo") specifies which block
         is left after partial trace. Key two (e.g., "v") specifies which block
         to partial trace over. The value of that is a list of tensors.
+    cse: CommonSubexpressions
+        If given, queue the tensors there for common subexpression elimination.
+    factorize: bool
+        Whether to print the tensors as pairwise contractions.
+    restricted: bool
+        Whether to print only the blocks of a closed-shell reference. The partial traces are taken over all blocks.
     """
     for d_block, value in data.items():
         for i, (o_data, v_data) in enumerate(zip(value["o"], value["v"]), start=1):
@@ -219,9 +247,10 @@ def compute_cumulant_partial_trace(data: dict[str, dict[str: list[Tensor]]]):
             v_data = compute_d(v_data, False)
             d_tensor = seek_equivalents(o_data + v_data)
             d_tensor = [tensor for tensor in d_tensor if tensor.weight]
-            tensor_prints = [tensor.print_code(f"i[\"d_{d_block}{tensor.spin_suffix()}\"]") for tensor in d_tensor]
-            write_files(f"{i}_d", "\n".join(tensor_prints))
-            rdm_to_en_deriv(d_tensor, "ft", f"{i}_d")
+            tensor_terms = [(tensor, f"i[\"d_{d_block}{tensor.spin_suffix()}\"]") for tensor in d_tensor
+                    if not restricted or is_closed_shell_canonical(tensor)]
+            write_tensors(f"{i}_d", tensor_terms, cse, factorize)
+            rdm_to_en_deriv(d_tensor, "ft", f"{i}_d", cse, factorize, restricted)
 
 def compute_d(tensors: Iterable[Tensor], target_occupied: bool) -> list[Tensor]:
     """ Partial trace the input tensors over indices with the specified occupation."""
@@ -111,6 +111,21 @@ def spin_integrate_case(tensor: Tensor, symbol_to_spin: dict[Symbol, Spin]) -> T
 
     return Tensor(new_amplitudes, weight, new_externals, tensor.antisymmetrizers)
 
+def closed_shell_preference(external_indices: list[list[Symbol]]) -> tuple[int, tuple[str, ...]]:
+    """ Rank a spin block among its spin-flipped partners: fewer beta indices first, then by orbital spaces. """
+    num_beta = sum(symbol.spin == Spin.BETA for symbol in external_indices[0])
+    return num_beta, tuple(sorted("".join("o" if symbol.occupied else "v" for symbol in row) for row in external_indices))
+
+def is_closed_shell_canonical(tensor: Tensor) -> bool:
+    """
+    For a closed-shell reference, every spin block equals the block with all spins flipped, up to a reordering
+    of indices. Of each such pair, a restricted code keeps only the block with fewer beta indices, e.g. αα over ββ,
+    and ovov_αβ over vovo_αβ. Is the block of this spin-integrated tensor the one kept?
+    """
+    flip = {Spin.ALPHA: Spin.BETA, Spin.BETA: Spin.ALPHA}
+    flipped = [sorted(Symbol(symbol.letter, flip[symbol.spin]) for symbol in row) for row in tensor.external_indices]
+    return closed_shell_preference(tensor.external_indices) <= closed_shell_preference(flipped)
+
 def multiset_complement(multiset: list, subset: list) -> list:
     """ Return all elements of multiset that are not in subset. """
     complement = []
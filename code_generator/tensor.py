@@ -62,33 +62,41 @@ class Tensor:
             return "_" + "".join(str(x.spin) for x in self.external_indices[0])
 
     def print_code(self, variable: str) -> str:
-        """ Print the string representation of the contraction, for use in the pilot implementation. """
+        """ Print the string representation of the contraction, for use in the pilot implementation.
+        One call of multilinear.einsum_add scales the contraction and adds it into the variable. """
         ws = " " * 4
-        string = ws + "temp = "
-        if self.weight != Fraction(1, 1):
-            string += "{} * ".format(self.weight)
-        string += "einsum(\""
         flipped_external = tensor_flip(self.external_indices)
-        string += ", ".join(i.reduced_str() for i in  self.amplitudes) + " -> " + simple_to_string(flipped_external) + "\", "
+        subscripts = ", ".join(i.reduced_str() for i in  self.amplitudes) + " -> " + simple_to_string(flipped_external)
         tensor_names = []
         for tensor in self.amplitudes:
             tensor_name = "i[\"" + tensor.full_name() + "\"]"
             tensor_names.append(tensor_name)
-        string += ", ".join(tensor_names) + ")\n" + ws + variable + " += "
+        string = ws + f"{variable} = mla.einsum_add({variable}, \"{subscripts}\", " + ", ".join(tensor_names)
+        if self.weight != Fraction(1, 1):
+            string += ", weight={}".format(self.weight)
         if self.antisymmetrizers:
-            string += "mla.antisymmetrize_axes_plus(temp"
-            group_strings = []
-            externals = []
-            # Create a list that functions as a hash from symbol to index in einsum
-            for row in flipped_external:
-                externals += row
-            for asym_group in self.antisymmetrizers:
-                block_list = []
-                for block in asym_group:
-                    block_list.append("(" + ", ".join([str(externals.index(symb)) for symb in block]) + ",)")
-                string += ", (" + ", ".join(block_list) + ")"
-            string+= ")"
-        else:
-            string += "temp"
-        return string
+            string += ", antisymmetrizer=" + self.print_antisymmetrizer()
+        return string + ")"
+
+    def print_accumulation(self, variable: str) -> str:
+        """ Print the line that adds temp to the variable, antisymmetrizing if needed. """
+        ws = " " * 4
+        string = ws + f"{variable} = mla.accumulate({variable}, temp"
+        if self.antisymmetrizers:
+            string += ", " + self.print_antisymmetrizer()
+        return string + ")"
+
+    def print_antisymmetrizer(self) -> str:
+        """ Print the antisymmetrizers as the axis groups antisymmetrize_axes_plus takes, in a tuple. """
+        group_strings = []
+        externals = []
+        # Create a list that functions as a hash from symbol to index in einsum
+        for row in tensor_flip(self.external_indices):
+            externals += row
+        for asym_group in self.antisymmetrizers:
+            block_list = []
+            for block in asym_group:
+                block_list.append("(" + ", ".join([str(externals.index(symb)) for symb in block]) + ",)")
+            group_strings.append("(" + ", ".join(block_list) + ")")
+        return "(" + ", ".join(group_strings) + ("," if len(group_strings) == 1 else "") + ")"
 
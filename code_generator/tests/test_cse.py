@@ -0,0 +1,63 @@
+from DICE_L.cse import CommonSubexpressions, Intermediate, candidate_pairs, print_intermediate
+from DICE_L.classes import Amplitude, Symbol
+from DICE_L.tensor import Tensor
+
+from types import SimpleNamespace
+
+import numpy as np
+from opt_einsum import contract as einsum
+
+# The runtime helpers the generated code calls, as multilinear defines them for terms without antisymmetrizers.
+mla = SimpleNamespace(einsum=einsum, einsum_add=lambda target, subscripts, *operands, weight=1: target + weight * einsum(subscripts, *operands),
+                      accumulate=lambda target, value: target + value)
+
+def test_candidate_pairs_relabel():
+    # The same contraction, with different letters and amplitudes in a different order.
+    tensor1 = Tensor([Amplitude("Ii", "ab", "t2"), Amplitude("Ji", "ab", "t2")], 1, [["I"], ["J"]], set())
+    tensor2 = Tensor([Amplitude("Kj", "cd", "t2"), Amplitude("Lj", "cd", "t2")], 1, [["K"], ["L"]], set())
+    (key1, (_, _, open1)), = candidate_pairs(tensor1)
+    (key2, (_, _, open2)), = candidate_pairs(tensor2)
+    assert key1 == key2
+    assert len(open1) == len(open2) == 2
+
+def test_candidate_pairs_skip():
+    # Outer products and full contractions aren't worth an intermediate.
+    tensor = Tensor([Amplitude("IJ", "ab", "t2"), Amplitude("KL", "cd", "t2")], 1, [["I", "J"], ["K", "L"]], set())
+    assert candidate_pairs(tensor) == []
+    tensor = Tensor([Amplitude("ij", "ab", "t2"), Amplitude("ij", "ab", "t2")], 1, [], set())
+    assert candidate_pairs(tensor) == []
+
+def test_eliminate():
+    opdm = Tensor([Amplitude("Ii", "ab", "t2"), Amplitude("Ji", "ab", "t2")], -1/2, [["I"], ["J"]], set())
+    residual = Tensor([Amplitude("M", "K", "f", include_orbspace=True), Amplitude("Kj", "cd", "t2"), Amplitude("Lj", "cd", "t2")], 1, [["M"], ["L"]], set())
+    unshared = Tensor([Amplitude("IJ", "AB", "t2")], 1, [["I", "J"], ["A", "B"]], set())
+    cse = CommonSubexpressions()
+    cse.add("opdm", [(opdm, "i[\"rdm_oo\"]")])
+    cse.add("residual", [(residual, "i[\"r1\"]"), (unshared, "i[\"r2\"]")])
+    cse.eliminate()
+    (intermediate, definition), = cse.intermediates
+    assert intermediate.name == "x1"
+    assert cse.is_amplitude_only(intermediate)
+    new_opdm, new_residual, new_unshared = cse.tensors()
+    assert [x.name for x in new_opdm.amplitudes] == ["x1"]
+    assert [x.name for x in new_residual.amplitudes] == ["f", "x1"]
+    assert new_unshared == unshared
+
+    # The factored code must compute the same numbers as the unfactored code.
+    rng = np.random.default_rng(0)
+    i = {"t2": rng.random((3, 3, 4, 4)), "f_oo": rng.random((3, 3))}
+    expected = {"rdm_oo": 0, "r1": 0, "r2": 0}
+    for tensor, variable in [(opdm, "i[\"rdm_oo\"]"), (residual, "i[\"r1\"]"), (unshared, "i[\"r2\"]")]:
+        exec(tensor.print_code(variable.replace("i[", "expected[")).replace(" " * 4, ""), {"einsum": einsum, "mla": mla, "i": i, "expected": expected})
+    code = print_intermediate(intermediate, definition) + "\n"
+    code += "\n".join(tensor.print_code(variable) for tensor, variable in zip(cse.tensors(), ["i[\"rdm_oo\"]", "i[\"r1\"]", "i[\"r2\"]"]))
+    i.update({"rdm_oo": 0, "r1": 0, "r2": 0})
+    exec(code.replace(" " * 4, ""), {"einsum": einsum, "mla": mla, "i": i})
+    for key, value in expected.items():
+        assert np.allclose(value, i[key])
+
+def test_intermediate_print():
+    intermediate = Intermediate([Symbol("I"), Symbol("J")], "x3")
+    definition = Tensor([Amplitude("Ii", "ab", "t2"), Amplitude("Ji", "ab", "t2")], 1, [], set())
+    assert intermediate.full_name() == "x3"
+    assert print_intermediate(intermediate, definition) == "    i[\"x3\"] = mla.einsum(\"Ii ab, Ji ab -> IJ\", i[\"t2\"], i[\"t2\"])"
@@ -0,0 +1,41 @@
+from DICE_L.factorize import Factorization, o, v
+from DICE_L.classes import Amplitude
+from DICE_L.tensor import Tensor
+
+from types import SimpleNamespace
+
+import numpy as np
+from opt_einsum import contract as einsum
+
+# The runtime helpers the generated code calls, as multilinear defines them for terms without antisymmetrizers.
+mla = SimpleNamespace(einsum_add=lambda target, subscripts, *operands, weight=1: target + weight * einsum(subscripts, *operands),
+                      accumulate=lambda target, value: target + value)
+
+def test_order():
+    # Contracting an amplitude with the integral first avoids the o^4 v^4 outer product of the amplitudes.
+    tensor = Tensor([Amplitude("kl", "cd", "g", include_orbspace=True), Amplitude("IJ", "cd", "t2"), Amplitude("kl", "AB", "t2")], 1, [["I", "J"], ["A", "B"]], set())
+    factorization = Factorization(tensor)
+    assert factorization.scaling() == o ** 4 * v ** 2
+    assert factorization.costs == [o ** 4 * v ** 2] * 2
+    tensor = Tensor([Amplitude("IJ", "ab", "t2"), Amplitude("ab", "cd", "g", include_orbspace=True), Amplitude("cd", "KL", "t2")], 1, [["I", "J"], ["K", "L"]], set())
+    assert Factorization(tensor).scaling() == o ** 2 * v ** 4
+
+def test_print():
+    tensor = Tensor([Amplitude("I", "i", "f", include_orbspace=True), Amplitude("Ji", "AB", "t2")], 2, [["I", "J"], ["A", "B"]], set())
+    code = Factorization(tensor).print_code("i[\"r2\"]")
+    assert "np.tensordot(" in code
+    assert "einsum(" not in code
+    rng = np.random.default_rng(0)
+    i = {"f_oo": rng.random((3, 3)), "t2": rng.random((3, 3, 4, 4)), "r2": 0}
+    exec(code.replace(" " * 4, ""), {"np": np, "einsum": einsum, "mla": mla, "i": i})
+    assert np.allclose(i["r2"], 2 * np.einsum("Ii, JiAB -> IJAB", i["f_oo"], i["t2"]))
+
+def test_trace():
+    # j is summed within the integral, which tensordot can't do.
+    tensor = Tensor([Amplitude("Ij", "Kj", "g", include_orbspace=True), Amplitude("KL", "AB", "t2")], 1, [["I", "L"], ["A", "B"]], set())
+    code = Factorization(tensor).print_code("i[\"r2\"]")
+    assert "np.tensordot(" not in code
+    rng = np.random.default_rng(0)
+    i = {"g_oooo": rng.random((3, 3, 3, 3)), "t2": rng.random((3, 3, 4, 4)), "r2": 0}
+    exec(code.replace(" " * 4, ""), {"np": np, "einsum": einsum, "mla": mla, "i": i})
+    assert np.allclose(i["r2"], np.einsum("IjKj, KLAB -> ILAB", i["g_oooo"], i["t2"]))
@@ -1,4 +1,4 @@
-from DICE_L.spin_integrate import construct_external_spin_counts, construct_allowed_spins, spin_integrate_case, spin_integrate, assign_external_spin
+from DICE_L.spin_integrate import construct_external_spin_counts, construct_allowed_spins, spin_integrate_case, spin_integrate, assign_external_spin, is_closed_shell_canonical
 import pytest
 import unittest
 from DICE_L.classes import Amplitude, Spin, Symbol
@@ -78,6 +78,16 @@ def test_spin_integrate_anti():
     for term in expected:
         assert term in results
 
+def test_closed_shell_canonical():
+    def block(upper, lower, spin):
+        return Tensor([Amplitude(upper, lower, "x", spin)], 1, [list(upper), list(lower)], set())
+    assert is_closed_shell_canonical(block("IA", "JB", "aa"))
+    assert not is_closed_shell_canonical(block("IA", "JB", "bb"))
+    assert is_closed_shell_canonical(block("IA", "JB", "ab"))
+    assert not is_closed_shell_canonical(block("AI", "BJ", "ab"))
+    # ovvo_αβ is its own spin flip, after hermitian conjugation.
+    assert is_closed_shell_canonical(block("IA", "BJ", "ab"))
+
 
 def test_spin_suffix():
     tensor = Tensor([Amplitude("Ii", "Ba", "t2"), Amplitude("Ji", "Aa", "t2")], 1, [["I", "A"], ["J", "B"]], set())
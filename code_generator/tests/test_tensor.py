@@ -62,7 +62,9 @@ def test_tensor_from_diagram():
 
 def test_print_code():
     tensor = Tensor([Amplitude("IJ", "AB", "t2")], 1, [["I", "J"], ["A", "B"]], set())
-    tensor.print_code("c")
+    assert tensor.print_code("c") == "    c = mla.einsum_add(c, \"IJ AB -> IJ AB\", i[\"t2\"])"
+    tensor.weight = -1/2
+    assert tensor.print_code("c").endswith(", weight=-0.5)")
 
 def test_seek_equivalents():
     input_tensors = [
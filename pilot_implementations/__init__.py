@@ -1 +1 @@
-from .scripts.runner import subspace
+from .scripts.runner import batch, subspace
@@ -0,0 +1,61 @@
+"""
+Compare multilinear.antisymmetrize_axes_plus against the permutation loop it replaced,
+on tensors shaped like rank-2 and rank-3 residuals.
+
+Run `python -m pilot_implementations.benchmarks.antisymmetrize [nocc] [nvir]`.
+"""
+import sys
+import timeit
+
+import numpy as np
+from sympy.utilities.iterables import multiset_permutations
+
+from pilot_implementations.multilinear.asym import antisymmetrize_axes_plus, find_parity
+
+def reference_antisymmetrize_axes_plus(tensor: np.ndarray, *axis_data: tuple[tuple[int]]) -> np.ndarray:
+    """ The original implementation: enumerate permutations and move axes on every call. """
+    returned_tensor = tensor.copy()
+    for row in axis_data:
+        old_tensor = returned_tensor.copy()
+        returned_tensor = np.zeros(returned_tensor.shape)
+        integer_mask = []
+        permutation_blocks = []
+        old_ordering = []
+        for i, block in enumerate(row):
+            integer_mask += [i] * len(block)
+            permutation_blocks.append(block)
+            old_ordering += block
+        old_ordering = sorted(old_ordering)
+        for permutation in multiset_permutations(integer_mask):
+            next_index_per_block = [0] * len(permutation_blocks)
+            new_ordering = []
+            for block, old_axis in zip(permutation, old_ordering):
+                next_index = next_index_per_block[block]
+                new_axis = permutation_blocks[block][next_index]
+                new_ordering.append(new_axis)
+                next_index_per_block[block] += 1
+            returned_tensor += np.moveaxis(old_tensor, new_ordering, old_ordering) * find_parity(new_ordering, old_ordering)
+    return returned_tensor
+
+def cases(nocc: int, nvir: int) -> list[tuple[str, tuple[int], tuple]]:
+    return [
+        ("rank 2, P(ij)", (nocc, nocc, nvir, nvir), (((0,), (1,)),)),
+        ("rank 2, P(ij) P(ab)", (nocc, nocc, nvir, nvir), (((0,), (1,)), ((3,), (2,)))),
+        ("rank 3, P(i/jk)", (nocc,) * 3 + (nvir,) * 3, (((0,), (1, 2)),)),
+        ("rank 3, P(i/j/k) P(a/bc)", (nocc,) * 3 + (nvir,) * 3, (((0,), (1,), (2,)), ((3,), (4, 5)))),
+    ]
+
+def main(nocc: int = 6, nvir: int = 14, repeat: int = 5):
+    rng = np.random.default_rng(0)
+    print(f"{'case':28s} {'reference (ms)':>15s} {'new (ms)':>10s} {'speedup':>8s}")
+    for name, shape, axis_data in cases(nocc, nvir):
+        tensor = rng.random(shape)
+        out = np.empty(shape)
+        assert np.allclose(reference_antisymmetrize_axes_plus(tensor, *axis_data), antisymmetrize_axes_plus(tensor, *axis_data))
+        number = max(1, int(2e6 // tensor.size))
+        old = min(timeit.repeat(lambda: reference_antisymmetrize_axes_plus(tensor, *axis_data), number=number, repeat=repeat)) / number
+        new = min(timeit.repeat(lambda: antisymmetrize_axes_plus(tensor, *axis_data, out=out), number=number, repeat=repeat)) / number
+        print(f"{name:28s} {old * 1e3:15.3f} {new * 1e3:10.3f} {old / new:8.1f}")
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -1,60 +1,105 @@
-from functools import partial
-from itertools import starmap
+import tempfile
 from typing import Union
 import numpy as np
-from copy import deepcopy
 
 
 class DirectSumDiis():
-    """ 
+    """
     A class to perform DIIS extrapolation on a direct sum of vectors.
     Needed to couple orbital and amplitude amplitudes.
+
+    The stored residual and trial vectors are flattened into rows of two preallocated ring buffers, so storing
+    one costs a copy into place, and only the row of the B matrix for the newest residual is computed.
+    The extrapolated vector is written into the trial arrays passed in, which are returned.
+    If directory is given, the buffers are memory-mapped to temporary files there, for amplitudes too large
+    to keep max_vec copies of in memory, and only the B matrix stays in memory. The files are deleted when the
+    object is. The directory may be set any time before the first vectors are stored. Dot products and the
+    extrapolation stream through the buffers chunk_size elements of a row at a time.
     """
 
-    def __init__(self, min_vec, max_vec):
+    def __init__(self, min_vec, max_vec, directory=None, chunk_size=2 ** 20):
         self.min = min_vec # Minimum vectors at once. Constant.
-        self.max = max_vec # Minimum vectors at once. Constant.
-        self.residuals = []
-        self.trials = []
+        self.max = max_vec # Maximum vectors at once. Constant.
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.residuals = None
+        self.trials = None
+        self.B = np.zeros((max_vec, max_vec))
+        self.count = 0 # Vectors stored so far. The newest is in row (count - 1) % max.
         self.skipped0 = False
 
     def diis(self, r, t):
         if not self.skipped0:
             self.skipped0 = True
-            return deepcopy(t)
+            return t
 
-        self.residuals.append(deepcopy(r))
-        self.trials.append(deepcopy(t))
+        r_pieces = [piece for vector in as_direct_sum(r) for piece in pieces(vector)]
+        t_pieces = [piece for vector in as_direct_sum(t) for piece in pieces(vector)]
+        if self.residuals is None:
+            self.residuals = self._buffer(r_pieces)
+            self.trials = self._buffer(t_pieces)
         # Enforce the maximum number of residuals and trial vectors with first in, first out.
-        if len(self.residuals) > self.max:
-            self.residuals.pop(0)
-            self.trials.pop(0)
+        slot = self.count % self.max
+        self.count += 1
+        num_vec = min(self.count, self.max)
+        write_row(self.residuals[slot], r_pieces)
+        write_row(self.trials[slot], t_pieces)
+        row = np.zeros(num_vec)
+        for start in range(0, self.residuals.shape[1], self.chunk_size):
+            columns = slice(start, start + self.chunk_size)
+            row += self.residuals[:num_vec, columns] @ self.residuals[slot, columns]
+        self.B[slot, :num_vec] = self.B[:num_vec, slot] = row
+
         # Perform DIIS if we have at least the minimum number of extrapolation points.
-        if len(self.residuals) >= self.min:
-            B_dim = 1 + len(self.residuals)
-            B = np.empty((B_dim, B_dim))
-            B[-1, :] = B[:, -1] = -1
-            B[-1, -1] = 0
-            for i, ri in enumerate(self.residuals):
-                for j, rj in enumerate(self.residuals):
-                    if i > j: continue
-                    B[i, j] = B[j, i] = direct_sum_dot(ri, rj)
-            # Normalize the matrix for numerical stability.
-            B[:-1, :-1] /= np.abs(B[:-1, :-1]).max()
-            rhs = np.zeros((B_dim))
-            rhs[-1] = -1
-            coeffs = np.linalg.solve(B, rhs)[:-1]
-            trials_to_new = partial(np.tensordot, b=coeffs, axes=(0,0))
-            if isinstance(self.trials[0], np.ndarray):
-                return trials_to_new(self.trials)
-            else:
-                return list(map(trials_to_new, zip(*self.trials)))
-        else:
+        if num_vec < self.min:
             return t
+        B_dim = 1 + num_vec
+        B = np.empty((B_dim, B_dim))
+        B[-1, :] = B[:, -1] = -1
+        B[-1, -1] = 0
+        B[:-1, :-1] = self.B[:num_vec, :num_vec]
+        # Normalize the matrix for numerical stability.
+        B[:-1, :-1] /= np.abs(B[:-1, :-1]).max()
+        rhs = np.zeros((B_dim))
+        rhs[-1] = -1
+        coeffs = np.linalg.solve(B, rhs)[:-1]
+        offset = 0
+        for piece in t_pieces:
+            if piece.flags.c_contiguous and piece.dtype == self.trials.dtype:
+                flat = piece.reshape(-1)
+                for start in range(0, piece.size, self.chunk_size):
+                    chunk = flat[start: start + self.chunk_size]
+                    np.dot(coeffs, self.trials[:num_vec, offset + start: offset + start + chunk.size], out=chunk)
+            else:
+                piece[...] = (coeffs @ self.trials[:num_vec, offset: offset + piece.size]).reshape(piece.shape)
+            offset += piece.size
+        return t
+
+    @property
+    def nbytes(self) -> int:
+        """ Bytes held in memory. Buffers mapped to files in directory are on disk, and count for nothing. """
+        buffers = [x for x in (self.residuals, self.trials) if x is not None and not isinstance(x, np.memmap)]
+        return self.B.nbytes + sum(x.nbytes for x in buffers)
+
+    def _buffer(self, vector_pieces) -> np.ndarray:
+        """ Allocate max_vec rows, each long enough for the pieces of one vector. """
+        shape = (self.max, sum(piece.size for piece in vector_pieces))
+        dtype = np.result_type(*vector_pieces)
+        if self.directory is None:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(tempfile.TemporaryFile(dir=self.directory), dtype=dtype, mode="w+", shape=shape)
+
+def as_direct_sum(vector: Union[np.ndarray, tuple]) -> tuple:
+    """ A vector of the direct sum is a tuple of arrays. A lone array is a direct sum of one. """
+    return (vector,) if isinstance(vector, np.ndarray) else tuple(vector)
+
+def pieces(vector) -> list[np.ndarray]:
+    """ The arrays a vector is stored in. Tensors stored in blocks, like IrrepTensor, are stored in their blocks. """
+    return list(vector.blocks.values()) if hasattr(vector, "blocks") else [vector]
 
-def direct_sum_dot(r1: Union[np.ndarray, tuple[np.ndarray]], r2: Union[np.ndarray, tuple[np.ndarray]],) -> float:
-    """ Return the sum of the dot products for each vector in the direct sum. """
-    if not isinstance(r1, np.ndarray):
-        return sum(starmap(np.vdot, zip(r1, r2)))
-    else:
-        return np.vdot(r1, r2)
+def write_row(row: np.ndarray, vector_pieces: list[np.ndarray]):
+    """ Copy the pieces of a vector into a row of a buffer, one after another. """
+    offset = 0
+    for piece in vector_pieces:
+        row[offset: offset + piece.size].reshape(piece.shape)[...] = piece
+        offset += piece.size
@@ -1,10 +1,21 @@
+from concurrent.futures import ProcessPoolExecutor
+import functools
+from math import factorial
 import numpy as np
-import scipy.misc
 from pilot_implementations.multilinear.tensor import einsum
 from typing import Callable, Union
 
+def central_diff_weights(npts: int, nder: int = 1) -> np.ndarray:
+    """ The weights of the npts-point central difference stencil for the nder'th derivative, at unit step.
+    This is the scipy.misc function of the same name, which scipy no longer has. """
+    if npts < nder + 1 or npts % 2 == 0:
+        raise ValueError("The stencil needs an odd number of points, more than the order of the derivative.")
+    offsets = np.arange(npts) - npts // 2
+    # Taylor expand f at each offset. The weights pick out nder! times the coefficient of x^nder.
+    return factorial(nder) * np.linalg.inv(np.vander(offsets, increasing=True).astype(float))[nder]
+
 # TODO: Get a better finite difference code. Perhaps repurpose Psi's?
-def central_difference(f: Callable[np.ndarray, Union[float, np.ndarray]], x: np.ndarray, step: Union[float, np.ndarray], npts: Union[int, None] = None, nder: int = 1) -> np.ndarray:
+def central_difference(f: Callable[np.ndarray, Union[float, np.ndarray]], x: np.ndarray, step: Union[float, np.ndarray], npts: Union[int, None] = None, nder: int = 1, num_workers: int = 1, value=None) -> np.ndarray:
     """
     Evaluates f'(x) by finite differentiation.
 
@@ -21,6 +32,11 @@ def central_difference(f: Callable[np.ndarray, Union[float, np.ndarray]], x: np.
         The number of points to use in the stencil.
     nder:
         Take the nder'th derivative of this function.
+    num_workers:
+        The number of processes to evaluate the stencil on. With more than one, f must be picklable,
+        e.g. a module-level function or a functools.partial of one.
+    value:
+        f(x), if already known.
 
     Output
     ------
@@ -31,22 +47,45 @@ def central_difference(f: Callable[np.ndarray, Union[float, np.ndarray]], x: np.
         npts = 1 + nder + nder % 2
     if not np.ndim(step):
         step = float(step) * np.ones_like(x)
-    weights = scipy.misc.central_diff_weights(Np=npts, ndiv=nder)
+    weights = central_diff_weights(npts, nder)
+    center = npts // 2
+    # The center weight of an odd derivative is zero, up to roundoff in the weights.
+    has_center = not np.isclose(weights[center], 0)
 
-    def derivative(index):
+    # Every stencil is centered on x, so f(x) is shared by all components. It's only needed at all for even nder.
+    indices = list(np.ndindex(np.shape(x)))
+    points = []
+    for index in indices:
         # Construct our displacement
         dx = np.zeros_like(x)
         dx[index] = step[index]
-        disp_grid = [np.array(x) + (k-npts//2) * dx for k in range(npts)]
-        vals = tuple(map(f, disp_grid))
-        return sum(np.array(vals) * weights / (step[index] ** nder))
+        points.extend(np.array(x) + (k - center) * dx for k in range(npts) if k != center)
+    need_center = has_center and value is None
+    if need_center:
+        points.append(np.array(x))
+
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            vals = list(pool.map(f, points))
+    else:
+        vals = list(map(f, points))
+    if need_center:
+        value = vals.pop()
 
-    der = tuple(map(derivative, np.ndindex(np.shape(x))))
-    shape = np.shape(x) + np.shape(f(x))
+    off_center = np.delete(weights, center)
+    der = []
+    for i, index in enumerate(indices):
+        stencil = vals[i * (npts - 1): (i + 1) * (npts - 1)]
+        total = sum(weight * np.array(val) for weight, val in zip(off_center, stencil))
+        if has_center:
+            total = total + weights[center] * np.array(value)
+        der.append(total / (step[index] ** nder))
+
+    shape = np.shape(x) + np.shape(vals[0])
     return np.reshape(der, shape)
 
 
-def hellmann_test(solve: Callable, h_ao: np.ndarray, p_ao: np.ndarray, *args, e_thresh: float = 1e-10, r_thresh: float = 1e-8, **kwargs) -> np.ndarray:
+def hellmann_test(solve: Callable, h_ao: np.ndarray, p_ao: np.ndarray, *args, e_thresh: float = 1e-10, r_thresh: float = 1e-8, num_workers: int = 1, **kwargs) -> np.ndarray:
     """
     Input
     -----
@@ -60,19 +99,24 @@ def hellmann_test(solve: Callable, h_ao: np.ndarray, p_ao: np.ndarray, *args, e_
         The energy convergence to pass to the solver.
     r_thresh:
         The residual convergence to pass to the solver.
+    num_workers:
+        The number of processes to solve the displaced points on. With more than one, solve and the other
+        arguments are pickled, as the solvers of the method modules can be.
 
-    Other arguments supplied as needed by the solver.
+    Other arguments supplied as needed by the solver. Pass the amplitudes of the field-free solution as guess
+    to start every displaced point from them.
 
     Output
     ------
     np.ndarray
         The dipole moment computed by finite difference.
     """
-    def single_point(f):
-        hp_ao = h_ao - einsum("x, p q x->p q", f, p_ao)
-        # The first argument to solve is the nuclear repulstion energy. This is constant for all displacements,
-        # so we don't actually need it.
-        return solve(0, hp_ao, *args, e_thresh=e_thresh, r_thresh=r_thresh, **kwargs)[0]["energy"]
-
-    return central_difference(single_point, np.array((0.0, 0.0, 0.0)), 0.002, npts=9)
+    single_point = functools.partial(_field_energy, solve, h_ao, p_ao, args, dict(kwargs, e_thresh=e_thresh, r_thresh=r_thresh))
+    return central_difference(single_point, np.array((0.0, 0.0, 0.0)), 0.002, npts=9, num_workers=num_workers)
 
+def _field_energy(solve, h_ao, p_ao, args, kwargs, f):
+    """ The energy in the electric field f. A module-level function, so it can be sent to worker processes. """
+    hp_ao = h_ao - einsum("x, p q x->p q", f, p_ao)
+    # The first argument to solve is the nuclear repulstion energy. This is constant for all displacements,
+    # so we don't actually need it.
+    return solve(0, hp_ao, *args, **kwargs)[0]["energy"]
@@ -1,8 +1,176 @@
+import math
+import re
+import tracemalloc
+from collections import defaultdict, namedtuple
+
+import numpy as np
+
+from pilot_implementations.multilinear.asym import antisymmetrize_axes_plus
+from pilot_implementations.multilinear.symmetry import key_irreps
 from pilot_implementations.multilinear.tensor import einsum
 
+# Bytes held by each intermediate, their totals by key_kind and overall, and the peak of traced memory
+# during an iteration, or None if it wasn't traced.
+MemoryReport = namedtuple("MemoryReport", ["sizes", "totals", "total", "peak"])
+
 def perturbation_gradient(gen_fock, hx, gx, sx, nx, RDM1, RDM2):
     one_term = einsum("q p,p q", hx, RDM1)
     two_term = 1 / 4 * einsum("rs pq,pq rs", gx, RDM2)
     lag_term = - einsum("q p,p q", gen_fock, sx)
     return one_term + two_term + lag_term + nx
 
+def amplitudes(intermediates) -> dict:
+    """ Return dense copies of the amplitudes, e.g. t2 or t1ov, to start a later computation from. """
+    return {key: np.array(value) for key, value in intermediates.items() if re.match(r"t\d", key)}
+
+def apply_guess(intermediates, guess):
+    """ Start from the amplitudes of guess, e.g. those of a nearby geometry, where their shapes match. """
+    for key, value in (guess or {}).items():
+        if key in intermediates and np.shape(intermediates[key]) == np.shape(value):
+            intermediates[key] = np.array(value)
+
+def check_stationary(intermediates, compute_intermediates, compute_energy, compute_amplitude_residual, tolerance=5e-9,
+        num_directions=3, step=5e-5, seed=0):
+    """
+    Check that the energy is stationary in the spin orbital amplitudes, e.g. t1 and t2, at their converged values.
+    The residuals are recomputed at those amplitudes, and their norm must be below tolerance. Each of num_directions
+    random unit directions, antisymmetric like the amplitudes, costs two energy evaluations for a central difference,
+    which must match vdot(residual, direction) to within tolerance. A residual of rank n is the derivative by the
+    unique amplitudes, so each full-tensor element of it counts 1 / (n!)^2. Raise an AssertionError otherwise.
+    """
+    rng = np.random.default_rng(seed)
+    start = {key: value for key, value in intermediates.items() if re.fullmatch(r"t\d+", key)}
+    compute_intermediates(intermediates)
+    compute_amplitude_residual(intermediates)
+    residual = {key: np.array(intermediates["r" + key[1:]]) for key in start}
+
+    def energy(direction, scale):
+        for key, value in start.items():
+            intermediates[key] = value + scale * direction[key]
+        compute_intermediates(intermediates)
+        return compute_energy(intermediates)
+
+    try:
+        residual_norm = np.sqrt(sum(np.vdot(x, x) for x in residual.values()))
+        if residual_norm > tolerance:
+            raise AssertionError(f"The amplitude equations are not solved. The norm of the residual is {residual_norm}.")
+        for _ in range(num_directions):
+            direction = {}
+            for key, value in start.items():
+                rank = int(key[1:])
+                occupied, virtual = tuple((x,) for x in range(rank)), tuple((x,) for x in range(rank, 2 * rank))
+                direction[key] = antisymmetrize_axes_plus(rng.standard_normal(np.shape(value)), occupied, virtual)
+            norm = np.sqrt(sum(np.vdot(x, x) for x in direction.values()))
+            direction = {key: x / norm for key, x in direction.items()}
+            slope = (energy(direction, step) - energy(direction, -step)) / (2 * step)
+            expected = sum(np.vdot(residual[key], x) / math.factorial(int(key[1:])) ** 2 for key, x in direction.items())
+            if np.abs(slope - expected) > tolerance:
+                raise AssertionError(f"The residual is not the gradient of the energy. Along a random direction, "
+                                     f"the derivative of the energy is {slope}, but the residual gives {expected}.")
+    finally:
+        intermediates.update(start)
+        compute_intermediates(intermediates)
+
+def space_dimensions(orbitals) -> tuple:
+    """ The number of alpha and beta orbitals of each space, e.g. (("o", (5, 4)), ("v", (2, 3))). """
+    return tuple((space, tuple(x.shape[1] for x in pair)) for space, pair in orbitals.items())
+
+def align_phases(guess, old_orbitals, new_orbitals) -> dict:
+    """
+    Express amplitudes of old_orbitals in new_orbitals, the orbitals of a nearby geometry or method, which may differ
+    in the sign of any orbital. Orbitals are matched by index, and an orbital changed sign if the overlap of its old
+    and new coefficients is negative. Every index of a changed orbital flips the sign of the amplitude.
+    """
+    signs = {space: tuple(np.where(einsum("pi, pi -> i", old, new) < 0, -1.0, 1.0)
+        for old, new in zip(old_orbitals[space], new_orbitals[space])) for space in ("o", "v")}
+    aligned = {}
+    for key, value in guess.items():
+        for axis, sign in enumerate(key_irreps(key, signs)):
+            value = value * sign.reshape((-1,) + (1,) * (value.ndim - axis - 1))
+        aligned[key] = value
+    return aligned
+
+
+class GuessStore:
+    """
+    Converged amplitudes, kept to start later computations, like the next point of a scan or another method at the
+    same geometry. Entries are keyed by method, molecule and the dimensions of the orbital spaces, and only the latest
+    entry for a key is kept. The method and molecule may be any hashable labels, e.g. the solver function and the
+    charge, multiplicity, basis and atoms of the molecule.
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def write(self, method, molecule, orbitals, intermediates):
+        """ Keep the amplitudes of converged intermediates, with the orbitals they belong to. """
+        key = (method, molecule, space_dimensions(orbitals))
+        self.entries.pop(key, None)
+        self.entries[key] = (amplitudes(intermediates), {space: tuple(np.array(x) for x in orbitals[space]) for space in ("o", "v")})
+
+    def read(self, method, molecule, orbitals) -> dict:
+        """ Return the amplitudes of the method for the molecule, or else the latest of any method, in the phases
+        of orbitals. Return an empty guess if there are none. """
+        dimensions = space_dimensions(orbitals)
+        entry = self.entries.get((method, molecule, dimensions))
+        if entry is None:
+            entry = next((value for key, value in reversed(self.entries.items()) if key[1:] == (molecule, dimensions)), None)
+        if entry is None:
+            return {}
+        guess, old_orbitals = entry
+        return align_phases(guess, old_orbitals, orbitals)
+
+
+def key_kind(key: str) -> str:
+    """ The kind of an intermediate, to total their memory by: the prefix of keys like g_oovv or rdm_oo_α, t or r
+    for the amplitudes and residuals of any rank, like t2 or r1_ov_α, and diis for the DIIS subspace. """
+    if key == "dsd":
+        return "diis"
+    match = re.match(r"([tr])\d|([^_]+)_", key)
+    return key if match is None else match.group(1) or match.group(2)
+
+def memory_report(intermediates, peak=None) -> MemoryReport:
+    """ Measure the intermediates as stored, without transforming or computing any. Anything with an nbytes,
+    like an array, IrrepTensor, PackedTensor, CholeskyVectors or DirectSumDiis, counts for that, and the rest,
+    like the energy, for nothing. """
+    sizes = {key: int(getattr(value, "nbytes", 0)) for key, value in dict.items(intermediates)}
+    totals = defaultdict(int)
+    for key, size in sizes.items():
+        totals[key_kind(key)] += size
+    return MemoryReport(sizes, dict(totals), sum(sizes.values()), peak)
+
+
+class MemoryMonitor:
+    """
+    Measure the memory of a solver. If log, allocations are traced with tracemalloc from when the monitor is made,
+    and after each iteration the size of the intermediates, by kind, and the peak of traced memory during the
+    iteration are printed. numpy reports its arrays to tracemalloc, so the peak includes the temporaries of the
+    contractions. Tracing slows Python code down, so without log only the final report is made, without a peak.
+    """
+
+    def __init__(self, log=False):
+        self.log = log
+        self.peak = None # The highest peak of any iteration
+        self.tracing = log and not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start()
+
+    def start_iteration(self):
+        if self.log:
+            tracemalloc.reset_peak()
+
+    def end_iteration(self, iteration: int, intermediates):
+        if not self.log:
+            return
+        peak = tracemalloc.get_traced_memory()[1]
+        self.peak = max(self.peak or 0, peak)
+        report = memory_report(intermediates, peak)
+        totals = " ".join(f"{kind} {size / 2 ** 20:.1f}" for kind, size in sorted(report.totals.items(), key=lambda x: -x[1]) if size)
+        print(f"{iteration:3d} memory (MiB) {report.total / 2 ** 20:.1f} peak {peak / 2 ** 20:.1f}: {totals}", flush=True)
+
+    def report(self, intermediates) -> MemoryReport:
+        """ Stop tracing, if this monitor started it, and report the intermediates with the highest peak. """
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+        return memory_report(intermediates, self.peak)
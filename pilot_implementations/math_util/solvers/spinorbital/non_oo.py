@@ -1,15 +1,18 @@
 from copy import deepcopy
-import itertools
+from functools import partial
 
 import numpy as np
 
 from pilot_implementations import multilinear as mla
+from pilot_implementations.math_util.solvers.common import apply_guess, check_stationary, MemoryMonitor
 
 def vanilla(en_nuc, h_ao, r_ao, start_orbitals,
         compute_intermediates, compute_energy,
         compute_amplitude_residual, compute_step, initialize_intermediates,
         niter=200, e_thresh=1e-13, r_thresh=1e-9,
-        check_minima = False,
+        check_minima = False, minima_tolerance = 5e-9,
+        compile_plan = False, packed = False, orbital_irreps = None,
+        guess = None, diis_directory = None, container = None, memory_log = False,
         **kwargs):
     """
     Straightforward non-OO algorithm.
@@ -20,8 +23,11 @@ def vanilla(en_nuc, h_ao, r_ao, start_orbitals,
         Nuclear repulsion energy
     h_ao: np.ndarray
         AO basis one-electron integrals.
-    r_ao: np.ndarray
-        AO basis two-electron integrals
+    r_ao: np.ndarray or multilinear.CholeskyVectors
+        AO basis two-electron integrals, dense or factorized.
+    start_orbitals: dict
+        A map from letters to a tuple of the alpha, beta np.ndarray. Orbitals of "c" and "w" are frozen,
+        and only the "o" and "v" orbitals are correlated. See multilinear.freeze.
     compute_intermediates: function
     compute_energy: function
     compute_amplitude_residual: function
@@ -35,6 +41,32 @@ def vanilla(en_nuc, h_ao, r_ao, start_orbitals,
         The energy convergence threshold.
     r_thresh: float
         The residual convergence threshold.
+    check_minima: bool
+        If True, check that the converged residual is small, and that it is the derivative of the energy
+        along a few random directions. See solvers.common.check_stationary.
+    minima_tolerance: float
+        The largest residual norm, and difference of a directional derivative from the residual, that check_minima accepts.
+    compile_plan: bool
+        If True, trace compute_intermediates and compute_amplitude_residual on their first call and
+        replay the recorded contractions afterwards. Terms of the integrals alone keep their first value.
+        See multilinear.plan.
+    packed: bool
+        If True, store the two-electron integral blocks antisymmetric within a space (oooo, oovv, vvvv...)
+        with only their unique elements. See multilinear.packed.
+    orbital_irreps: dict
+        A map from letters to a tuple of the alpha, beta irreps of each orbital, as given by the integral provider.
+        If given, the two-electron integrals and the amplitudes of rank two and up are stored and contracted
+        by symmetry block, and so are the RDM and cumulant blocks contracted from them. See multilinear.symmetry.
+    guess: dict
+        Amplitudes to start from, like those of a nearby geometry. Amplitudes of the wrong shape are ignored.
+    diis_directory: str
+        If given, keep the DIIS vectors in memory-mapped files in this directory. See math_util.convergence.
+    container: type
+        The class of the intermediates, mla.LazyIntegrals unless given, e.g. the tracking scripts.prdm.common.Intermediates.
+    memory_log: bool
+        If True, print the memory of the intermediates, by kind, and the peak memory of each iteration.
+        Either way, intermediates["memory"] is a report of the memory of the converged intermediates.
+        See solvers.common.MemoryMonitor.
 
     Output
     ------
@@ -44,23 +76,32 @@ def vanilla(en_nuc, h_ao, r_ao, start_orbitals,
     orbitals: dict
         A map from letters to a tuple of the alpha, beta np.ndarray
     """
+    if packed and orbital_irreps is not None:
+        raise ValueError("Integrals can be packed or blocked by symmetry, not both.")
     orbitals = deepcopy(start_orbitals)
-    intermediates = initialize_intermediates(orbitals)
+    memory = MemoryMonitor(memory_log)
+    transformer = mla.IntegralTransformer(h_ao, r_ao, irreps=orbital_irreps)
+    transformer.update(orbitals)
+    # The frozen core adds a constant to the energy, like the nuclear repulsion.
+    en_nuc += transformer.core_energy()
+    # Integral blocks are transformed when the method first reads them.
+    container = mla.LazyIntegrals if container is None else container
+    intermediates = container(initialize_intermediates(orbitals), partial(transformer.spinorbital_block, packed=packed), transformer.factorized)
+    if compile_plan:
+        # The orbitals never rotate, so terms of the integrals alone are contracted once, on the first iteration.
+        fixed = intermediates.provided.__contains__
+        compute_intermediates = mla.plan.CompiledFunction(compute_intermediates, fixed)
+        compute_amplitude_residual = mla.plan.CompiledFunction(compute_amplitude_residual, fixed)
+    compute_intermediates, compute_energy, compute_amplitude_residual = map(intermediates.track, (compute_intermediates, compute_energy, compute_amplitude_residual))
+    apply_guess(intermediates, guess)
+    if diis_directory is not None:
+        intermediates["dsd"].directory = diis_directory
+    if orbital_irreps is not None:
+        mla.symmetry.block_amplitudes(intermediates, orbital_irreps)
     prev_energy = en_nuc
 
-    # TODO: I may not need all of these integral blocks. And in fact, I probably don't.
-    pairs = [''.join(x) for x in itertools.combinations_with_replacement("ov", 2)]
-
-    h = mla.request_asym(h_ao, orbitals,
-        pairs)
-    g = mla.request_asym(r_ao, orbitals,
-        [''.join(x) for x in itertools.combinations_with_replacement(pairs, 2)])
-    for key, value in h.items():
-        intermediates[f"h_{key}"] = value
-    for key, value in g.items():
-        intermediates[f"g_{key}"] = value
-
     for iteration in range(niter):
+        memory.start_iteration()
         compute_intermediates(intermediates)
         energy = compute_energy(intermediates) + en_nuc
         compute_amplitude_residual(intermediates)
@@ -71,8 +112,10 @@ def vanilla(en_nuc, h_ao, r_ao, start_orbitals,
         t2_norm = np.linalg.norm(intermediates["r2"])
         converged = np.fabs(deltaE) < e_thresh and t1_norm < r_thresh and t2_norm < r_thresh
         print(f"{iteration:3d} {energy:20.14f} {t1_norm:20.14f} {t2_norm:20.14f}", flush=True)
+        memory.end_iteration(iteration, intermediates)
         prev_energy = energy
         if converged: break
+    intermediates["memory"] = memory.report(intermediates)
     if not converged:
         print("CONVERGENCE FAIL")
         raise Exception
@@ -80,55 +123,8 @@ def vanilla(en_nuc, h_ao, r_ao, start_orbitals,
         intermediates["energy"] = energy
         print("CONVERGENCE SUCCESS")
 
-    # Numerical differentiate.
     if check_minima:
-        h = 0.00005
-        tensor = intermediates["t1"]
-        with np.nditer(tensor, flags=["multi_index"], op_flags=["readwrite"]) as it:
-            for x in it:
-                tensor[it.multi_index] += h
-                compute_intermediates(intermediates)
-                ep = compute_energy(intermediates) + en_nuc
-                tensor[it.multi_index] -= 2 * h
-                compute_intermediates(intermediates)
-                em = compute_energy(intermediates) + en_nuc
-                tensor[it.multi_index] += h
-                try:
-                    assert np.abs((ep - em) / (2 * h)) < 5e-9
-                except AssertionError:
-                    print(np.abs((ep - em) / (2 * h)))
-                    raise AssertionError
-
-        tensor = intermediates["t2"]
-        with np.nditer(tensor, flags=["multi_index"], op_flags=["readwrite"]) as it:
-            for x in it:
-                if np.abs(tensor[it.multi_index]) < 1e-10:
-                    continue
-                i1 = it.multi_index
-                i2 = i1[0], i1[1], i1[3], i1[2]
-                i3 = i1[1], i1[0], i1[2], i1[3]
-                i4 = i1[1], i1[0], i1[3], i1[2]
-                tensor[i1] += h
-                tensor[i4] += h
-                tensor[i2] -= h
-                tensor[i3] -= h
-                compute_intermediates(intermediates)
-                ep = compute_energy(intermediates)
-                tensor[i1] -= 2 * h
-                tensor[i4] -= 2 * h
-                tensor[i2] += 2 * h
-                tensor[i3] += 2 * h
-                compute_intermediates(intermediates)
-                em = compute_energy(intermediates)
-                tensor[i1] += h
-                tensor[i4] += h
-                tensor[i2] -= h
-                tensor[i3] -= h
-                try:
-                    assert np.abs((ep - em) / (2 * h)) < 5e-9
-                except AssertionError:
-                    print(np.abs((ep - em) / (2 * h)))
-                    raise Exception
+        check_stationary(intermediates, compute_intermediates, compute_energy, compute_amplitude_residual, minima_tolerance)
 
     return intermediates, orbitals
 
@@ -1,6 +1,8 @@
 import numpy as np
+from scipy import linalg as spla
 
 from pilot_implementations import multilinear as mla
+from pilot_implementations.multilinear.integrals import coulomb_exchange
 from pilot_implementations.multilinear.tensor import einsum
 
 def hermitian_block_orbital_gradient(i):
@@ -35,40 +37,56 @@ def hermitian_block_orbital_gradient(i):
 
     i["r1ov"] = grad
 
-def backtransform_hermitian_opdm(orbitals, intermed):
+def one_electron_backtransform(spin_summed):
+    """ Return the back-transform for one-electron quantities: to spin orbital AOs, or to spatial AOs summed over spin. """
+    if spin_summed:
+        return lambda tensor, subspaces: mla.mso_to_spatial(tensor, subspaces, ((0, 1),))
+    return mla.mso_to_aso
+
+def two_electron_backtransform(spin_summed):
+    """ Return the back-transform for two-electron quantities. Summed over spin, the result is antisymmetrized in
+    its ket, so that contracting it with <pq|rs> in spatial AOs gives what the spin orbital tensor gives with <pq||rs>. """
+    if spin_summed:
+        return lambda tensor, subspaces: (mla.mso_to_spatial(tensor, subspaces, ((0, 2), (1, 3)))
+            - mla.mso_to_spatial(tensor, subspaces, ((0, 3), (1, 2))).swapaxes(2, 3))
+    return mla.mso_to_aso
+
+def backtransform_hermitian_opdm(orbitals, intermed, spin_summed=False):
     """ Assume that the 1RDM is diagonal in the occupied block, has an occ-occ and vir-vir block, """
     ci = orbitals["o"]
     cv = orbitals["v"]
-    oei = mla.mso_to_aso(intermed["rdm_oo"], (ci, ci))
+    transform = one_electron_backtransform(spin_summed)
+    oei = transform(intermed["rdm_oo"], (ci, ci))
     if "rdm_ov" in intermed:
-        oei += 2 * mla.mso_to_aso(intermed["rdm_ov"], (ci, cv))
-    oei += mla.mso_to_aso(intermed["rdm_vv"], (cv, cv))
+        oei += 2 * transform(intermed["rdm_ov"], (ci, cv))
+    oei += transform(intermed["rdm_vv"], (cv, cv))
     return oei 
 
-def backtransform_hermitian_tpdm(orbitals, intermed):
+def backtransform_hermitian_tpdm(orbitals, intermed, spin_summed=False):
     ci = orbitals["o"]
     cv = orbitals["v"]
+    transform = two_electron_backtransform(spin_summed)
     # oovv; vvoo
-    tei = 2 * mla.mso_to_aso(intermed["rdm_oovv"], (ci, ci, cv, cv))
+    tei = 2 * transform(intermed["rdm_oovv"], (ci, ci, cv, cv))
     # ovov; voov; ovvo; vovo
-    tei += 4 * mla.mso_to_aso(intermed["rdm_ovov"], (ci, cv, ci, cv))
-    tei += mla.mso_to_aso(intermed["rdm_oooo"], (ci, ci, ci, ci))
+    tei += 4 * transform(intermed["rdm_ovov"], (ci, cv, ci, cv))
+    tei += transform(intermed["rdm_oooo"], (ci, ci, ci, ci))
     if "rdm_vvvv" in intermed: # False for OMP2
-        tei += mla.mso_to_aso(intermed["rdm_vvvv"], (cv, cv, cv, cv))
+        tei += transform(intermed["rdm_vvvv"], (cv, cv, cv, cv))
     if "rdm_ovvv" in intermed: # False for OMP2, OCEPA, and OUDCT doubles
-        tei += 4 * mla.mso_to_aso(intermed["rdm_ovvv"], (ci, cv, cv, cv))
-        tei += 4 * mla.mso_to_aso(intermed["rdm_ooov"], (ci, ci, ci, cv))
+        tei += 4 * transform(intermed["rdm_ovvv"], (ci, cv, cv, cv))
+        tei += 4 * transform(intermed["rdm_ooov"], (ci, ci, ci, cv))
     return tei
 
-def backtransform_hermitian_gfm(orbitals, intermed):
+def backtransform_hermitian_gfm(orbitals, intermed, spin_summed=False):
     # Backtransform perpendicular rotation derivative over 2
     # The division by two corrects for double-counting constraints
     # We assume no frozen orbitals, the GFM is hermitian, and no rdm_ov. Beyond that, the method tells us what to do.
+    # With frozen orbitals, use backtransform_frozen instead.
     ci = orbitals["o"]
     cv = orbitals["v"]
-    nina = ci[0].shape[1] + ci[1].shape[1]
-    nvir = cv[0].shape[1] + cv[1].shape[1]
-    gei = np.zeros((nina + nvir, nina + nvir))
+    transform = one_electron_backtransform(spin_summed)
+    gei = 0
     # OO block:
     term = einsum("i J, I i -> IJ", intermed["h_oo"], intermed["rdm_oo"])
     term += 0.5 * einsum("jk Ji, Ii jk -> IJ", intermed["g_oooo"], intermed["rdm_oooo"])
@@ -80,7 +98,7 @@ def backtransform_hermitian_gfm(orbitals, intermed):
         term += 0.5 * einsum("ij Ja, ij Ia -> IJ", intermed["g_ooov"], intermed["rdm_ooov"])
     if "rdm_ov" in intermed:
         term += einsum("J a, I a -> IJ", intermed["h_ov"], intermed["rdm_ov"])
-    gei += mla.mso_to_aso(term, (ci, ci))
+    gei += transform(term, (ci, ci))
     # OV block (Should equal VO):
     term = einsum("i A, I i -> IA", intermed["h_ov"], intermed["rdm_oo"])
     term += -0.5 * einsum("jk iA, Ii jk -> IA", intermed["g_ooov"], intermed["rdm_oooo"])
@@ -92,7 +110,7 @@ def backtransform_hermitian_gfm(orbitals, intermed):
         term += einsum("iA ja, iI ja -> IA", intermed["g_ovov"], intermed["rdm_ooov"])
     if "rdm_ov" in intermed:
         term += einsum("a A, I a -> IA", intermed["h_vv"], intermed["rdm_ov"])
-    gei += mla.mso_to_aso(term, (ci, cv))
+    gei += transform(term, (ci, cv))
     # VO block (Should equal OV):
     term = einsum("I a, A a -> AI", intermed["h_ov"], intermed["rdm_vv"])
     term += 0.5 * einsum("Ia bc, Aa bc -> AI", intermed["g_ovvv"], intermed["rdm_vvvv"])
@@ -104,7 +122,7 @@ def backtransform_hermitian_gfm(orbitals, intermed):
         term += einsum("ia Ib, ia Ab -> AI", intermed["g_ovov"], intermed["rdm_ovvv"])
     if "rdm_ov" in intermed:
         term += einsum("I i, i A -> AI", intermed["h_oo"], intermed["rdm_ov"])
-    gei += mla.mso_to_aso(term, (cv, ci))
+    gei += transform(term, (cv, ci))
     # VV block:
     term = einsum("a B, A a -> AB", intermed["h_vv"], intermed["rdm_vv"])
     term += 0.5 * einsum("bc Ba, Aa bc -> AB", intermed["g_vvvv"], intermed["rdm_vvvv"])
@@ -116,7 +134,177 @@ def backtransform_hermitian_gfm(orbitals, intermed):
         term += einsum("ia Bb, ia Ab -> AB", intermed["g_ovvv"], intermed["rdm_ovvv"])
     if "rdm_ov" in intermed:
         term += einsum("i B, i A -> AB", intermed["h_ov"], intermed["rdm_ov"])
-    gei += mla.mso_to_aso(term, (cv, cv))
+    gei += transform(term, (cv, cv))
+
+    return gei
+
+def tpdm_blocks(intermed):
+    """ Return every block of the 2RDM by its spaces, e.g. vovo, from the stored blocks, e.g. ovov,
+    by antisymmetry within the bra and the ket and by hermiticity. """
+    symmetries = (((0, 1, 2, 3), 1), ((1, 0, 2, 3), -1), ((0, 1, 3, 2), -1), ((1, 0, 3, 2), 1),
+                  ((2, 3, 0, 1), 1), ((3, 2, 0, 1), -1), ((2, 3, 1, 0), -1), ((3, 2, 1, 0), 1))
+    blocks = dict()
+    for spaces in ("oooo", "oovv", "ovov", "vvvv", "ooov", "ovvv"):
+        if "rdm_" + spaces not in intermed:
+            continue
+        tensor = np.asarray(intermed["rdm_" + spaces])
+        for axes, sign in symmetries:
+            key = "".join(spaces[axis] for axis in axes)
+            if key not in blocks:
+                blocks[key] = sign * tensor.transpose(axes)
+    return blocks
+
+def spin_potential(r_ao, densities):
+    """ Return the AO potential on an electron of each spin, J - K, of the AO densities of each spin. """
+    (coulomb_a, exchange_a), (coulomb_b, exchange_b) = (coulomb_exchange(r_ao, density) for density in densities)
+    return coulomb_a + coulomb_b - exchange_a, coulomb_a + coulomb_b - exchange_b
+
+def wedge_backtransform(pairs):
+    """ Return the spin summed AO 2RDM of a sum of antisymmetrized products of 1RDMs, a ^ b, in the form of
+    two_electron_backtransform. Each of a and b is given as the AO matrices of each spin. """
+    tei = 0
+    for a, b in pairs:
+        tei = tei + 2 * einsum("pr, qs -> pqrs", sum(a), sum(b))
+        for a_spin, b_spin in zip(a, b):
+            tei = tei - 2 * einsum("ps, qr -> pqrs", a_spin, b_spin)
+    return tei
+
+def contract_tpdm(tpdm, r_ao):
+    """ Return sum_rst tpdm_prst <qr|st>, where the last three indices of tpdm are AOs. r_ao may be CholeskyVectors. """
+    if isinstance(r_ao, mla.CholeskyVectors):
+        temp = np.tensordot(tpdm, r_ao.vectors, ((1, 3), (1, 2))) # psQ
+        return np.tensordot(temp, r_ao.vectors, ((2, 1), (0, 2)))
+    return np.tensordot(tpdm, r_ao, ((1, 2, 3), (1, 2, 3)))
+
+def sylvester(a, b, q):
+    """ Solve a x - x b = q for x. """
+    if not q.size:
+        return q
+    return spla.solve_sylvester(a, -b, q)
+
+def conjugate_gradient(apply, rhs, preconditioner, tolerance=1e-10, niter=100):
+    """ Solve apply(x) = rhs for a symmetric positive definite apply by preconditioned conjugate gradient.
+    rhs and preconditioner are vectors, and preconditioner approximates the diagonal of apply. """
+    x = rhs / preconditioner
+    residual = rhs - apply(x)
+    step = residual / preconditioner
+    overlap = np.vdot(residual, step)
+    for _ in range(niter):
+        if np.linalg.norm(residual) < tolerance:
+            return x
+        product = apply(step)
+        scale = overlap / np.vdot(step, product)
+        x = x + scale * step
+        residual = residual - scale * product
+        new_step = residual / preconditioner
+        new_overlap = np.vdot(residual, new_step)
+        step = new_step + new_overlap / overlap * step
+        overlap = new_overlap
+    raise Exception(f"The Z-vector equations didn't converge in {niter} iterations.")
+
+def backtransform_frozen(h_ao, r_ao, reference, orbitals, intermed):
+    """
+    Return the spin summed AO 1RDM, 2RDM and GFM of perturbation_gradient when some orbitals are frozen.
+    The frozen core adds its own densities and generalized Fock rows, and the frozen orbitals add GFM columns.
+    The frozen orbitals never rotate, so the energy isn't stationary in them. They are those of the reference,
+    which solve the UHF equations with the core and frozen virtuals blocks of their own, so the orbital response
+    is that of the UHF equations. Their multipliers, from a Z-vector solve, enter the densities like the rest.
+    reference are the orbitals the solver started from, and orbitals are the optimized ones.
+    r_ao may be CholeskyVectors. Raise a ValueError if the reference doesn't solve the UHF equations, e.g. ROHF.
+    """
+    spaces = "covw"
+    oei = backtransform_hermitian_opdm(orbitals, intermed, spin_summed=True)
+    tei = backtransform_hermitian_tpdm(orbitals, intermed, spin_summed=True)
+    blocks = tpdm_blocks(intermed)
+    dims = [{space: orbitals[space][spin].shape[1] for space in spaces} for spin in range(2)]
+    core = [orbitals["c"][spin] @ orbitals["c"][spin].T for spin in range(2)]
+    active_density = []
+    for spin in range(2):
+        only = {space: tuple(x if i == spin else np.zeros(x.shape) for i, x in enumerate(orbitals[space])) for space in "ov"}
+        density = backtransform_hermitian_opdm(only, intermed, spin_summed=True)
+        active_density.append(0.5 * (density + density.T))
+    core_fock = [h_ao + x for x in spin_potential(r_ao, core)]
+    fock = [h_ao + x for x in spin_potential(r_ao, [a + b for a, b in zip(core, active_density)])]
+    reference_coefficients = [np.hstack([reference[space][spin] for space in spaces]) for spin in range(2)]
+    occupied = [x[:, :dims[spin]["c"] + dims[spin]["o"]] for spin, x in enumerate(reference_coefficients)]
+    reference_density = [x @ x.T for x in occupied]
+    reference_fock = [h_ao + x for x in spin_potential(r_ao, reference_density)]
+
+    gei = 0
+    gradients, reference_mo_fock = [], []
+    for spin in range(2):
+        coefficients = np.hstack([orbitals[space][spin] for space in spaces])
+        nc, no, nv = dims[spin]["c"], dims[spin]["o"], dims[spin]["v"]
+        active = coefficients[:, nc:nc + no + nv]
+        # Rows of the GFM, F_pq = rows_p . C_q. Those of the core are those of the Fock matrix of the correlated 1RDM.
+        # Those of the active orbitals are built from the 1RDM and the 2RDM with all but its first index in AOs,
+        # so they have columns for the frozen orbitals too. Those of the frozen virtuals are zero.
+        select = {"o": np.eye(no + nv)[:, :no], "v": np.eye(no + nv)[:, no:]}
+        selected = {space: tuple(select[space] if i == spin else np.zeros((no + nv, x.shape[1]))
+                                 for i, x in enumerate(orbitals[space])) for space in "ov"}
+        opdm = backtransform_hermitian_opdm(selected, intermed, spin_summed=True)
+        opdm = 0.5 * (opdm + opdm.T)
+        half = 0
+        for key, block in blocks.items():
+            subspaces = [selected[key[0]]] + [orbitals[space] for space in key[1:]]
+            half = half + mla.mso_to_spatial(block, subspaces, ((0, 2), (1, 3)))
+        rows = np.zeros((coefficients.shape[1], h_ao.shape[0]))
+        rows[:nc] = orbitals["c"][spin].T @ fock[spin]
+        rows[nc:nc + no + nv] = opdm @ active.T @ core_fock[spin] + contract_tpdm(half, r_ao)
+        gei = gei + coefficients @ rows @ coefficients @ coefficients.T
+        # The derivative of the energy by the rotation exp(κ) of the reference orbitals is 2 (F_qp - F_pq) at κ_pq.
+        rotation = np.linalg.lstsq(reference_coefficients[spin], coefficients, rcond=None)[0]
+        gfm = rotation @ rows @ coefficients @ rotation.T
+        gradients.append(gfm.T - gfm)
+        reference_mo_fock.append(reference_coefficients[spin].T @ reference_fock[spin] @ reference_coefficients[spin])
+
+    # Multipliers of the equations that keep the core apart from the active occupied orbitals, and the frozen
+    # virtuals from the active virtuals. Only the reference orbitals of one block enter them, so they're solved first.
+    fixed = []
+    for spin, (w, f) in enumerate(zip(gradients, reference_mo_fock)):
+        nc, no, nv = dims[spin]["c"], dims[spin]["o"], dims[spin]["v"]
+        c, o, v, x = slice(None, nc), slice(nc, nc + no), slice(nc + no, nc + no + nv), slice(nc + no + nv, None)
+        n = nc + no
+        if max(np.abs(f[c, o]).max(initial=0), np.abs(f[v, x]).max(initial=0), np.abs(f[:n, n:]).max(initial=0)) > 1e-5:
+            raise ValueError("The reference orbitals must solve the UHF equations, with the frozen orbitals a block of their own.")
+        z_co = sylvester(f[c, c], f[o, o], -2 * w[c, o])
+        z_vw = sylvester(f[v, v], f[x, x], -2 * w[v, x])
+        C = reference_coefficients[spin]
+        temp = C[:, c] @ z_co @ C[:, o].T + C[:, v] @ z_vw @ C[:, x].T
+        fixed.append(0.5 * (temp + temp.T))
+    fixed_potential = spin_potential(r_ao, fixed)
 
-    return gei 
+    # Multipliers of the UHF equations between occupied and virtual orbitals
+    shapes = [(x.shape[1], c.shape[1] - x.shape[1]) for x, c in zip(occupied, reference_coefficients)]
+    sizes = [a * b for a, b in shapes]
+    def unpack(vector):
+        return [part.reshape(shape) for part, shape in zip(np.split(vector, [sizes[0]]), shapes)]
+    def densities(z):
+        return [occ @ block @ C[:, occ.shape[1]:].T for occ, block, C in zip(occupied, z, reference_coefficients)]
+    def apply(vector):
+        z = unpack(vector)
+        potential = spin_potential(r_ao, [x + x.T for x in densities(z)])
+        result = []
+        for spin, (block, f, C) in enumerate(zip(z, reference_mo_fock, reference_coefficients)):
+            n = occupied[spin].shape[1]
+            result.append(block @ f[n:, n:] - f[:n, :n] @ block + occupied[spin].T @ potential[spin] @ C[:, n:])
+        return np.concatenate([x.ravel() for x in result])
+    rhs, preconditioner = [], []
+    for spin, (w, f, C) in enumerate(zip(gradients, reference_mo_fock, reference_coefficients)):
+        n = occupied[spin].shape[1]
+        rhs.append(2 * w[:n, n:] - 2 * occupied[spin].T @ fixed_potential[spin] @ C[:, n:])
+        preconditioner.append(np.add.outer(-np.diag(f)[:n], np.diag(f)[n:]))
+    z = unpack(conjugate_gradient(apply, np.concatenate([x.ravel() for x in rhs]),
+                                  np.concatenate([x.ravel() for x in preconditioner])))
+    multipliers = [a + 0.5 * (b + b.T) for a, b in zip(fixed, densities(z))]
 
+    # The Lagrangian adds sum_pq z_pq F_pq of the reference to the energy.
+    oei = oei + sum(core) + sum(multipliers)
+    tei = tei + wedge_backtransform([(core, core), (core, active_density), (active_density, core),
+                                     (multipliers, reference_density), (reference_density, multipliers)])
+    multiplier_potential = spin_potential(r_ao, multipliers)
+    for spin in range(2):
+        inverse_overlap = reference_coefficients[spin] @ reference_coefficients[spin].T
+        gei = gei + (multipliers[spin] @ reference_fock[spin]
+                     + reference_density[spin] @ multiplier_potential[spin]) @ inverse_overlap
+    return oei, tei, gei
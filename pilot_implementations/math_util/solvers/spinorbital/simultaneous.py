@@ -1,16 +1,19 @@
 from copy import deepcopy
-import itertools
+from functools import partial
 
 import numpy as np
 from scipy import linalg as spla
 
 from pilot_implementations import multilinear as mla
+from pilot_implementations.math_util.solvers.common import apply_guess, MemoryMonitor
 from pilot_implementations.multilinear.tensor import einsum
 
 def simultaneous(en_nuc, h_ao, r_ao, start_orbitals,
         compute_intermediates, compute_energy, compute_orbital_residual,
         compute_amplitude_residual, compute_step, initialize_intermediates,
-        niter=200, e_thresh=1e-13, r_thresh=1e-9, **kwargs):
+        niter=200, e_thresh=1e-13, r_thresh=1e-9,
+        compile_plan=False, packed=False, integral_threads=1, orbital_irreps=None,
+        guess=None, diis_directory=None, container=None, memory_log=False, **kwargs):
     """
     Orbital-optimization algorithm with simultaneous optimization of orbitals and
     amplitudes.
@@ -21,8 +24,11 @@ def simultaneous(en_nuc, h_ao, r_ao, start_orbitals,
         Nuclear repulsion energy
     h_ao: np.ndarray
         AO basis one-electron integrals.
-    r_ao: np.ndarray
-        AO basis two-electron integrals
+    r_ao: np.ndarray or multilinear.CholeskyVectors
+        AO basis two-electron integrals, dense or factorized.
+    start_orbitals: dict
+        A map from letters to a tuple of the alpha, beta np.ndarray. Orbitals of "c" and "w" are frozen,
+        and only the "o" and "v" orbitals are correlated. See multilinear.freeze.
     compute_intermediates: function
     compute_energy: function
     compute_orbital_residual: function
@@ -37,6 +43,28 @@ def simultaneous(en_nuc, h_ao, r_ao, start_orbitals,
         The energy convergence threshold.
     r_thresh: float
         The residual convergence threshold.
+    compile_plan: bool
+        If True, trace compute_intermediates and compute_amplitude_residual on their first call and replay
+        the recorded contractions afterwards. See multilinear.plan.
+    packed: bool
+        If True, store the two-electron integral blocks antisymmetric within a space (oooo, oovv, vvvv...)
+        with only their unique elements. See multilinear.packed.
+    integral_threads: int
+        The number of threads used to transform integrals.
+    orbital_irreps: dict
+        A map from letters to a tuple of the alpha, beta irreps of each orbital, as given by the integral provider.
+        If given, the two-electron integrals and the amplitudes of rank two and up are stored and contracted
+        by symmetry block, and so are the RDM and cumulant blocks contracted from them. See multilinear.symmetry.
+    guess: dict
+        Amplitudes to start from, like those of a nearby geometry. Amplitudes of the wrong shape are ignored.
+    diis_directory: str
+        If given, keep the DIIS vectors in memory-mapped files in this directory. See math_util.convergence.
+    container: type
+        The class of the intermediates, mla.LazyIntegrals unless given, e.g. the tracking scripts.prdm.common.Intermediates.
+    memory_log: bool
+        If True, print the memory of the intermediates, by kind, and the peak memory of each iteration.
+        Either way, intermediates["memory"] is a report of the memory of the converged intermediates.
+        See solvers.common.MemoryMonitor.
 
     Output
     ------
@@ -46,24 +74,36 @@ def simultaneous(en_nuc, h_ao, r_ao, start_orbitals,
     orbitals: dict
         A map from letters to a tuple of the alpha, beta np.ndarray
     """
+    if compile_plan:
+        compute_intermediates = mla.plan.CompiledFunction(compute_intermediates)
+        compute_amplitude_residual = mla.plan.CompiledFunction(compute_amplitude_residual)
+    if packed and orbital_irreps is not None:
+        raise ValueError("Integrals can be packed or blocked by symmetry, not both.")
     orbitals = deepcopy(start_orbitals)
-    intermediates = initialize_intermediates(orbitals)
+    memory = MemoryMonitor(memory_log)
+    transformer = mla.IntegralTransformer(h_ao, r_ao, irreps=orbital_irreps)
+    transformer.update(orbitals)
+    # The frozen core never rotates, so it adds a constant to the energy, like the nuclear repulsion.
+    en_nuc += transformer.core_energy()
+    # Integral blocks are transformed when the method first reads them.
+    container = mla.LazyIntegrals if container is None else container
+    intermediates = container(initialize_intermediates(orbitals), partial(transformer.spinorbital_block, packed=packed), transformer.factorized)
+    compute_intermediates, compute_energy, compute_orbital_residual, compute_amplitude_residual = map(intermediates.track,
+        (compute_intermediates, compute_energy, compute_orbital_residual, compute_amplitude_residual))
+    apply_guess(intermediates, guess)
+    if diis_directory is not None:
+        intermediates["dsd"].directory = diis_directory
+    if orbital_irreps is not None:
+        mla.symmetry.block_amplitudes(intermediates, orbital_irreps)
     prev_energy = en_nuc
 
     for iteration in range(niter):
+        memory.start_iteration()
         orbitals = mla.spinorb.orb_rot(intermediates, start_orbitals)
-
-        # TODO: I may not need all of these integral blocks. And in fact, I probably don't.
-        pairs = [''.join(x) for x in itertools.combinations_with_replacement("ov", 2)]
-
-        h = mla.request_asym(h_ao, orbitals,
-            pairs)
-        g = mla.request_asym(r_ao, orbitals,
-            [''.join(x) for x in itertools.combinations_with_replacement(pairs, 2)])
-        for key, value in h.items():
-            intermediates[f"h_{key}"] = value
-        for key, value in g.items():
-            intermediates[f"g_{key}"] = value
+        if transformer.update(orbitals):
+            # Retransform the blocks read last iteration together, so they share their half-transforms.
+            intermediates.refresh()
+            intermediates.update(transformer.transform(intermediates.provided, intermediates.provider, integral_threads))
 
         compute_intermediates(intermediates)
         energy = compute_energy(intermediates) + en_nuc
@@ -76,8 +116,10 @@ def simultaneous(en_nuc, h_ao, r_ao, start_orbitals,
         t2_norm = np.linalg.norm(intermediates["r2"])
         converged = np.fabs(deltaE) < e_thresh and t1_norm < r_thresh and t2_norm < r_thresh
         print(f"{iteration:3d} {energy:20.14f} {t1_norm:20.14f} {t2_norm:20.14f}", flush=True)
+        memory.end_iteration(iteration, intermediates)
         prev_energy = energy
         if converged: break
+    intermediates["memory"] = memory.report(intermediates)
     if not converged:
         print("CONVERGENCE FAIL")
         raise Exception
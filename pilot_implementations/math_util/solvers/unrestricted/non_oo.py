@@ -3,20 +3,105 @@ from copy import deepcopy
 import numpy as np
 
 from pilot_implementations import multilinear as mla
-from . import proc
+from pilot_implementations.math_util.solvers.common import apply_guess, MemoryMonitor
 
 def vanilla(en_nuc, h_ao, r_ao, start_orbitals,
         compute_intermediates, compute_energy,
         compute_amplitude_residual, compute_step, initialize_intermediates,
         niter=200, e_thresh=1e-13, r_thresh=1e-9,
+        compile_plan=False, restricted=False, orbital_irreps=None,
+        guess=None, diis_directory=None, container=None, memory_log=False,
         **kwargs):
+    """
+    Straightforward non-OO algorithm, with the spin blocks stored separately.
+
+    Input
+    -----
+    en_nuc: float
+        Nuclear repulsion energy
+    h_ao: np.ndarray
+        AO basis one-electron integrals.
+    r_ao: np.ndarray or multilinear.CholeskyVectors
+        AO basis two-electron integrals, dense or factorized.
+    start_orbitals: dict
+        A map from letters to a tuple of the alpha, beta np.ndarray. Orbitals of "c" and "w" are frozen,
+        and only the "o" and "v" orbitals are correlated. See multilinear.freeze.
+    compute_intermediates: function
+    compute_energy: function
+    compute_amplitude_residual: function
+    compute_step: function
+    initialize_intermediates: function
+        Method-specific functions. All take in a dict of intermediates. compute_energy returns an energy.
+        All others modify the intermediate dict.
+    niter: int
+        The number of iterations before termination.
+    e_thresh: float
+        The energy convergence threshold.
+    r_thresh: float
+        The residual convergence threshold.
+    compile_plan: bool
+        If True, trace compute_intermediates and compute_amplitude_residual on their first call and
+        replay the recorded contractions afterwards. Terms of the integrals alone keep their first value.
+        See multilinear.plan.
+    restricted: bool
+        If True, the alpha and beta orbitals must be the same, and only one block of each pair related by
+        flipping all spins is stored and computed. See multilinear.ClosedShellIntermediates and
+        scripts.prdm.common.ClosedShellDispatch.
+    orbital_irreps: dict
+        A map from letters to a tuple of the alpha, beta irreps of each orbital, as given by the integral provider.
+        If given, the two-electron integrals and the amplitudes of rank two and up are stored and contracted
+        by symmetry block, and so are the RDM and cumulant blocks contracted from them. See multilinear.symmetry.
+    guess: dict
+        Amplitudes to start from, like those of a nearby geometry. Amplitudes of the wrong shape are ignored.
+    diis_directory: str
+        If given, keep the DIIS vectors in memory-mapped files in this directory. See math_util.convergence.
+    container: type
+        The class of the intermediates, mla.ClosedShellIntermediates if restricted and mla.LazyIntegrals otherwise
+        unless given, e.g. the tracking scripts.prdm.common.Intermediates.
+    memory_log: bool
+        If True, print the memory of the intermediates, by kind, and the peak memory of each iteration.
+        Either way, intermediates["memory"] is a report of the memory of the converged intermediates.
+        See solvers.common.MemoryMonitor.
+
+    Output
+    ------
+    intermediates: dict
+        A dict of the various intermediates needed by the computation.
+        Some of these can be big, so be careful!
+    orbitals: dict
+        A map from letters to a tuple of the alpha, beta np.ndarray
+    """
     orbitals = deepcopy(start_orbitals)
-    intermediates = initialize_intermediates(orbitals)
+    if restricted and not all(np.allclose(alpha, beta) for alpha, beta in orbitals.values()):
+        raise ValueError("A restricted computation needs the same alpha and beta orbitals.")
+    memory = MemoryMonitor(memory_log)
+    transformer = mla.IntegralTransformer(h_ao, r_ao, irreps=orbital_irreps)
+    transformer.update(orbitals)
+    # The frozen core adds a constant to the energy, like the nuclear repulsion.
+    en_nuc += transformer.core_energy()
+    # Integral blocks are transformed when the method first reads them.
+    # A closed-shell reference stores, and transforms the integrals of, only one block of each pair related by
+    # flipping all spins. The glue of scripts.prdm then computes only those, with restricted_param.
+    if container is None:
+        container = mla.ClosedShellIntermediates if restricted else mla.LazyIntegrals
+    elif restricted and not issubclass(container, mla.ClosedShellIntermediates):
+        raise ValueError("A restricted computation needs a closed-shell container of intermediates.")
+    intermediates = container(initialize_intermediates(orbitals), transformer.unrestricted_block, transformer.factorized)
+    if compile_plan:
+        # The orbitals never rotate, so terms of the integrals alone are contracted once, on the first iteration.
+        fixed = intermediates.provided.__contains__
+        compute_intermediates = mla.plan.CompiledFunction(compute_intermediates, fixed)
+        compute_amplitude_residual = mla.plan.CompiledFunction(compute_amplitude_residual, fixed)
+    compute_intermediates, compute_energy, compute_amplitude_residual = map(intermediates.track, (compute_intermediates, compute_energy, compute_amplitude_residual))
+    apply_guess(intermediates, guess)
+    if diis_directory is not None:
+        intermediates["dsd"].directory = diis_directory
+    if orbital_irreps is not None:
+        mla.symmetry.block_amplitudes(intermediates, orbital_irreps)
     prev_energy = en_nuc
 
-    proc.compute_integrals(intermediates, h_ao, r_ao, orbitals)
-
     for iteration in range(niter):
+        memory.start_iteration()
         compute_intermediates(intermediates)
         energy = compute_energy(intermediates) + en_nuc
         compute_amplitude_residual(intermediates)
@@ -27,8 +112,10 @@ def vanilla(en_nuc, h_ao, r_ao, start_orbitals,
         t2_norm = np.linalg.norm([np.linalg.norm(intermediates["r2_αα"]), np.linalg.norm(intermediates["r2_αβ"]), np.linalg.norm(intermediates["r2_ββ"])])
         converged = np.fabs(deltaE) < e_thresh and t1_norm < r_thresh and t2_norm < r_thresh
         print(f"{iteration:3d} {energy:20.14f} {t1_norm:20.14f} {t2_norm:20.14f}", flush=True)
+        memory.end_iteration(iteration, intermediates)
         prev_energy = energy
         if converged: break
+    intermediates["memory"] = memory.report(intermediates)
     if not converged:
         print("CONVERGENCE FAIL")
         raise Exception
@@ -1,5 +1,4 @@
-import numpy as np
-
+from pilot_implementations import multilinear as mla
 from pilot_implementations.multilinear.tensor import einsum
 
 def hermitian_block_orbital_gradient(i):
@@ -82,82 +81,23 @@ def hermitian_block_orbital_gradient(i):
     i["r1_ov_α"] = grad_α
     i["r1_ov_β"] = grad_β
 
-def compute_integrals(intermediates, h_ao, r_ao, orbitals): 
-        Coa, Cob = orbitals["o"]
-        Cva, Cvb = orbitals["v"]
-
-        intermediates["h_oo_α"] = einsum("pq, pP, qQ -> PQ", h_ao, Coa, Coa)
-        intermediates["h_oo_β"] = einsum("pq, pP, qQ -> PQ", h_ao, Cob, Cob)
-        intermediates["h_ov_α"] = einsum("pq, pP, qQ -> PQ", h_ao, Coa, Cva)
-        intermediates["h_ov_β"] = einsum("pq, pP, qQ -> PQ", h_ao, Cob, Cvb)
-        intermediates["h_vv_α"] = einsum("pq, pP, qQ -> PQ", h_ao, Cva, Cva)
-        intermediates["h_vv_β"] = einsum("pq, pP, qQ -> PQ", h_ao, Cvb, Cvb)
-
-
-        temp = einsum("pqrs, pP, qQ, rR, sS -> PQ RS", r_ao, Coa, Coa, Coa, Coa)
-        temp -= np.swapaxes(temp, 2, 3)
-        intermediates["g_oooo_αα"] = temp
-        intermediates["g_oooo_αβ"] = einsum("pqrs, pP, qQ, rR, sS -> PQ RS", r_ao, Coa, Cob, Coa, Cob)
-        temp = einsum("pqrs, pP, qQ, rR, sS -> PQ RS", r_ao, Cob, Cob, Cob, Cob)
-        temp -= np.swapaxes(temp, 2, 3)
-        intermediates["g_oooo_ββ"] = temp
-
-        temp = einsum("pqrs, pP, qQ, rR, sS -> PQ RS", r_ao, Coa, Coa, Cva, Cva)
-        temp -= np.swapaxes(temp, 2, 3)
-        intermediates["g_oovv_αα"] = temp
-        intermediates["g_oovv_αβ"] = einsum("pqrs, pP, qQ, rR, sS -> PQ RS", r_ao, Coa, Cob, Cva, Cvb)
-        temp = einsum("pqrs, pP, qQ, rR, sS -> PQ RS", r_ao, Cob, Cob, Cvb, Cvb)
-        temp -= np.swapaxes(temp, 2, 3)
-        intermediates["g_oovv_ββ"] = temp
-
-        intermediates["g_vvoo_αα"] = einsum("PQRS -> RSPQ", intermediates["g_oovv_αα"])
-        intermediates["g_vvoo_αβ"] = einsum("PQRS -> RSPQ", intermediates["g_oovv_αβ"])
-        intermediates["g_vvoo_ββ"] = einsum("PQRS -> RSPQ", intermediates["g_oovv_ββ"])
-        
-        temp = einsum("pqrs, pP, qQ, rR, sS -> PQ RS", r_ao, Cva, Cva, Cva, Cva)
-        temp -= np.swapaxes(temp, 2, 3)
-        intermediates["g_vvvv_αα"] = temp
-        intermediates["g_vvvv_αβ"] = einsum("pqrs, pP, qQ, rR, sS -> PQ RS", r_ao, Cva, Cvb, Cva, Cvb)
-        temp = einsum("pqrs, pP, qQ, rR, sS -> PQ RS", r_ao, Cvb, Cvb, Cvb, Cvb)
-        temp -= np.swapaxes(temp, 2, 3)
-        intermediates["g_vvvv_ββ"] = temp
-
-        temp = einsum("pqrs, pP, qQ, rR, sS -> PQ RS", r_ao, Coa, Cva, Coa, Cva)
-        temp -= einsum("pqrs, pP, qQ, rS, sR -> PQ RS", r_ao, Coa, Cva, Cva, Coa)
-        intermediates["g_ovov_αα"] = temp
-        intermediates["g_ovov_αβ"] = einsum("pqrs, pP, qQ, rR, sS -> PQ RS", r_ao, Coa, Cvb, Coa, Cvb)
-        intermediates["g_vovo_αβ"] = einsum("pqrs, pP, qQ, rR, sS -> PQ RS", r_ao, Cva, Cob, Cva, Cob)
-        temp = einsum("pqrs, pP, qQ, rR, sS -> PQ RS", r_ao, Cob, Cvb, Cob, Cvb)
-        temp -= einsum("pqrs, pP, qQ, rS, sR -> PQ RS", r_ao, Cob, Cvb, Cvb, Cob)
-        intermediates["g_ovov_ββ"] = temp
-        intermediates["g_ovvo_αβ"] = einsum("pqrs, pP, qQ, rR, sS -> PQ RS", r_ao, Coa, Cvb, Cva, Cob)
-
-        intermediates["g_voov_αβ"] = einsum("PQRS -> RSPQ", intermediates["g_ovvo_αβ"])
-
-        temp = einsum("pqrs, pP, qQ, rR, sS -> PQ RS", r_ao, Coa, Coa, Coa, Cva)
-        temp -= np.swapaxes(temp, 0, 1)
-        intermediates["g_ooov_αα"] = temp
-        intermediates["g_ovoo_αα"] = einsum("PQRS -> RSPQ", intermediates["g_ooov_αα"])
-        temp = einsum("pqrs, pP, qQ, rR, sS -> PQ RS", r_ao, Cob, Cob, Cob, Cvb)
-        temp -= np.swapaxes(temp, 0, 1)
-        intermediates["g_ooov_ββ"] = temp
-        intermediates["g_ovoo_ββ"] = einsum("PQRS -> RSPQ", intermediates["g_ooov_ββ"])
-        intermediates["g_oovo_αβ"] = einsum("pqrs, pP, qQ, rR, sS -> PQ RS", r_ao, Coa, Cob, Cva, Cob)
-        intermediates["g_vooo_αβ"] = einsum("PQRS -> RSPQ", intermediates["g_oovo_αβ"])
-        intermediates["g_ooov_αβ"] = einsum("pqrs, pP, qQ, rR, sS -> PQ RS", r_ao, Coa, Cob, Coa, Cvb)
-        intermediates["g_ovoo_αβ"] = einsum("PQRS -> RSPQ", intermediates["g_ooov_αβ"])
-
-        temp = einsum("pqrs, pP, qQ, rR, sS -> PQ RS", r_ao, Coa, Cva, Cva, Cva)
-        temp -= np.swapaxes(temp, 2, 3)
-        intermediates["g_ovvv_αα"] = temp
-        intermediates["g_vvov_αα"] = einsum("PQRS -> RSPQ", intermediates["g_ovvv_αα"])
-        temp = einsum("pqrs, pP, qQ, rR, sS -> PQ RS", r_ao, Cob, Cvb, Cvb, Cvb)
-        temp -= np.swapaxes(temp, 2, 3)
-        intermediates["g_ovvv_ββ"] = temp
-        intermediates["g_vvov_ββ"] = einsum("PQRS -> RSPQ", intermediates["g_ovvv_ββ"])
-        intermediates["g_vovv_αβ"] = einsum("pqrs, pP, qQ, rR, sS -> PQ RS", r_ao, Cva, Cob, Cva, Cvb)
-        intermediates["g_vvvo_αβ"] = einsum("PQRS -> RSPQ", intermediates["g_vovv_αβ"])
-        intermediates["g_ovvv_αβ"] = einsum("pqrs, pP, qQ, rR, sS -> PQ RS", r_ao, Coa, Cvb, Cva, Cvb)
-        intermediates["g_vvov_αβ"] = einsum("PQRS -> RSPQ", intermediates["g_ovvv_αβ"])
-
-
+INTEGRAL_KEYS = [
+    "h_oo_α", "h_oo_β", "h_ov_α", "h_ov_β", "h_vv_α", "h_vv_β",
+    "g_oooo_αα", "g_oooo_αβ", "g_oooo_ββ",
+    "g_oovv_αα", "g_oovv_αβ", "g_oovv_ββ", "g_vvoo_αα", "g_vvoo_αβ", "g_vvoo_ββ",
+    "g_vvvv_αα", "g_vvvv_αβ", "g_vvvv_ββ",
+    "g_ovov_αα", "g_ovov_αβ", "g_vovo_αβ", "g_ovov_ββ", "g_ovvo_αβ", "g_voov_αβ",
+    "g_ooov_αα", "g_ovoo_αα", "g_ooov_ββ", "g_ovoo_ββ", "g_oovo_αβ", "g_vooo_αβ", "g_ooov_αβ", "g_ovoo_αβ",
+    "g_ovvv_αα", "g_vvov_αα", "g_ovvv_ββ", "g_vvov_ββ", "g_vovv_αβ", "g_vvvo_αβ", "g_ovvv_αβ", "g_vvov_αβ"
+    ]
+
+def compute_integrals(intermediates, h_ao, r_ao, orbitals, keys=INTEGRAL_KEYS, num_threads=1, restricted=False, orbital_irreps=None):
+    """ Transform the integral blocks named by keys into intermediates. Half-transformed integrals are
+    shared between blocks. See multilinear.IntegralTransformer.transform.
+    If restricted, skip the blocks a closed-shell reference reads from their spin flips. See multilinear.ClosedShellIntermediates.
+    If orbital_irreps is given, two-electron blocks are stored by symmetry block. See multilinear.symmetry. """
+    if restricted:
+        keys = [key for key in keys if mla.integrals.closed_shell_key(key)[0] == key]
+    transformer = mla.IntegralTransformer(h_ao, r_ao, irreps=orbital_irreps)
+    transformer.update(orbitals)
+    intermediates.update(transformer.transform(keys, transformer.unrestricted_block, num_threads))
@@ -1,5 +1,9 @@
-from . import asym
-from .spinorb import to_spinorb, antisym_subspace, spatial_subspace, mso_to_aso, request_asym
-from .tensor import broadcaster, full_broadcaster, one_index_transform, read_tensor, read_tensor_general
+from . import asym, cholesky, integrals, packed, plan, symmetry
+from .spinorb import freeze, to_spinorb, antisym_subspace, spatial_subspace, mso_to_aso, mso_to_spatial, request_asym
+from .tensor import accumulate, einsum, einsum_add, clear_path_cache, path_cache_info, broadcaster, full_broadcaster, one_index_transform, read_tensor, read_tensor_general
 from .asym import antisymmetrize_axes, antisymmetrize_axes_plus
+from .cholesky import CholeskyVectors
+from .integrals import ClosedShellIntermediates, IntegralTransformer, LazyIntegrals
+from .packed import PackedTensor
+from .symmetry import IrrepTensor
 
@@ -1,39 +1,74 @@
+from functools import lru_cache
+
 from sympy.utilities.iterables import multiset_permutations
 import numpy as np
 
+from .symmetry import IrrepTensor
+
 def antisymmetrize_axes(tensor: np.ndarray, *axis_pairs: tuple[int, int]) -> np.ndarray:
     """ Apply P-(p/q) to the tensor. """
     for axis_pair in axis_pairs:
         tensor -= tensor.swapaxes(*axis_pair)
     return tensor
 
-def antisymmetrize_axes_plus(tensor: np.ndarray, *axis_data: tuple[tuple[int]]) -> np.ndarray:
+def antisymmetrize_axes_plus(tensor: np.ndarray, *axis_data: tuple[tuple[int]], out: np.ndarray = None) -> np.ndarray:
     """ Each inner tuple are a group of indices that should be antisymmetric among themselves.
     Each outer tuple is a group of indices that is already antisymmetric among themselves.
-    This function handles the remaining antisymmetrizations. """
-    returned_tensor = tensor.copy()
-    for row in axis_data:
-        old_tensor = returned_tensor.copy()
-        returned_tensor = np.zeros(returned_tensor.shape)
-        integer_mask = []
-        permutation_blocks = []
-        old_ordering = []
-        for i, block in enumerate(row):
-            integer_mask += [i] * len(block)
-            permutation_blocks.append(block)
-            old_ordering += block
-        old_ordering = sorted(old_ordering)
-        for permutation in multiset_permutations(integer_mask):
-            next_index_per_block = [0] * len(permutation_blocks)
-            new_ordering = []
-            for block, old_axis in zip(permutation, old_ordering):
-                next_index = next_index_per_block[block]
-                new_axis = permutation_blocks[block][next_index]
-                new_ordering.append(new_axis)
-                next_index_per_block[block] += 1
-            returned_tensor += np.moveaxis(old_tensor, new_ordering, old_ordering) * find_parity(new_ordering, old_ordering)
+    This function handles the remaining antisymmetrizations.
+    The input is not modified. If out is given, the result is written there. It must not overlap the input. """
+    if isinstance(tensor, IrrepTensor):
+        # Permuting axes permutes the blocks, so the terms are summed with the tensor's own arithmetic.
+        for row in axis_data:
+            terms = row_permutations(tuple(tuple(block) for block in row), tensor.ndim)
+            tensor = sum(parity * tensor.transpose(axes) for axes, parity in terms)
+        return tensor if axis_data else tensor.copy()
+    if not axis_data:
+        if out is None:
+            return tensor.copy()
+        np.copyto(out, tensor)
+        return out
+    dtype = np.result_type(tensor, float)
+    returned_tensor = tensor
+    for i, row in enumerate(axis_data):
+        last = i == len(axis_data) - 1
+        buffer = out if last and out is not None else np.empty(tensor.shape, dtype=dtype)
+        (axes, parity), *others = row_permutations(tuple(tuple(block) for block in row), tensor.ndim)
+        np.multiply(returned_tensor.transpose(axes), parity, out=buffer)
+        for axes, parity in others:
+            if parity == 1:
+                buffer += returned_tensor.transpose(axes)
+            else:
+                buffer -= returned_tensor.transpose(axes)
+        returned_tensor = buffer
     return returned_tensor
 
+@lru_cache(maxsize=None)
+def row_permutations(row: tuple[tuple[int]], ndim: int) -> tuple[tuple[tuple[int], int]]:
+    """ Return the axis orderings, for np.transpose, and parities of all terms of one antisymmetrizer. """
+    integer_mask = []
+    permutation_blocks = []
+    old_ordering = []
+    for i, block in enumerate(row):
+        integer_mask += [i] * len(block)
+        permutation_blocks.append(block)
+        old_ordering += block
+    old_ordering = sorted(old_ordering)
+    terms = []
+    for permutation in multiset_permutations(integer_mask):
+        next_index_per_block = [0] * len(permutation_blocks)
+        new_ordering = []
+        for block, old_axis in zip(permutation, old_ordering):
+            next_index = next_index_per_block[block]
+            new_axis = permutation_blocks[block][next_index]
+            new_ordering.append(new_axis)
+            next_index_per_block[block] += 1
+        # Equivalent to np.moveaxis(tensor, new_ordering, old_ordering)
+        axes = list(range(ndim))
+        for new_axis, old_axis in zip(new_ordering, old_ordering):
+            axes[old_axis] = new_axis
+        terms.append((tuple(axes), find_parity(new_ordering, old_ordering)))
+    return tuple(terms)
+
 def find_parity(list1: list, list2: list) -> int:
     """ Find the parity of the permutation between these. """
     num_flips = 0 
@@ -0,0 +1,149 @@
+"""
+Cholesky-factorized two-electron integrals, <pq|rs> = sum_Q B^Q_pr B^Q_qs.
+
+The vectors are N^3 against the N^4 of the dense integrals. They are generated here from the dense AO integrals,
+so the N^4 tensor still exists once, until it is factorized, but nothing downstream of the factorization needs it.
+The MO blocks with three or more virtual indices, like vvvv and ovvv, stay factorized as FactorizedBlock,
+which einsum contracts through the vectors. The smaller blocks, at most o^2 v^2, are built.
+"""
+import itertools
+import string
+
+import numpy as np
+
+from .symmetry import parse_subscripts
+
+
+class CholeskyVectors:
+    """ Cholesky vectors of the AO two-electron integrals, stored as vectors[Q, p, r] for electron (p, r). """
+
+    def __init__(self, vectors: np.ndarray):
+        self.vectors = vectors
+
+    @classmethod
+    def from_dense(cls, r_ao: np.ndarray, threshold: float = 1e-8):
+        """ Factorize r_ao, in physicist's notation, by pivoted incomplete Cholesky decomposition.
+        Stops when no diagonal element of the remaining error exceeds threshold. """
+        n = r_ao.shape[0]
+        # Row (p, r), column (q, s): the chemist's notation supermatrix (pr|qs), which is positive semidefinite.
+        matrix = r_ao.transpose(0, 2, 1, 3).reshape(n * n, n * n)
+        diagonal = np.diagonal(matrix).copy()
+        vectors = []
+        while len(vectors) < n * n:
+            pivot = np.argmax(diagonal)
+            if diagonal[pivot] <= threshold:
+                break
+            column = matrix[:, pivot].copy()
+            for vector in vectors:
+                column -= vector * vector[pivot]
+            vector = column / np.sqrt(diagonal[pivot])
+            vectors.append(vector)
+            diagonal -= vector ** 2
+        return cls(np.array(vectors).reshape(-1, n, n))
+
+    @property
+    def naux(self) -> int:
+        return self.vectors.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        return self.vectors.nbytes
+
+    def transform(self, left: np.ndarray, right: np.ndarray) -> np.ndarray:
+        """ Return B^Q_PR for the orbitals given by the columns of left and right. """
+        temp = np.tensordot(self.vectors, left, (1, 0)) # QrP
+        return np.ascontiguousarray(np.tensordot(temp, right, (1, 0))) # QPR
+
+    def to_dense(self) -> np.ndarray:
+        """ Return the integrals <pq|rs>. Only for testing: this is the N^4 tensor the factorization avoids. """
+        return np.einsum("Qpr, Qqs -> pqrs", self.vectors, self.vectors)
+
+
+class FactorizedBlock:
+    """
+    A two-electron block <PQ||RS> kept as Cholesky vectors instead of an N^4 array: the Coulomb term
+    sum_X B^X_PR B^X_QS, minus the exchange term sum_X B^X_PS B^X_QR if both electrons have the same spin.
+    Each term is (weight, left, right, axes), the array weight * einsum("Xab, Xcd -> abcd", left, right).transpose(axes).
+    tensor.einsum contracts it through the vectors. Anything else, like np.tensordot, sees the dense block through __array__.
+    """
+
+    def __init__(self, terms):
+        self.terms = tuple(terms)
+
+    @classmethod
+    def antisymmetrized(cls, pr: np.ndarray, qs: np.ndarray, ps: np.ndarray = None, qr: np.ndarray = None):
+        """ Return <PQ||RS> from the vectors of each pair of orbital spaces. Without ps and qr, there's no exchange term. """
+        terms = [(1, pr, qs, (0, 2, 1, 3))]
+        if ps is not None:
+            terms.append((-1, ps, qr, (0, 2, 3, 1)))
+        return cls(terms)
+
+    @property
+    def shape(self) -> tuple:
+        _, left, right, axes = self.terms[0]
+        shape = left.shape[1:] + right.shape[1:]
+        return tuple(shape[x] for x in axes)
+
+    @property
+    def ndim(self) -> int:
+        return 4
+
+    @property
+    def dtype(self):
+        return np.result_type(*(vectors for _, left, right, _ in self.terms for vectors in (left, right)))
+
+    @property
+    def nbytes(self) -> int:
+        vectors = {id(x): x for _, left, right, _ in self.terms for x in (left, right)}
+        return sum(x.nbytes for x in vectors.values())
+
+    def transpose(self, *axes):
+        if len(axes) == 1:
+            axes = tuple(axes[0])
+        return FactorizedBlock((weight, left, right, tuple(old[x] for x in axes)) for weight, left, right, old in self.terms)
+
+    def __mul__(self, weight):
+        return FactorizedBlock((weight * old, left, right, axes) for old, left, right, axes in self.terms)
+
+    __rmul__ = __mul__
+
+    def to_dense(self) -> np.ndarray:
+        return sum(weight * np.einsum("Xab, Xcd -> abcd", left, right).transpose(axes) for weight, left, right, axes in self.terms)
+
+    def __array__(self, dtype=None, copy=None):
+        dense = self.to_dense()
+        return dense if dtype is None else dense.astype(dtype)
+
+
+def expand_factorized(subscripts: str, operands: tuple):
+    """
+    Rewrite einsum(subscripts, *operands) as a sum of contractions in which each FactorizedBlock is replaced by
+    the two vectors of one of its terms, e.g. "abcd, ijcd -> ijab" with g_vvvv becomes "Xac, Xbd, ijcd -> ijab"
+    minus "Xad, Xbc, ijcd -> ijab". Return a list of (weight, subscripts, operands), or None if the subscripts
+    can't be followed.
+    """
+    parsed = parse_subscripts(subscripts, len(operands))
+    if parsed is None:
+        return None
+    inputs, output = parsed
+    free = (x for x in string.ascii_letters if x not in subscripts)
+    choices = []
+    for labels, operand in zip(inputs, operands):
+        if not isinstance(operand, FactorizedBlock):
+            choices.append([(1, (labels,), (operand,))])
+            continue
+        auxiliary = next(free)
+        options = []
+        for weight, left, right, axes in operand.terms:
+            # Axis n of the block is axis axes[n] of einsum("Xab, Xcd -> abcd", left, right).
+            product = [None] * 4
+            for n, x in enumerate(axes):
+                product[x] = labels[n]
+            options.append((weight, (auxiliary + product[0] + product[1], auxiliary + product[2] + product[3]), (left, right)))
+        choices.append(options)
+    expanded = []
+    for combination in itertools.product(*choices):
+        weight = np.prod([weight for weight, _, _ in combination])
+        labels = ",".join(x for _, labels, _ in combination for x in labels)
+        expanded.append((weight, f"{labels}->{output}", tuple(x for _, _, operands in combination for x in operands)))
+    return expanded
@@ -0,0 +1,389 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable
+
+import numpy as np
+
+from . import packed as packing
+from .cholesky import CholeskyVectors, FactorizedBlock
+from .symmetry import IrrepTensor, key_irreps
+
+Label = tuple[str, str] # (space, spin), e.g. ("o", "α")
+
+class IntegralTransformer:
+    """
+    Transform AO integrals to blocks of MO integrals, keeping the work that can be reused.
+
+    The two-electron transform is done in two halves. The first half, over the bra indices, depends on only two
+    coefficient matrices and is shared by every block with those bra spaces, e.g. oooo, oovv and ooov.
+    Half-transformed integrals and finished blocks are kept between calls to update, and only those that
+    depend on a changed coefficient matrix are recomputed. Orbital optimization rotates every "o" and "v"
+    matrix on every iteration, so there this only keeps what depends on the frozen spaces, like the core
+    potential. Updating the blocks through the rotation generator instead is no cheaper: applying exp(X)
+    to the MO integrals is a four-index transform of the same N^5 cost.
+
+    r_ao is in physicist's notation, <pq|rs>, so p and r belong to one electron and q and s to the other.
+    It may instead be CholeskyVectors, in which case blocks are built from transformed vectors B^Q_PR and
+    no N^4 AO tensor is touched. Blocks with three or more virtual indices, like vvvv and ovvv, are then not
+    built at all but kept as a FactorizedBlock of the vectors, unless the orbital irreps are given.
+    Orbitals are real, so a block like vvoo is the transpose of oovv, if that was already transformed.
+
+    Orbitals of the space "c" are a frozen core: always occupied and never correlated. They enter the other
+    blocks only through their potential, which is added to the one-electron integrals, and core_energy.
+    Orbitals of the space "w" are frozen virtuals and never enter any block that isn't asked for.
+    """
+
+    def __init__(self, h_ao: np.ndarray, r_ao: np.ndarray, irreps: dict[str, tuple[np.ndarray, np.ndarray]] = None):
+        """ irreps maps each space to the irreps of its alpha and beta orbitals. If given, two-electron blocks
+        are stored as IrrepTensors. See multilinear.symmetry. """
+        self.h_ao = h_ao
+        self.r_ao = r_ao
+        self.irreps = irreps
+        self.factorized = isinstance(r_ao, CholeskyVectors)
+        self.coefficients = dict() # Map label to coefficient matrix
+        self.cache = dict() # Map (kind, labels) to an array. The array depends only on those labels.
+        self.quarters = dict() # Map label to quarter-transformed integrals, while transform runs
+
+    def update(self, orbitals: dict[str, tuple[np.ndarray, np.ndarray]]) -> set[Label]:
+        """ Set the orbitals, given as a map from space to (alpha, beta) coefficients. Return the changed labels. """
+        changed = set()
+        for space, matrices in orbitals.items():
+            for spin, matrix in zip("αβ", matrices):
+                old = self.coefficients.get((space, spin))
+                if old is None or old.shape != matrix.shape or not np.array_equal(old, matrix):
+                    self.coefficients[(space, spin)] = matrix
+                    changed.add((space, spin))
+        if changed:
+            self.cache = {key: value for key, value in self.cache.items() if not changed.intersection(key[1])}
+        return changed
+
+    def cached(self, kind: str, labels: tuple[Label], compute):
+        key = (kind, labels)
+        if key not in self.cache:
+            self.cache[key] = compute()
+        return self.cache[key]
+
+    def core_labels(self) -> tuple[Label, ...]:
+        """ Return the labels of the frozen core orbitals, if there are any. """
+        return tuple(label for label in (("c", "α"), ("c", "β")) if label in self.coefficients and self.coefficients[label].shape[1])
+
+    def core_potential(self, spin: str) -> np.ndarray:
+        """ Return the AO potential of the frozen core on an electron of the given spin, J - K. """
+        def compute():
+            potentials = {other: np.zeros(self.h_ao.shape) for other in "αβ"}
+            for label in self.core_labels():
+                coulomb, exchange = coulomb_exchange(self.r_ao, self.coefficients[label] @ self.coefficients[label].T)
+                for other in "αβ":
+                    potentials[other] += coulomb - exchange if other == label[1] else coulomb
+            return potentials
+        return self.cached("v", self.core_labels(), compute)[spin]
+
+    def core_energy(self) -> float:
+        """ Return the energy of the frozen core electrons, on their own and with each other. """
+        energy = 0
+        for label in self.core_labels():
+            density = self.coefficients[label] @ self.coefficients[label].T
+            energy += np.vdot(density, self.h_ao + 0.5 * self.core_potential(label[1]))
+        return energy
+
+    def one_electron(self, p: Label, q: Label) -> np.ndarray:
+        """ Return h_PQ, including the potential of the frozen core. """
+        def compute():
+            h_ao = self.h_ao + self.core_potential(p[1]) if self.core_labels() else self.h_ao
+            return self.coefficients[p].T @ h_ao @ self.coefficients[q]
+        return self.cached("h", (p, q) + self.core_labels(), compute)
+
+    def quarter(self, p: Label) -> np.ndarray:
+        """ Return <Pq|rs>. Only kept while transform runs: it is as large as r_ao for a large space. """
+        if p in self.quarters:
+            return self.quarters[p]
+        return np.tensordot(self.coefficients[p], self.r_ao, (0, 0))
+
+    def half(self, p: Label, q: Label) -> np.ndarray:
+        """ Return <PQ|rs>, with the ket still in the AO basis. """
+        def compute():
+            # Transform the smaller space first. <pq|rs> = <qp|sr> lets either index go first.
+            if self.coefficients[p].shape[1] <= self.coefficients[q].shape[1]:
+                temp = np.tensordot(self.quarter(p), self.coefficients[q], (1, 0)) # PrsQ
+                return np.ascontiguousarray(temp.transpose(0, 3, 1, 2))
+            temp = np.tensordot(self.quarter(q), self.coefficients[p], (1, 0)) # QsrP
+            return np.ascontiguousarray(temp.transpose(3, 0, 2, 1))
+        return self.cached("half", (p, q), compute)
+
+    def vectors(self, p: Label, r: Label) -> np.ndarray:
+        """ Return the Cholesky vectors B^Q_PR. """
+        return self.cached("b", (p, r), lambda: self.r_ao.transform(self.coefficients[p], self.coefficients[r]))
+
+    def coulomb(self, p: Label, q: Label, r: Label, s: Label) -> np.ndarray:
+        """ Return <PQ|RS>. Not cached: the callers cache the blocks they build from it. """
+        if self.factorized:
+            return np.tensordot(self.vectors(p, r), self.vectors(q, s), (0, 0)).transpose(0, 2, 1, 3)
+        temp = np.tensordot(self.half(p, q), self.coefficients[r], (2, 0)) # PQsR
+        temp = np.tensordot(temp, self.coefficients[s], (2, 0)) # PQRS
+        return temp
+
+    def antisymmetrized(self, spaces: str, spins: str) -> np.ndarray:
+        """ Return <PQ||RS> for the spatial orbital spaces, e.g. "ovov", where P and R have spin spins[0]
+        and Q and S have spin spins[1]. """
+        p, q, r, s = [(space, spin) for space, spin in zip(spaces, spins * 2)]
+        def compute():
+            if ("g", (r, s, p, q)) in self.cache:
+                return self.cache[("g", (r, s, p, q))].transpose(2, 3, 0, 1)
+            if self.keeps_factorized(spaces):
+                exchange = (self.vectors(p, s), self.vectors(q, r)) if spins[0] == spins[1] else ()
+                return FactorizedBlock.antisymmetrized(self.vectors(p, r), self.vectors(q, s), *exchange)
+            block = self.coulomb(p, q, r, s)
+            if spins[0] == spins[1]:
+                exchange = block if r == s else self.coulomb(p, q, s, r)
+                block = block - exchange.swapaxes(2, 3)
+            return self.blocked(block, f"g_{spaces}_{spins}")
+        return self.cached("g", (p, q, r, s), compute)
+
+    def keeps_factorized(self, spaces: str) -> bool:
+        """ Is the block of these spaces kept as Cholesky vectors? Only the blocks of N^4 size are: the others
+        are at most o^2 v^2, and are built. """
+        return self.factorized and self.irreps is None and spaces.count("v") >= 3
+
+    def blocked(self, block: np.ndarray, key: str):
+        """ Return the block as an IrrepTensor, if the orbital irreps are known. """
+        return block if self.irreps is None else IrrepTensor.from_dense(block, key_irreps(key, self.irreps))
+
+    def spinorbital_one_electron(self, spaces: str) -> np.ndarray:
+        """ Return h_PQ in spin orbitals, all alpha orbitals of a space before all beta orbitals. """
+        p, q = spaces
+        def compute():
+            blocks = [self.one_electron((p, spin), (q, spin)) for spin in "αβ"]
+            result = np.zeros(tuple(sum(block.shape[axis] for block in blocks) for axis in range(2)))
+            result[:blocks[0].shape[0], :blocks[0].shape[1]] = blocks[0]
+            result[blocks[0].shape[0]:, blocks[0].shape[1]:] = blocks[1]
+            return result
+        return self.cached("h", ((p, "α"), (p, "β"), (q, "α"), (q, "β")) + self.core_labels(), compute)
+
+    def spinorbital_vectors(self, spaces: str) -> np.ndarray:
+        """ Return the Cholesky vectors B^Q_PR in spin orbitals, all alpha orbitals of a space before all beta orbitals. """
+        p, r = spaces
+        def compute():
+            blocks = [self.vectors((p, spin), (r, spin)) for spin in "αβ"]
+            result = np.zeros((self.r_ao.naux,) + tuple(sum(block.shape[axis] for block in blocks) for axis in (1, 2)))
+            result[:, :blocks[0].shape[1], :blocks[0].shape[2]] = blocks[0]
+            result[:, blocks[0].shape[1]:, blocks[0].shape[2]:] = blocks[1]
+            return result
+        return self.cached("b", ((p, "α"), (p, "β"), (r, "α"), (r, "β")), compute)
+
+    def spinorbital(self, spaces: str) -> np.ndarray:
+        """ Return <PQ||RS> in spin orbitals, all alpha orbitals of a space before all beta orbitals. """
+        labels = tuple((space, spin) for space in spaces for spin in "αβ")
+        def compute():
+            if ("g", labels[4:] + labels[:4]) in self.cache:
+                return self.cache[("g", labels[4:] + labels[:4])].transpose(2, 3, 0, 1)
+            if self.keeps_factorized(spaces):
+                p, q, r, s = spaces
+                vectors = self.spinorbital_vectors
+                return FactorizedBlock.antisymmetrized(vectors(p + r), vectors(q + s), vectors(p + s), vectors(q + r))
+            dims = {space: [self.coefficients[(space, spin)].shape[1] for spin in "αβ"] for space in spaces}
+            def piece(space, spin):
+                start = 0 if spin == "α" else dims[space][0]
+                return slice(start, start + dims[space]["αβ".index(spin)])
+            p, q, r, s = spaces
+            result = np.zeros(tuple(sum(dims[space]) for space in spaces))
+            for sp in "αβ":
+                for sq in "αβ":
+                    direct = self.coulomb((p, sp), (q, sq), (r, sp), (s, sq))
+                    result[piece(p, sp), piece(q, sq), piece(r, sp), piece(s, sq)] += direct
+                    exchange = direct.swapaxes(2, 3) if r == s and sp == sq else self.coulomb((p, sp), (q, sq), (s, sp), (r, sq)).swapaxes(2, 3)
+                    result[piece(p, sp), piece(q, sq), piece(r, sq), piece(s, sp)] -= exchange
+            return self.blocked(result, f"g_{spaces}")
+        return self.cached("g", labels, compute)
+
+    def spinorbital_block(self, key: str, packed: bool = False):
+        """ Return a spin orbital intermediate like h_oo, g_oovv or, for Cholesky vectors, b_ov.
+        If packed, antisymmetric blocks are packed. """
+        kind, spaces = parse_key(key, 1)
+        if kind == "h":
+            return self.spinorbital_one_electron(spaces)
+        if kind == "b":
+            return self.spinorbital_vectors(spaces)
+        groups = packing.antisymmetric_groups(spaces) if packed and not self.keeps_factorized(spaces) else ()
+        if not groups:
+            return self.spinorbital(spaces)
+        labels = tuple((space, spin) for space in spaces for spin in "αβ")
+        def compute():
+            self.spinorbital(spaces)
+            # Keep only the packed block. A dense one left in the cache would cost more than packing saves.
+            return packing.pack(self.cache.pop(("g", labels)), groups)
+        return self.cached("packed", labels, compute)
+
+    def unrestricted_block(self, key: str) -> np.ndarray:
+        """ Return an unrestricted intermediate like h_oo_α, g_oovv_αβ or, for Cholesky vectors, b_ov_α. """
+        kind, spaces, spins = parse_key(key, 2)
+        if kind == "h" and len(spins) == 1:
+            return self.one_electron((spaces[0], spins), (spaces[1], spins))
+        if kind == "b" and len(spins) == 1:
+            return self.vectors((spaces[0], spins), (spaces[1], spins))
+        if kind == "g" and len(spins) == 2:
+            return self.antisymmetrized(spaces, spins)
+        raise KeyError(key)
+
+    def transform(self, keys: Iterable[str], provider: Callable[[str], np.ndarray], num_threads: int = 1) -> dict:
+        """
+        Return a map from each key to provider(key), where provider is one of the *_block methods.
+
+        The work is staged: first the quarter-transforms shared between half-transforms, then every half-transform
+        the keys need, then the blocks, then the blocks that are transposes of others. The steps of a stage
+        are independent, so they can run on a pool of threads.
+        """
+        keys = list(keys)
+        halves = [] if self.factorized else [half for half in dict.fromkeys(half for key in keys for half in required_halves(key)) if ("half", half) not in self.cache]
+        firsts = [min(half, key=lambda x: self.coefficients[x].shape[1]) for half in halves]
+        shared = [label for label in dict.fromkeys(firsts) if firsts.count(label) > 1]
+        transposes = [key for key in keys if transposed_key(key) in keys and transposed_key(key) < key]
+        direct = [key for key in keys if key not in transposes]
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            try:
+                self.quarters = dict(zip(shared, pool.map(self.quarter, shared)))
+                list(pool.map(lambda x: self.half(*x), halves))
+            finally:
+                self.quarters = dict()
+            blocks = dict(zip(direct, pool.map(provider, direct)))
+        blocks.update({key: provider(key) for key in transposes})
+        return {key: blocks[key] for key in keys}
+
+    def request_asym(self, strings: Iterable[str]) -> dict[str, np.ndarray]:
+        """ Drop-in for spinorb.request_asym. Return spin orbital blocks for each string of spaces, e.g. "oo" or "oovv". """
+        return {string: (self.spinorbital_one_electron(string) if len(string) == 2 else self.spinorbital(string)) for string in strings}
+
+
+def coulomb_exchange(r_ao, density: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """ Return the AO Coulomb and exchange matrices of a density, J_pq = <pr|qs> D_rs and K_pq = <pr|sq> D_rs.
+    r_ao may be dense or CholeskyVectors. """
+    if isinstance(r_ao, CholeskyVectors):
+        vectors = r_ao.vectors
+        coulomb = np.tensordot(np.tensordot(vectors, density, ((1, 2), (0, 1))), vectors, (0, 0))
+        temp = np.tensordot(vectors, density, (2, 0)) # Qpr
+        exchange = np.tensordot(temp, vectors, ((0, 2), (0, 1)))
+        return coulomb, exchange
+    return np.tensordot(r_ao, density, ((1, 3), (0, 1))), np.tensordot(r_ao, density, ((1, 2), (0, 1)))
+
+def parse_key(key: str, num_parts: int) -> tuple[str, ...]:
+    """ Split an integral key like g_oovv or g_oovv_αβ into its parts. Raise KeyError if it isn't one. """
+    parts = key.split("_")
+    if len(parts) != num_parts + 1 or parts[0] not in ("h", "g", "b") or len(parts[1]) != (4 if parts[0] == "g" else 2):
+        raise KeyError(key)
+    return tuple(parts)
+
+def required_halves(key: str) -> list[tuple[Label, Label]]:
+    """ Return the bra labels of the half-transforms an integral key needs. """
+    parts = key.split("_")
+    if parts[0] != "g":
+        return []
+    p, q = parts[1][:2]
+    spins = [parts[2]] if len(parts) == 3 else ["αα", "αβ", "βα", "ββ"]
+    return [((p, spin[0]), (q, spin[1])) for spin in spins]
+
+def transposed_key(key: str) -> str:
+    """ Return the key of the block with the electron pairs exchanged, e.g. g_vvoo_αβ for g_oovv_αβ. """
+    parts = key.split("_")
+    if parts[0] != "g":
+        return key
+    parts[1] = parts[1][2:] + parts[1][:2]
+    return "_".join(parts)
+
+
+class LazyIntegrals(dict):
+    """
+    A dict of intermediates that transforms an integral block the first time it is read, so only the blocks
+    a method consumes are ever transformed. Until then, `key in intermediates` is False for the block.
+    """
+
+    def __init__(self, intermediates: dict, provider: Callable[[str], np.ndarray], factorized: bool = False):
+        """ provider maps a key to its block, or raises KeyError if the key is not an integral.
+        factorized says whether the provider transforms Cholesky vectors, so the glue can read b blocks instead. """
+        super().__init__(intermediates)
+        self.provider = provider
+        self.factorized = factorized
+        self.provided = set() # Integral keys read so far
+
+    def __missing__(self, key):
+        value = self.provider(key)
+        self[key] = value
+        self.provided.add(key)
+        return value
+
+    def refresh(self):
+        """ Drop the transformed blocks, so they are transformed from the current orbitals when next read. """
+        for key in self.provided:
+            self.pop(key, None)
+
+    def track(self, function: Callable) -> Callable:
+        """ Return function, for the solvers to call with these intermediates. Containers that record what each
+        function reads and writes return a wrapper that only calls it when there is something new to compute. """
+        return function
+
+
+def closed_shell_key(key: str) -> tuple[str, tuple[int, ...]]:
+    """
+    For a closed-shell reference, each spin block equals the block with all spins flipped, with the indices of
+    each electron row resorted so the alpha indices come first. Return the key of the block a restricted code
+    keeps, the one with fewer beta indices (then the one with the lower spaces), and the axes that carry it to the
+    requested block. E.g. g_vovo_αβ gives g_ovov_αβ and (1, 0, 3, 2). Keys without spins are returned as they are.
+    """
+    parts = key.split("_")
+    spins = parts[-1]
+    if len(parts) < 2 or not spins or set(spins) - {"α", "β"}:
+        return key, None
+    n = len(spins)
+    explicit = len(parts) > 2 and len(parts[-2]) == 2 * n and not set(parts[-2]) - {"o", "v"}
+    spaces = parts[-2] if explicit else "o" * n + "v" * n
+    # The alpha indices of a row become beta, so the other indices move in front of them.
+    num_alpha = spins.count("α")
+    order = list(range(num_alpha, n)) + list(range(num_alpha))
+    rows = [spaces[:n], spaces[n:]]
+    flipped_rows = ["".join(row[x] for x in order) for row in rows]
+    preference = (n - num_alpha, tuple(sorted(rows)))
+    flipped_preference = (num_alpha, tuple(sorted(flipped_rows)))
+    if preference <= flipped_preference:
+        return key, None
+    parts[-1] = "α" * (n - num_alpha) + "β" * num_alpha
+    if explicit:
+        parts[-2] = "".join(flipped_rows)
+    # Requested position x of a row sits at position order.index(x) of the stored row.
+    inverse = [order.index(x) for x in range(n)]
+    return "_".join(parts), tuple(inverse + [n + x for x in inverse])
+
+
+class ClosedShellIntermediates(LazyIntegrals):
+    """
+    Intermediates of a closed-shell reference, where the alpha and beta orbitals are the same. Of each pair of
+    spin blocks related by flipping all spins, only the one named by closed_shell_key is stored, and only its
+    integrals are transformed. Reading the other block returns a read-only transposed view of the stored one.
+    Writing the other block does nothing, since it would only repeat the stored block.
+
+    This saves integral storage and transforms, and the storage of flipped amplitude and RDM blocks. A module
+    generated with compute.restricted, like scripts.prdm.restricted_param, also leaves out the contractions
+    of the flipped blocks.
+    """
+
+    def __init__(self, intermediates: dict, provider: Callable[[str], np.ndarray], factorized: bool = False):
+        super().__init__({key: value for key, value in intermediates.items() if closed_shell_key(key)[0] == key}, provider, factorized)
+
+    def __getitem__(self, key):
+        canonical, axes = closed_shell_key(key)
+        value = super().__getitem__(canonical)
+        if axes is None or np.ndim(value) == 0:
+            return value
+        # Leading axes outside the electron rows, like the auxiliary index of Cholesky vectors, stay in place.
+        offset = np.ndim(value) - len(axes)
+        flipped = np.transpose(value, tuple(range(offset)) + tuple(offset + x for x in axes))
+        if isinstance(flipped, np.ndarray):
+            # A generated term adds into its target in place, which mustn't reach the stored block.
+            flipped.flags.writeable = False
+        return flipped
+
+    def __setitem__(self, key, value):
+        if closed_shell_key(key)[0] == key:
+            super().__setitem__(key, value)
+
+    def __contains__(self, key):
+        return super().__contains__(closed_shell_key(key)[0])
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
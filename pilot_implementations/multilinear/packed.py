@@ -0,0 +1,253 @@
+"""
+Storage for tensors that are antisymmetric within groups of axes, like t2 or g_vvvv.
+Only the elements with strictly increasing indices within each group (i<j, a<b) are stored.
+
+A group whose indices are all summed against a single dense operand is contracted without unpacking:
+sum_{a,b} g_ab X_ab = sum_{a<b} g_ab (X_ab - X_ba). Other groups are unpacked for that contraction only,
+so no dense copy of a packed tensor outlives the term that needs it.
+"""
+from __future__ import annotations
+from functools import lru_cache
+import itertools
+from math import comb, factorial
+from numbers import Number
+import string
+from typing import Union
+
+import numpy as np
+
+from .asym import find_parity
+from .symmetry import parse_subscripts
+
+Groups = tuple[tuple[int, ...], ...]
+
+
+@lru_cache(maxsize=None)
+def _combinations(dim: int, rank: int) -> np.ndarray:
+    """ All strictly increasing index tuples of length rank, with entries below dim. Shape (comb(dim, rank), rank). """
+    return np.array(list(itertools.combinations(range(dim), rank)), dtype=np.intp).reshape(-1, rank)
+
+@lru_cache(maxsize=None)
+def _signed_permutations(rank: int) -> tuple[tuple[tuple[int, ...], int], ...]:
+    return tuple((permutation, find_parity(list(range(rank)), list(permutation))) for permutation in itertools.permutations(range(rank)))
+
+
+class PackedTensor:
+    """ A tensor antisymmetric within each group of axes, stored with one packed axis per group.
+
+    Axes within a group must be adjacent and of equal dimension. Axes outside every group are stored as is.
+    Converting to a numpy array (np.asarray, or any einsum from multilinear.tensor that can't contract the packed axes
+    directly) unpacks the tensor into a new array. """
+
+    def __init__(self, data: np.ndarray, shape: tuple[int, ...], groups: Groups):
+        self.data = data
+        self.shape = tuple(shape)
+        self.groups = tuple(tuple(group) for group in groups)
+        for group in self.groups:
+            if list(group) != list(range(group[0], group[0] + len(group))) or len({self.shape[x] for x in group}) != 1:
+                raise ValueError(f"Antisymmetric axes {group} must be adjacent and of equal dimension.")
+        if data.shape != self.packed_shape(self.shape, self.groups):
+            raise ValueError(f"Packed data of shape {data.shape} does not match shape {self.shape} and groups {self.groups}.")
+
+    @staticmethod
+    def packed_shape(shape: tuple[int, ...], groups: Groups) -> tuple[int, ...]:
+        starts = {group[0]: group for group in groups}
+        packed = []
+        axis = 0
+        while axis < len(shape):
+            if axis in starts:
+                packed.append(comb(shape[axis], len(starts[axis])))
+                axis += len(starts[axis])
+            else:
+                packed.append(shape[axis])
+                axis += 1
+        return tuple(packed)
+
+    @classmethod
+    def from_dense(cls, array: np.ndarray, groups: Groups) -> PackedTensor:
+        """ Pack an array that is antisymmetric within each group. Antisymmetry is assumed, not checked. """
+        array = np.asarray(array)
+        # Work from the last group so earlier axis numbers stay valid.
+        data = array
+        for group in sorted(groups, reverse=True):
+            index = _combinations(array.shape[group[0]], len(group))
+            selector = (slice(None),) * group[0] + tuple(index[:, k] for k in range(len(group)))
+            data = data[selector]
+        return cls(np.ascontiguousarray(data), array.shape, groups)
+
+    @classmethod
+    def zeros(cls, shape: tuple[int, ...], groups: Groups, dtype=float) -> PackedTensor:
+        return cls(np.zeros(cls.packed_shape(shape, groups), dtype=dtype), shape, groups)
+
+    def unpack(self, groups: Groups = None) -> np.ndarray:
+        """ Return the array with the given groups unpacked, by default all of them. Other groups stay packed. """
+        groups = tuple(sorted(self.groups if groups is None else groups))
+        dense = self.data
+        # Unpack from the first group. Each group's packed axis sits at the position of its first axis,
+        # less one for each axis of a packed group before it.
+        offset = 0
+        for group in sorted(self.groups):
+            rank = len(group)
+            axis = group[0] - offset
+            if group not in groups:
+                offset += rank - 1
+                continue
+            index = _combinations(self.shape[group[0]], rank)
+            moved = np.moveaxis(dense, axis, 0)
+            new = np.zeros((self.shape[group[0]],) * rank + moved.shape[1:], dtype=dense.dtype)
+            for permutation, parity in _signed_permutations(rank):
+                new[tuple(index[:, k] for k in permutation)] = moved if parity == 1 else -moved
+            dense = np.moveaxis(new, tuple(range(rank)), tuple(range(axis, axis + rank)))
+        return dense
+
+    def __array__(self, dtype=None, copy=None):
+        # A copy, since the caller may change it.
+        return self.unpack().astype(dtype if dtype is not None else self.dtype)
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes
+
+    def copy(self) -> PackedTensor:
+        return PackedTensor(self.data.copy(), self.shape, self.groups)
+
+    def _other_data(self, other: Union[PackedTensor, np.ndarray, Number]):
+        """ Return other's packed data in this tensor's layout. """
+        if isinstance(other, Number):
+            return other
+        if isinstance(other, PackedTensor):
+            if other.shape != self.shape or other.groups != self.groups:
+                raise ValueError("Packed tensors must have the same shape and antisymmetric axes.")
+            return other.data
+        return PackedTensor.from_dense(other, self.groups).data
+
+    def __add__(self, other):
+        return PackedTensor(self.data + self._other_data(other), self.shape, self.groups)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return PackedTensor(self.data - self._other_data(other), self.shape, self.groups)
+
+    def __rsub__(self, other):
+        return PackedTensor(self._other_data(other) - self.data, self.shape, self.groups)
+
+    def __iadd__(self, other):
+        self.data += self._other_data(other)
+        return self
+
+    def __isub__(self, other):
+        self.data -= self._other_data(other)
+        return self
+
+    def __mul__(self, other: Number):
+        if not isinstance(other, Number):
+            return NotImplemented
+        return PackedTensor(self.data * other, self.shape, self.groups)
+
+    __rmul__ = __mul__
+
+    def __imul__(self, other: Number):
+        self.data *= other
+        return self
+
+    def __truediv__(self, other: Number):
+        if not isinstance(other, Number):
+            return NotImplemented
+        return PackedTensor(self.data / other, self.shape, self.groups)
+
+    def __neg__(self):
+        return PackedTensor(-self.data, self.shape, self.groups)
+
+    def multiplicity(self) -> int:
+        """ The number of dense elements each packed element stands for. """
+        return int(np.prod([factorial(len(group)) for group in self.groups]))
+
+    def vdot(self, other: Union[PackedTensor, np.ndarray]) -> float:
+        """ Full contraction with a tensor of the same antisymmetry, without unpacking. """
+        return self.multiplicity() * np.vdot(self.data, self._other_data(other))
+
+    def norm(self) -> float:
+        """ Frobenius norm of the dense tensor. """
+        return np.sqrt(self.multiplicity()) * np.linalg.norm(self.data)
+
+
+def pack(array: np.ndarray, groups: Groups) -> PackedTensor:
+    """ Pack an array antisymmetric within each group of adjacent axes. """
+    return PackedTensor.from_dense(array, groups)
+
+def unpack(tensor: Union[PackedTensor, np.ndarray]) -> np.ndarray:
+    """ Return a dense array, whether or not the tensor was packed. """
+    return tensor.unpack() if isinstance(tensor, PackedTensor) else tensor
+
+def _gather(array: np.ndarray, axes: tuple[int, ...]) -> np.ndarray:
+    """ Return sum_P parity(P) array[P(i<j<...)] over the given axes, with the pairs (i<j<...) on a new first axis. """
+    rank = len(axes)
+    moved = np.moveaxis(array, axes, tuple(range(rank)))
+    index = _combinations(array.shape[axes[0]], rank)
+    gathered = 0
+    for permutation, parity in _signed_permutations(rank):
+        gathered = gathered + parity * moved[tuple(index[:, k] for k in permutation)]
+    return gathered
+
+def contract_packed(subscripts: str, operands: tuple) -> tuple[str, tuple]:
+    """
+    Rewrite einsum(subscripts, *operands) so that no operand is a PackedTensor, and return the new subscripts and operands.
+
+    A group of a packed operand whose indices are summed over and appear in exactly one other operand, a dense one,
+    is contracted on its packed axis: that operand is gathered onto the unique pairs, with the permuted elements
+    subtracted, in place of the factor of 2 (or 3!) from the pairs that aren't stored. Other groups are unpacked.
+    """
+    if not any(isinstance(operand, PackedTensor) for operand in operands):
+        return subscripts, operands
+    parsed = parse_subscripts(subscripts, len(operands))
+    if parsed is None:
+        return subscripts, tuple(unpack(operand) for operand in operands)
+    inputs, output = parsed
+    operands = list(operands)
+    free = (x for x in string.ascii_letters if x not in subscripts)
+    for k, operand in enumerate(operands):
+        if not isinstance(operand, PackedTensor):
+            continue
+        labels = inputs[k]
+        direct = {}
+        for group in operand.groups:
+            group_labels = [labels[x] for x in group]
+            partners = [j for j in range(len(inputs)) if j != k and any(x in inputs[j] for x in group_labels)]
+            if (len(partners) == 1 and not isinstance(operands[partners[0]], PackedTensor)
+                    and all(labels.count(x) == 1 and inputs[partners[0]].count(x) == 1 and x not in output for x in group_labels)):
+                j = partners[0]
+                new = next(free)
+                operands[j] = _gather(np.asarray(operands[j]), tuple(inputs[j].index(x) for x in group_labels))
+                inputs[j] = new + "".join(x for x in inputs[j] if x not in group_labels)
+                direct[group[0]] = (group, new)
+        operands[k] = operand.unpack(tuple(group for group in operand.groups if group[0] not in direct))
+        new_labels, axis = "", 0
+        while axis < len(labels):
+            if axis in direct:
+                group, new = direct[axis]
+                new_labels += new
+                axis += len(group)
+            else:
+                new_labels += labels[axis]
+                axis += 1
+        inputs[k] = new_labels
+    return ",".join(inputs) + "->" + output, tuple(operands)
+
+def antisymmetric_groups(spaces: str) -> Groups:
+    """ Given the orbital spaces of a two-electron quantity, e.g. "vvvv", return the groups of axes that are antisymmetric
+    within a single space. Electron pairs spanning two spaces, like the "ov" of "ovov", can't be packed. """
+    half = len(spaces) // 2
+    groups = []
+    for start, row in [(0, spaces[:half]), (half, spaces[half:])]:
+        if len(row) > 1 and len(set(row)) == 1:
+            groups.append(tuple(range(start, start + len(row))))
+    return tuple(groups)
@@ -0,0 +1,568 @@
+"""
+Compile a method's intermediate and residual functions into a static plan of contractions.
+
+A method function (e.g. SD4V.intermed) is "glue": a straight-line chain of calls that eventually reaches
+the generated functions of a *_param module, plus resets like intermed["r2"] = 0. compile() runs the function
+once under a profiler to learn which generated functions are reached and in which order, parses every generated
+function into Contraction steps (operand keys, output key, weight, antisymmetrizer), and flattens the whole call
+tree into one list of steps. Executing the plan replays those steps directly against the intermediates dict.
+
+Replaying saves the work of the glue code and of planning each contraction, but each step is still dispatched
+from Python, one contraction at a time. Factorized generated code, a chain of pairwise np.tensordot and einsum
+steps into temporaries, is parsed into one PairwiseTerm per term.
+"""
+import ast
+import builtins
+import inspect
+import sys
+import textwrap
+import warnings
+from typing import Callable, Union
+
+import numpy as np
+from opt_einsum import contract_expression
+
+from .asym import antisymmetrize_axes_plus
+from .cholesky import FactorizedBlock
+from .packed import contract_packed
+from .symmetry import contract_blocks, is_blocked, parse_subscripts, unblock
+from .tensor import accumulate, einsum, scaling_size
+
+GENERATED_SUFFIX = "_param"
+
+
+class PlanError(Exception):
+    """ Raised when a function cannot be expressed as a static plan. """
+
+
+class Contraction:
+    """ One generated term: intermed[target] (+)= antisymmetrize(weight * einsum(subscripts, *operands)). """
+
+    def __init__(self, target: str, subscripts: str, operands: tuple[str], weight: Union[float, None], antisymmetrizer: tuple, accumulate: bool, copy: bool):
+        self.target = target
+        self.subscripts = subscripts
+        self.operands = operands
+        self.weight = weight
+        self.antisymmetrizer = antisymmetrizer
+        self.accumulate = accumulate
+        self.copy = copy
+        self.expression = None
+
+    def __repr__(self):
+        op = "+=" if self.accumulate else "="
+        return f"{self.target} {op} {self.weight} * einsum({self.subscripts!r}, {', '.join(self.operands)})"
+
+    @property
+    def reads(self) -> set[str]:
+        return set(self.operands) | ({self.target} if self.accumulate else set())
+
+    @property
+    def writes(self) -> set[str]:
+        return {self.target}
+
+    def __call__(self, intermed: dict):
+        subscripts, operands = contract_packed(self.subscripts, tuple(intermed[key] for key in self.operands))
+        operands = list(operands)
+        if self.accumulate and self.weight is not None:
+            # As in tensor.einsum_add, scale the smallest operand rather than the result.
+            k = min(range(len(operands)), key=lambda k: scaling_size(operands[k]))
+            operands[k] = self.weight * operands[k]
+        if is_blocked(operands) and parse_subscripts(subscripts, len(operands)) is not None:
+            value = contract_blocks(subscripts, *operands)
+        elif any(isinstance(operand, FactorizedBlock) for operand in operands):
+            value = einsum(subscripts, *operands)
+        else:
+            operands = [unblock(operand) for operand in operands]
+            if self.expression is None:
+                # Plan the contraction the first time it runs. The shapes are fixed for the life of the plan.
+                self.expression = contract_expression(subscripts, *(np.shape(operand) for operand in operands))
+            value = self.expression(*operands)
+        if self.accumulate:
+            intermed[self.target] = accumulate(intermed[self.target], value, self.antisymmetrizer)
+            return
+        if self.weight is not None:
+            value = self.weight * value
+        if self.copy:
+            value = value.copy()
+        if self.antisymmetrizer:
+            value = antisymmetrize_axes_plus(value, *self.antisymmetrizer)
+        intermed[self.target] = value
+
+
+class PairwiseTerm:
+    """ One factorized generated term: a chain of pairwise contractions into temporaries, whose last result is scaled,
+    transposed and added into intermed[target]. Each step is ("tensordot", name, operands, axes) or
+    ("einsum", name, operands, subscripts), where an operand is the name of an earlier temporary or an intermediate. """
+
+    def __init__(self, target: str, steps: list[tuple], result: str, weight: Union[float, None], permutation: Union[tuple, None], antisymmetrizer: tuple):
+        self.target = target
+        self.steps = steps
+        self.result = result
+        self.weight = weight
+        self.permutation = permutation
+        self.antisymmetrizer = antisymmetrizer
+        self.accumulate = True
+        temporaries = {name for _, name, _, _ in steps}
+        self.operands = tuple(dict.fromkeys(key for _, _, operands, _ in steps for key in operands if key not in temporaries))
+        self.expressions = {}
+
+    def __repr__(self):
+        return f"{self.target} += {self.weight} * ({' -> '.join(name for _, name, _, _ in self.steps)})"
+
+    @property
+    def reads(self) -> set[str]:
+        return set(self.operands) | {self.target}
+
+    @property
+    def writes(self) -> set[str]:
+        return {self.target}
+
+    def __call__(self, intermed: dict):
+        temporaries = {}
+        for kind, name, operands, argument in self.steps:
+            operands = [unblock(temporaries[key] if key in temporaries else intermed[key]) for key in operands]
+            if kind == "tensordot":
+                # A FactorizedBlock is built here, as np.tensordot can't contract through its vectors.
+                temporaries[name] = np.tensordot(*operands, axes=argument)
+                continue
+            if any(isinstance(operand, FactorizedBlock) for operand in operands):
+                temporaries[name] = einsum(argument, *operands)
+                continue
+            subscripts, operands = contract_packed(argument, tuple(operands))
+            if name not in self.expressions:
+                self.expressions[name] = contract_expression(subscripts, *(np.shape(operand) for operand in operands))
+            temporaries[name] = self.expressions[name](*operands)
+        value = temporaries[self.result]
+        if self.weight is not None:
+            value = self.weight * value
+        if self.permutation is not None:
+            value = value.transpose(self.permutation)
+        intermed[self.target] = accumulate(intermed[self.target], value, self.antisymmetrizer)
+
+
+class SetConstant:
+    """ A reset made by the glue code, e.g. intermed["r2"] = 0. """
+
+    def __init__(self, target: str, value):
+        self.target = target
+        self.value = value
+
+    def __repr__(self):
+        return f"{self.target} = {self.value!r}"
+
+    reads = frozenset()
+
+    @property
+    def writes(self) -> set[str]:
+        return {self.target}
+
+    def __call__(self, intermed: dict):
+        intermed[self.target] = self.value
+
+
+class FixedTerm:
+    """ A generated term whose operands don't change between calls, like r2 += 2 * g_oovv while the integrals
+    are fixed. It is contracted the first time it runs, and its value is added from then on. """
+
+    def __init__(self, contraction: Contraction):
+        self.contraction = contraction
+        self.value = None
+
+    def __repr__(self):
+        return f"{self.contraction!r} (fixed)"
+
+    @property
+    def reads(self) -> set[str]:
+        return self.contraction.reads
+
+    @property
+    def writes(self) -> set[str]:
+        return self.contraction.writes
+
+    def __call__(self, intermed: dict):
+        target = self.contraction.target
+        if self.value is None:
+            scratch = {key: intermed[key] for key in self.contraction.operands}
+            scratch[target] = 0
+            self.contraction(scratch)
+            self.value = scratch[target]
+        intermed[target] = accumulate(intermed[target], self.value)
+
+
+class Statement:
+    """ An opaque statement that never reaches generated code, e.g. a call to zero_rdms or rdm_construct.
+    It is re-evaluated with the arguments seen when the plan was traced. Its reads are unknown, and so are its
+    writes, unless it calls a function that declares them. See declare_writes. """
+
+    def __init__(self, source: str, code, global_vars: dict, local_vars: dict, writes: Union[set[str], None] = None):
+        self.source = source
+        self.code = code
+        self.globals = global_vars
+        self.locals = local_vars
+        self.writes = writes
+
+    def __repr__(self):
+        return self.source
+
+    reads = None
+
+    def __call__(self, intermed: dict):
+        local_vars = {key: (intermed if value is _INTERMED else value) for key, value in self.locals.items()}
+        eval(self.code, self.globals, local_vars)
+
+
+class Plan:
+    """ A flat list of steps that reproduces one call of the traced function. """
+
+    def __init__(self, steps: list):
+        self.steps = steps
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __iter__(self):
+        return iter(self.steps)
+
+    @property
+    def contractions(self) -> list[Union[Contraction, PairwiseTerm]]:
+        return [step for step in self.steps if isinstance(step, (Contraction, PairwiseTerm))]
+
+    def __call__(self, intermed: dict):
+        for step in self.steps:
+            step(intermed)
+
+    def hoist(self, fixed: Callable[[str], bool]) -> "Plan":
+        """ Return the plan with every term added from operands that are all fixed, and not written earlier in
+        the plan, made a FixedTerm. fixed(key) says if the caller keeps a key the same between calls, like the
+        integrals of a solver that never rotates the orbitals. A Statement of unknown writes may write anything,
+        so nothing after one is hoisted. """
+        steps = []
+        written = set()
+        for step in self.steps:
+            if (written is not None and isinstance(step, (Contraction, PairwiseTerm)) and step.accumulate
+                    and not written & set(step.operands) and all(fixed(key) for key in step.operands)):
+                step = FixedTerm(step)
+            if written is not None:
+                # A statement may write anything, so no later term is known to be fixed.
+                written = None if step.writes is None else written | step.writes
+            steps.append(step)
+        return Plan(steps)
+
+
+class CompiledFunction:
+    """ Drop-in replacement for a method function. The first call traces the function and builds the plan;
+    every later call executes the plan. Functions that can't be planned are called as they are, with a warning.
+    If fixed is given, the terms of keys it accepts are contracted once. See Plan.hoist. """
+
+    def __init__(self, function: Callable, fixed: Union[Callable[[str], bool], None] = None):
+        self.function = function
+        self.fixed = fixed
+        self.plan = None
+
+    def __call__(self, intermed: dict):
+        if self.plan is None:
+            try:
+                self.plan = compile(self.function, intermed)
+                if self.fixed is not None:
+                    self.plan = self.plan.hoist(self.fixed)
+            except PlanError as error:
+                # Code the planner can't parse, e.g. glue that branches. The trace already did this call's work.
+                name = getattr(self.function, "__qualname__", repr(self.function))
+                warnings.warn(f"Cannot compile {name}, so it runs uncompiled: {error}", stacklevel=2)
+                self.plan = self.function
+        else:
+            self.plan(intermed)
+
+
+def compile(function: Callable, intermed: dict) -> Plan:
+    """ Call function(intermed) once, recording the work it does as a Plan.
+
+    The call has its usual side effects on intermed, so the trace doubles as the first evaluation. """
+    tracer = _Tracer()
+    # Restore any profiler or coverage tool that was running before the trace.
+    previous = sys.getprofile()
+    sys.setprofile(tracer)
+    try:
+        function(intermed)
+    finally:
+        sys.setprofile(previous)
+    root, = tracer.root.children
+    return Plan(_compile_node(root, intermed))
+
+
+#################
+## Tracing
+#################
+
+class _Node:
+    """ One Python-level call seen while tracing. """
+
+    def __init__(self, frame, generated: bool):
+        self.code = frame.f_code
+        self.globals = frame.f_globals
+        self.locals = dict(frame.f_locals)
+        self.line = frame.f_back.f_lineno if frame.f_back is not None else None
+        self.generated = generated
+        self.reaches_generated = generated
+        self.children = []
+        self.depth = 0 # Calls below a generated function are not recorded.
+
+
+class _Root:
+
+    def __init__(self):
+        self.children = []
+        self.generated = False
+        self.reaches_generated = False
+        self.depth = 0
+
+
+class _Tracer:
+
+    def __init__(self):
+        self.root = _Root()
+        self.stack = [self.root]
+
+    def __call__(self, frame, event, arg):
+        top = self.stack[-1]
+        if event == "call":
+            if top.generated:
+                top.depth += 1
+                return
+            node = _Node(frame, frame.f_globals.get("__name__", "").endswith(GENERATED_SUFFIX))
+            top.children.append(node)
+            self.stack.append(node)
+        elif event == "return":
+            if top.depth:
+                top.depth -= 1
+                return
+            self.stack.pop()
+            if top.reaches_generated:
+                self.stack[-1].reaches_generated = True
+
+
+#################
+## Compilation
+#################
+
+_INTERMED = object() # Placeholder for the intermediates dict inside recorded locals.
+_generated_cache = {}
+_declared_writes = {}
+
+def declare_writes(writes: Callable[..., set[str]]):
+    """ Decorate a glue function that doesn't reach generated code, like zero_blocks, with a function of the same
+    arguments that returns the keys a call writes. Plan.hoist can then look past calls to it. """
+    def decorator(function: Callable) -> Callable:
+        _declared_writes[function] = writes
+        return function
+    return decorator
+
+def _statement_writes(call: ast.Call, global_vars: dict, local_vars: dict) -> Union[set[str], None]:
+    """ Return the keys a traced call writes, if the function it calls declares them. Otherwise, None. """
+    function = eval(builtins.compile(ast.Expression(call.func), "<plan>", "eval"), global_vars, local_vars)
+    try:
+        writes = _declared_writes.get(function)
+    except TypeError: # Unhashable callables declare nothing.
+        return None
+    if writes is None:
+        return None
+    call = ast.fix_missing_locations(ast.Expression(ast.Call(ast.Name("_writes", ast.Load()), call.args, call.keywords)))
+    return set(eval(builtins.compile(call, "<plan>", "eval"), global_vars, {**local_vars, "_writes": writes}))
+
+def _compile_node(node: _Node, intermed: dict) -> list:
+    if node.generated:
+        return _compile_generated(node)
+    tree = _function_ast(node.code)
+    argument = tree.args.args[0].arg if tree.args.args else None
+    local_vars = {key: (_INTERMED if value is intermed else value) for key, value in node.locals.items()}
+    steps = []
+    for statement in tree.body:
+        if isinstance(statement, ast.Pass) or _is_docstring(statement):
+            continue
+        if isinstance(statement, ast.Assign) and len(statement.targets) == 1:
+            key = _intermed_key(statement.targets[0], argument)
+            if key is None or local_vars.get(argument) is not _INTERMED:
+                raise PlanError(f"Cannot compile assignment {ast.unparse(statement)}")
+            steps.append(SetConstant(key, _constant(statement.value)))
+        elif isinstance(statement, (ast.Expr, ast.Return)) and isinstance(statement.value, ast.Call):
+            first = statement.lineno + node.code.co_firstlineno - 1
+            last = statement.end_lineno + node.code.co_firstlineno - 1
+            children = [child for child in node.children if first <= child.line <= last]
+            if not any(child.reaches_generated for child in children):
+                source = ast.unparse(statement.value)
+                code = builtins.compile(ast.Expression(statement.value), node.code.co_filename, "eval")
+                writes = _statement_writes(statement.value, node.globals, local_vars)
+                steps.append(Statement(source, code, node.globals, local_vars, writes))
+            elif len(children) == 1:
+                steps += _compile_node(children[0], intermed)
+            else:
+                raise PlanError(f"Cannot compile {ast.unparse(statement)}: several calls on one line reach generated code.")
+        else:
+            raise PlanError(f"Cannot compile {ast.unparse(statement)}: method functions must be straight-line.")
+    return steps
+
+def _compile_generated(node: _Node) -> list:
+    """ Parse a generated function into Contraction steps. Parsed functions are cached by code object. """
+    if node.code not in _generated_cache:
+        tree = _function_ast(node.code)
+        argument = tree.args.args[0].arg
+        steps = []
+        pending = None
+        pairwise = [] # The pairwise steps of a factorized term, until its result is accumulated
+        for statement in tree.body:
+            if isinstance(statement, ast.Pass):
+                continue
+            elif isinstance(statement, ast.Assign) and _is_temporary(statement.targets[0]):
+                pairwise.append(_parse_pairwise(statement, argument))
+            elif isinstance(statement, ast.Assign) and ast.unparse(statement.targets[0]) == "temp" and pairwise:
+                pending = _parse_result(statement.value, pairwise)
+                pairwise = []
+            elif isinstance(statement, ast.Assign) and ast.unparse(statement.targets[0]) == "temp":
+                pending = _parse_einsum(statement.value, argument)
+            elif isinstance(statement, ast.Assign) and _is_call(statement.value, "einsum_add"):
+                steps.append(_parse_einsum_add(statement, argument))
+            elif isinstance(statement, ast.Assign) and _is_call(statement.value, "accumulate"):
+                steps.append(_parse_accumulate(statement, argument, pending))
+                pending = None
+            elif isinstance(statement, (ast.Assign, ast.AugAssign)):
+                target = statement.targets[0] if isinstance(statement, ast.Assign) else statement.target
+                key = _intermed_key(target, argument)
+                if key is None:
+                    raise PlanError(f"Cannot compile {ast.unparse(statement)}")
+                value = statement.value
+                antisymmetrizer = ()
+                if isinstance(value, ast.Call) and ast.unparse(value.func).endswith("antisymmetrize_axes_plus"):
+                    antisymmetrizer = tuple(ast.literal_eval(x) for x in value.args[1:])
+                    value = value.args[0]
+                if isinstance(value, ast.Name) and value.id == "temp":
+                    subscripts, operands, weight, copy = pending
+                else:
+                    subscripts, operands, weight, copy = _parse_einsum(value, argument)
+                steps.append(Contraction(key, subscripts, operands, weight, antisymmetrizer, isinstance(statement, ast.AugAssign), copy))
+            else:
+                raise PlanError(f"Cannot compile {ast.unparse(statement)}")
+        _generated_cache[node.code] = steps
+    # Each plan needs its own steps, since the steps store the shapes they were planned for.
+    return [_copy_step(step) for step in _generated_cache[node.code]]
+
+def _copy_step(step: Union[Contraction, PairwiseTerm]) -> Union[Contraction, PairwiseTerm]:
+    if isinstance(step, PairwiseTerm):
+        return PairwiseTerm(step.target, step.steps, step.result, step.weight, step.permutation, step.antisymmetrizer)
+    return Contraction(step.target, step.subscripts, step.operands, step.weight, step.antisymmetrizer, step.accumulate, step.copy)
+
+def _is_temporary(node: ast.expr) -> bool:
+    """ Return whether node names a numbered temporary of factorized code, like temp1. """
+    return isinstance(node, ast.Name) and node.id.startswith("temp") and node.id[4:].isdigit()
+
+def _pairwise_operand(node: ast.expr, argument: str) -> str:
+    if _is_temporary(node):
+        return node.id
+    key = _intermed_key(node, argument)
+    if key is None:
+        raise PlanError(f"Cannot compile {ast.unparse(node)}")
+    return key
+
+def _parse_pairwise(statement: ast.Assign, argument: str) -> tuple:
+    """ Parse tempN = np.tensordot(a, b, axes=(...)) or tempN = einsum("...", a, b) into a step of a PairwiseTerm. """
+    name, call = statement.targets[0].id, statement.value
+    if _is_call(call, "tensordot"):
+        keywords = {keyword.arg: keyword.value for keyword in call.keywords}
+        axes = ast.literal_eval(keywords["axes"] if "axes" in keywords else call.args[2])
+        return ("tensordot", name, tuple(_pairwise_operand(x, argument) for x in call.args[:2]), tuple(tuple(x) for x in axes))
+    if _is_call(call, "einsum"):
+        return ("einsum", name, tuple(_pairwise_operand(x, argument) for x in call.args[1:]), ast.literal_eval(call.args[0]))
+    raise PlanError(f"Cannot compile {ast.unparse(statement)}")
+
+def _parse_result(node: ast.expr, pairwise: list[tuple]) -> tuple:
+    """ Parse temp = [weight *] tempN[.transpose(...)], the result of a factorized term. """
+    weight = None
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Mult):
+        weight = _constant(node.left)
+        node = node.right
+    permutation = None
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == "transpose":
+        permutation = tuple(ast.literal_eval(x) for x in node.args)
+        permutation = permutation[0] if len(permutation) == 1 and isinstance(permutation[0], tuple) else permutation
+        node = node.func.value
+    if not _is_temporary(node):
+        raise PlanError(f"Cannot compile temp = {ast.unparse(node)}")
+    return ("pairwise", list(pairwise), node.id, weight, permutation)
+
+def _parse_accumulate(statement: ast.Assign, argument: str, pending) -> PairwiseTerm:
+    """ Parse i["x"] = mla.accumulate(i["x"], temp[, antisymmetrizer]), the last line of a factorized term. """
+    call = statement.value
+    key = _intermed_key(statement.targets[0], argument)
+    if (key is None or _intermed_key(call.args[0], argument) != key or ast.unparse(call.args[1]) != "temp"
+            or pending is None or pending[0] != "pairwise"):
+        raise PlanError(f"Cannot compile {ast.unparse(statement)}")
+    antisymmetrizer = ast.literal_eval(call.args[2]) if len(call.args) > 2 else ()
+    _, steps, result, weight, permutation = pending
+    return PairwiseTerm(key, steps, result, weight, permutation, antisymmetrizer)
+
+def _parse_einsum_add(statement: ast.Assign, argument: str) -> Contraction:
+    """ Parse i["x"] = mla.einsum_add(i["x"], "...", i["a"], ..., weight=w, antisymmetrizer=(...)) into a Contraction. """
+    call = statement.value
+    key = _intermed_key(statement.targets[0], argument)
+    if key is None or _intermed_key(call.args[0], argument) != key:
+        raise PlanError(f"Cannot compile {ast.unparse(statement)}")
+    subscripts = ast.literal_eval(call.args[1])
+    operands = tuple(_intermed_key(x, argument) for x in call.args[2:])
+    if None in operands:
+        raise PlanError(f"Cannot compile {ast.unparse(statement)}")
+    keywords = {keyword.arg: keyword.value for keyword in call.keywords}
+    weight = _constant(keywords["weight"]) if "weight" in keywords else None
+    antisymmetrizer = ast.literal_eval(keywords["antisymmetrizer"]) if "antisymmetrizer" in keywords else ()
+    return Contraction(key, subscripts, operands, weight, antisymmetrizer, True, False)
+
+def _is_call(node: ast.expr, name: str) -> bool:
+    return isinstance(node, ast.Call) and ast.unparse(node.func).split(".")[-1] == name
+
+def _parse_einsum(node: ast.expr, argument: str) -> tuple[str, tuple[str], Union[float, None], bool]:
+    """ Parse [weight *] einsum("...", i["a"], ...)[.copy()] into its subscripts, operand keys, weight and copy flag. """
+    weight = None
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Mult):
+        weight = _constant(node.left)
+        node = node.right
+    copy = False
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == "copy":
+        copy = True
+        node = node.func.value
+    if not (isinstance(node, ast.Call) and ast.unparse(node.func).endswith("einsum")):
+        raise PlanError(f"Cannot compile {ast.unparse(node)}")
+    subscripts = ast.literal_eval(node.args[0])
+    operands = tuple(_intermed_key(x, argument) for x in node.args[1:])
+    if None in operands:
+        raise PlanError(f"Cannot compile {ast.unparse(node)}")
+    return subscripts, operands, weight, copy
+
+def _intermed_key(node: ast.expr, argument: str) -> Union[str, None]:
+    """ Return "x" if node is argument["x"], else None. """
+    if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == argument:
+        if isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, str):
+            return node.slice.value
+    return None
+
+def _constant(node: ast.expr):
+    """ Evaluate a constant arithmetic expression such as -1/2. """
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+        return node.value
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        return -_constant(node.operand)
+    elif isinstance(node, ast.BinOp) and isinstance(node.op, ast.Div):
+        return _constant(node.left) / _constant(node.right)
+    elif isinstance(node, ast.BinOp) and isinstance(node.op, ast.Mult):
+        return _constant(node.left) * _constant(node.right)
+    raise PlanError(f"{ast.unparse(node)} is not a constant.")
+
+def _function_ast(code) -> ast.FunctionDef:
+    try:
+        source = inspect.getsource(code)
+    except (OSError, TypeError):
+        raise PlanError(f"No source available for {code.co_name}.")
+    tree = ast.parse(textwrap.dedent(source)).body[0]
+    if not isinstance(tree, ast.FunctionDef):
+        raise PlanError(f"{code.co_name} is not a function definition.")
+    return tree
+
+def _is_docstring(statement: ast.stmt) -> bool:
+    return isinstance(statement, ast.Expr) and isinstance(statement.value, ast.Constant) and isinstance(statement.value.value, str)
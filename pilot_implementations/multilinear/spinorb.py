@@ -1,10 +1,13 @@
 from collections import OrderedDict
+import itertools
 from typing import Iterable
 
 import numpy as np
 import scipy.linalg as spla
 
 from . import tensor as mla
+from .cholesky import CholeskyVectors
+from .integrals import IntegralTransformer
 
 def orb_rot(intermed: dict, start_orbitals: OrderedDict[str: tuple[np.ndarray, np.ndarray]]) -> OrderedDict[str: tuple[np.ndarray, np.ndarray]]:
     """ Apply a rotation given by the t amplitudes to the orbitals, returning the new orbitals. """
@@ -38,14 +41,15 @@ def orb_rot(intermed: dict, start_orbitals: OrderedDict[str: tuple[np.ndarray, n
     return new_orbitals
 
 def orb_rot_SI(intermed: dict, start_orbitals: OrderedDict[str: tuple[np.ndarray, np.ndarray]]) -> OrderedDict[str: tuple[np.ndarray, np.ndarray]]:
-    """ Apply a rotation given by the t amplitudes to the orbitals, returning the new orbitals. """
+    """ Apply a rotation given by the t amplitudes to the orbitals, returning the new orbitals.
+    Only the occupied and virtual orbitals rotate. Frozen spaces are returned as they are. """
     noa, nva = intermed["t1_ov_α"].shape
     Zoa = np.zeros((noa, noa)) 
     Zva = np.zeros((nva, nva))
     Xa = np.block([[Zoa, -intermed["t1_ov_α"]],
                   [intermed["t1_ov_α"].T, Zva]])
     U = spla.expm(np.block(Xa))
-    reassembled_C = np.hstack( tuple(i[0] for i in start_orbitals.values()))
+    reassembled_C = np.hstack((start_orbitals["o"][0], start_orbitals["v"][0]))
     new_Ca = reassembled_C @ U
 
     nob, nvb = intermed["t1_ov_β"].shape
@@ -54,10 +58,10 @@ def orb_rot_SI(intermed: dict, start_orbitals: OrderedDict[str: tuple[np.ndarray
     Xb = np.block([[Zob, -intermed["t1_ov_β"]],
                   [intermed["t1_ov_β"].T, Zvb]])
     U = spla.expm(np.block(Xb))
-    reassembled_C = np.hstack( tuple(i[1] for i in start_orbitals.values()))
+    reassembled_C = np.hstack((start_orbitals["o"][1], start_orbitals["v"][1]))
     new_Cb = reassembled_C @ U
 
-    new_orbitals = OrderedDict()
+    new_orbitals = OrderedDict(start_orbitals)
     new_Coa, new_Cva = np.hsplit(new_Ca, [noa])
     new_Cob, new_Cvb = np.hsplit(new_Cb, [nob])
     new_orbitals["o"] = (new_Coa, new_Cob)
@@ -65,6 +69,24 @@ def orb_rot_SI(intermed: dict, start_orbitals: OrderedDict[str: tuple[np.ndarray
 
     return new_orbitals
 
+def freeze(orbitals: OrderedDict[str: tuple[np.ndarray, np.ndarray]], num_core: int = 0, num_virtual: int = 0) -> OrderedDict[str: tuple[np.ndarray, np.ndarray]]:
+    """ Move the lowest num_core occupied orbitals of each spin into the frozen core, "c", and the highest
+    num_virtual virtual orbitals of each spin into the frozen virtuals, "w". Orbitals are ordered by energy.
+    Frozen orbitals are never correlated or rotated, so the amplitudes and integrals span only "o" and "v".
+    For gradients, their response to a perturbation is solved for in math_util.solvers.spinorbital.proc.backtransform_frozen. """
+    def merge(space, matrices):
+        old = orbitals.get(space, tuple(np.zeros((matrix.shape[0], 0)) for matrix in matrices))
+        return tuple(np.hstack((a, b) if space == "c" else (b, a)) for a, b in zip(old, matrices))
+    occupied, virtual = orbitals["o"], orbitals["v"]
+    if any(num_core > x.shape[1] for x in occupied) or any(num_virtual > x.shape[1] for x in virtual):
+        raise ValueError("Cannot freeze more orbitals than there are.")
+    new_orbitals = OrderedDict()
+    new_orbitals["c"] = merge("c", tuple(x[:, :num_core] for x in occupied))
+    new_orbitals["o"] = tuple(x[:, num_core:] for x in occupied)
+    new_orbitals["v"] = tuple(x[:, :x.shape[1] - num_virtual] for x in virtual)
+    new_orbitals["w"] = merge("w", tuple(x[:, x.shape[1] - num_virtual:] for x in virtual))
+    return new_orbitals
+
 
 def antisym_subspace(tensor: np.ndarray, integral_transformers: tuple[tuple[np.ndarray, np.ndarray]]) -> np.ndarray:
     """ Transform each index of the tensor into the corresponding subspaces, and then antisymmetrize.. """
@@ -84,7 +106,16 @@ def antisym_subspace(tensor: np.ndarray, integral_transformers: tuple[tuple[np.n
 
 
 def request_asym(integral: np.ndarray, space_dict, strings: Iterable[str]) -> dict[str, np.ndarray]:
-    """ Construct and return a dictionary with the intrgrals transformed in the various spaces."""
+    """ Construct and return a dictionary with the intrgrals transformed in the various spaces.
+    The integral may also be CholeskyVectors, for two-electron strings."""
+    strings = list(strings)
+    if isinstance(integral, CholeskyVectors):
+        one_electron = [string for string in strings if len(string) != 4]
+        if one_electron:
+            raise ValueError(f"Cholesky vectors only give two-electron integrals, not the blocks {', '.join(one_electron)}.")
+        transformer = IntegralTransformer(None, integral)
+        transformer.update(space_dict)
+        return transformer.request_asym(strings)
     integral_dict = {}
     for string in strings:
         integral_dict["".join(string)] = antisym_subspace(integral, [space_dict[i] for i in string])
@@ -109,6 +140,27 @@ def mso_to_aso(tensor: np.ndarray, subspaces: tuple[tuple[np.ndarray, np.ndarray
 
     return tensor
 
+def mso_to_spatial(tensor: np.ndarray, subspaces: tuple[tuple[np.ndarray, np.ndarray]], electron_indices: tuple[tuple[int]]) -> np.ndarray:
+    """ Given a tensor in spin orbitals, all alpha before all beta in each space, and the alpha and beta
+    transforms of each index, back-transform to spatial AOs and sum over spin. The indices in each pair of
+    electron_indices share a spin. Unlike mso_to_aso, the spin orbital AO tensor is never built.
+    """
+    result = 0
+    for spins in itertools.product(range(2), repeat=len(electron_indices)):
+        selection = [None] * tensor.ndim
+        matrices = [None] * tensor.ndim
+        for spin, electron in zip(spins, electron_indices):
+            for axis in electron:
+                alpha, beta = subspaces[axis]
+                num_alpha = alpha.shape[1]
+                selection[axis] = slice(None, num_alpha) if spin == 0 else slice(num_alpha, None)
+                matrices[axis] = (alpha, beta)[spin]
+        block = tensor[tuple(selection)]
+        for axis, matrix in enumerate(matrices):
+            block = mla.one_index_transform(block, axis, matrix.T)
+        result = result + block
+    return result
+
 def spatial_subspace(tensor: np.ndarray, subspaces: tuple[tuple[np.ndarray, np.ndarray]]) -> np.ndarray:
     """
     Transform each index of the tensor into the corresponding subspaces.
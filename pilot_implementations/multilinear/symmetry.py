@@ -0,0 +1,262 @@
+"""
+Storage for tensors of molecules with abelian point-group symmetry, like t2 or g_oovv.
+
+Every orbital belongs to an irrep. Irreps are numbered so that the direct product of two irreps is their bitwise
+XOR, as in the usual ordering for D2h and its subgroups. An element of a totally symmetric tensor vanishes unless
+the product of the irreps of its indices is the totally symmetric irrep, 0, so only those blocks are stored,
+and a contraction only visits the block combinations that can be nonzero.
+"""
+from __future__ import annotations
+from functools import reduce
+import itertools
+from numbers import Number
+import operator
+import re
+from typing import Union
+
+import numpy as np
+from opt_einsum import contract_expression
+
+Irreps = tuple[np.ndarray, ...] # The irrep of each index, for each axis
+BlockKey = tuple[int, ...] # The irrep of each axis of one block
+
+_expressions = {} # Contraction paths of block products, by subscripts and shapes
+_BLOCKED_UFUNCS = {np.add, np.subtract, np.multiply, np.divide} # Arithmetic with a dense array that keeps the blocks
+
+
+def direct_product(*irreps: int) -> int:
+    return reduce(operator.xor, irreps, 0)
+
+def allowed_keys(irreps: Irreps) -> list[BlockKey]:
+    """ The blocks of a totally symmetric tensor that can be nonzero. Irreps absent along an axis give no block. """
+    present = [np.unique(axis).tolist() for axis in irreps]
+    return [key for key in itertools.product(*present) if direct_product(*key) == 0]
+
+
+class IrrepTensor:
+    """ A totally symmetric tensor, stored as its symmetry-allowed blocks. blocks[(Γ0, Γ1, ...)] holds the elements
+    whose index along axis k has irrep Γk. Dense arrays combined with the tensor lose their symmetry-forbidden elements.
+    Converting to a numpy array (np.asarray, or any einsum from multilinear.tensor with a dense operand) unpacks the tensor.
+    So does arithmetic in place on a dense array, e.g. array += IrrepTensor, which keeps the array. """
+
+    def __array_ufunc__(self, ufunc, method, *inputs, out=None, **kwargs):
+        if method != "__call__":
+            return NotImplemented
+        if out is not None:
+            # In place on a dense array, like grad += einsum(...) of blocked operands. The array stays dense.
+            if any(isinstance(x, IrrepTensor) for x in out):
+                return NotImplemented
+            return ufunc(*(unblock(x) for x in inputs), out=out, **kwargs)
+        if len(inputs) == 2 and not kwargs and ufunc in _BLOCKED_UFUNCS:
+            # Mixed arithmetic, e.g. array + IrrepTensor, is done block by block.
+            if inputs[0] is self:
+                return self._map(ufunc, inputs[1])
+            return self._map(lambda x, y: ufunc(y, x), inputs[0])
+        return ufunc(*(unblock(x) for x in inputs), **kwargs)
+
+    def __init__(self, blocks: dict[BlockKey, np.ndarray], irreps: Irreps):
+        self.blocks = blocks
+        self.irreps = tuple(np.asarray(axis) for axis in irreps)
+        self.positions = [{irrep: np.flatnonzero(axis == irrep) for irrep in np.unique(axis).tolist()} for axis in self.irreps]
+
+    def index(self, key: BlockKey) -> tuple[np.ndarray, ...]:
+        """ Return the open mesh that selects a block from the dense tensor. """
+        return np.ix_(*(positions[irrep] for positions, irrep in zip(self.positions, key)))
+
+    @classmethod
+    def from_dense(cls, array: np.ndarray, irreps: Irreps) -> IrrepTensor:
+        """ Block an array. Symmetry-forbidden elements are dropped, not checked. """
+        array = np.asarray(array)
+        tensor = cls({}, irreps)
+        tensor.blocks = {key: array[tensor.index(key)] for key in allowed_keys(tensor.irreps)}
+        return tensor
+
+    @classmethod
+    def zeros(cls, irreps: Irreps, dtype=float) -> IrrepTensor:
+        tensor = cls({}, irreps)
+        tensor.blocks = {key: np.zeros(tuple(len(tensor.positions[k][irrep]) for k, irrep in enumerate(key)), dtype=dtype) for key in allowed_keys(tensor.irreps)}
+        return tensor
+
+    def unpack(self) -> np.ndarray:
+        """ Return the dense array. """
+        dense = np.zeros(self.shape, dtype=self.dtype)
+        for key, block in self.blocks.items():
+            dense[self.index(key)] = block
+        return dense
+
+    def __array__(self, dtype=None, copy=None):
+        dense = self.unpack()
+        return dense if dtype is None else dense.astype(dtype)
+
+    @property
+    def shape(self) -> tuple[int, ...]:
+        return tuple(len(axis) for axis in self.irreps)
+
+    @property
+    def ndim(self) -> int:
+        return len(self.irreps)
+
+    @property
+    def dtype(self):
+        return np.result_type(*self.blocks.values()) if self.blocks else np.dtype(float)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(block.nbytes for block in self.blocks.values())
+
+    def copy(self) -> IrrepTensor:
+        return IrrepTensor({key: block.copy() for key, block in self.blocks.items()}, self.irreps)
+
+    def transpose(self, *axes) -> IrrepTensor:
+        axes = axes[0] if len(axes) == 1 and not isinstance(axes[0], int) else axes
+        return IrrepTensor({tuple(key[x] for x in axes): block.transpose(axes) for key, block in self.blocks.items()},
+                tuple(self.irreps[x] for x in axes))
+
+    def swapaxes(self, axis1: int, axis2: int) -> IrrepTensor:
+        axes = list(range(self.ndim))
+        axes[axis1], axes[axis2] = axes[axis2], axes[axis1]
+        return self.transpose(axes)
+
+    def _other_block(self, other: Union[IrrepTensor, np.ndarray, Number], key: BlockKey):
+        """ Return the part of other that combines with the block key of this tensor. """
+        if isinstance(other, IrrepTensor):
+            return other.blocks[key]
+        if np.ndim(other) == 0:
+            return other
+        if np.shape(other) != self.shape:
+            raise ValueError(f"Cannot combine shape {np.shape(other)} with an IrrepTensor of shape {self.shape}.")
+        return np.asarray(other)[self.index(key)]
+
+    def _map(self, function, other) -> IrrepTensor:
+        return IrrepTensor({key: function(block, self._other_block(other, key)) for key, block in self.blocks.items()}, self.irreps)
+
+    def _update(self, function, other) -> IrrepTensor:
+        for key, block in self.blocks.items():
+            function(block, self._other_block(other, key), out=block)
+        return self
+
+    def __add__(self, other):
+        return self._map(np.add, other)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return self._map(np.subtract, other)
+
+    def __rsub__(self, other):
+        return self._map(lambda x, y: y - x, other)
+
+    def __mul__(self, other):
+        return self._map(np.multiply, other)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        return self._map(np.divide, other)
+
+    def __iadd__(self, other):
+        return self._update(np.add, other)
+
+    def __isub__(self, other):
+        return self._update(np.subtract, other)
+
+    def __imul__(self, other):
+        return self._update(np.multiply, other)
+
+    def __itruediv__(self, other):
+        return self._update(np.divide, other)
+
+    def __neg__(self):
+        return IrrepTensor({key: -block for key, block in self.blocks.items()}, self.irreps)
+
+    def vdot(self, other: Union[IrrepTensor, np.ndarray]) -> float:
+        """ Full contraction with a tensor of the same shape, without unpacking. """
+        return sum(np.vdot(block, self._other_block(other, key)) for key, block in self.blocks.items())
+
+    def norm(self) -> float:
+        """ Frobenius norm of the dense tensor. """
+        return np.sqrt(sum(np.vdot(block, block) for block in self.blocks.values()))
+
+
+def parse_subscripts(subscripts: str, num_operands: int) -> Union[tuple[list[str], str], None]:
+    """ Split einsum subscripts, which may contain spaces, into the operand and output strings.
+    Return None for subscripts a blocked contraction can't follow: ellipses, or an implicit output that isn't a scalar. """
+    subscripts = subscripts.replace(" ", "")
+    if "." in subscripts:
+        return None
+    if "->" in subscripts:
+        inputs, output = subscripts.split("->")
+    else:
+        inputs, output = subscripts, ""
+        if any(inputs.count(x) == 1 for x in set(inputs) - {","}):
+            return None
+    inputs = inputs.split(",")
+    return (inputs, output) if len(inputs) == num_operands else None
+
+def contract_blocks(subscripts: str, *operands: IrrepTensor) -> Union[IrrepTensor, float]:
+    """
+    Evaluate einsum(subscripts, *operands) one block at a time, visiting only the combinations of blocks that agree
+    on the irrep of every shared index. Return an IrrepTensor, or a number for a full contraction.
+    """
+    inputs, output = parse_subscripts(subscripts, len(operands))
+    block_subscripts = ",".join(inputs) + "->" + output
+    results = {}
+
+    def visit(k: int, assignment: dict[str, int], blocks: list[np.ndarray]):
+        if k == len(operands):
+            key = tuple(assignment[x] for x in output)
+            shapes = tuple(block.shape for block in blocks)
+            if (block_subscripts, shapes) not in _expressions:
+                _expressions[(block_subscripts, shapes)] = contract_expression(block_subscripts, *shapes)
+            value = _expressions[(block_subscripts, shapes)](*blocks)
+            results[key] = results[key] + value if key in results else value
+            return
+        for key, block in operands[k].blocks.items():
+            new_assignment = dict(assignment)
+            if all(new_assignment.setdefault(x, irrep) == irrep for x, irrep in zip(inputs[k], key)):
+                visit(k + 1, new_assignment, blocks + [block])
+
+    visit(0, {}, [])
+    if not output:
+        return results.get((), 0.0)
+    # The irreps of each output index, from the first operand carrying it.
+    irreps = []
+    for x in output:
+        k = next(k for k, operand in enumerate(inputs) if x in operand)
+        irreps.append(operands[k].irreps[inputs[k].index(x)])
+    tensor = IrrepTensor.zeros(irreps, np.result_type(*(operand.dtype for operand in operands)))
+    for key, value in results.items():
+        tensor.blocks[key] += value
+    return tensor
+
+def is_blocked(operands) -> bool:
+    """ Can a contraction over these operands be done block by block? """
+    return bool(operands) and all(isinstance(operand, IrrepTensor) for operand in operands)
+
+def unblock(tensor: Union[IrrepTensor, np.ndarray]) -> np.ndarray:
+    """ Return a dense array, whether or not the tensor was blocked. """
+    return tensor.unpack() if isinstance(tensor, IrrepTensor) else tensor
+
+def key_irreps(key: str, irreps: dict[str, tuple[np.ndarray, np.ndarray]]) -> Irreps:
+    """
+    Return the irreps of each axis of an intermediate, given the irreps of the alpha and beta orbitals of each space.
+    Unrestricted keys, like g_oovv_αβ or t2_αβ, have spatial axes. Other keys, like g_oovv, t2 or t1ov, have spin orbital
+    axes, all alpha orbitals of a space before all beta orbitals. Amplitudes like t2 have the occupied axes first.
+    """
+    parts = key.split("_")
+    spins = parts[-1] if len(parts) > 1 and not set(parts[-1]) - {"α", "β"} else None
+    spaces = parts[1] if len(parts) > 1 and parts[1] and not set(parts[1]) - {"o", "v"} else None
+    if spaces is None:
+        rank = int(re.match(r"t(\d+)", parts[0]).group(1))
+        spaces = "o" * rank + "v" * rank
+    if spins is None:
+        return tuple(np.concatenate(irreps[space]) for space in spaces)
+    return tuple(irreps[space]["αβ".index(spin)] for space, spin in zip(spaces, spins * 2))
+
+def block_amplitudes(intermediates: dict, irreps: dict[str, tuple[np.ndarray, np.ndarray]]):
+    """ Store the amplitudes of rank two and up, like t2 or t2_αβ, as IrrepTensors.
+    Rank one amplitudes rotate the orbitals and stay dense. """
+    for key, value in list(intermediates.items()):
+        match = re.fullmatch(r"t(\d+)(_[αβ]+)?", key)
+        if match and int(match.group(1)) > 1:
+            intermediates[key] = IrrepTensor.from_dense(value, key_irreps(key, irreps))
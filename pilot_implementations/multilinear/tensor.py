@@ -1,7 +1,117 @@
+from collections import OrderedDict, namedtuple
+
 import numpy as np
-from opt_einsum import contract
+from opt_einsum import contract, contract_expression
+
+from .asym import antisymmetrize_axes_plus, row_permutations
+from .cholesky import FactorizedBlock, expand_factorized
+from .packed import contract_packed
+from .symmetry import contract_blocks, is_blocked, parse_subscripts, unblock
+
+PathCacheInfo = namedtuple("PathCacheInfo", ["hits", "misses", "currsize"])
+
+# The most contraction paths kept. A method uses a few hundred, and a scan or a frozen-core sweep adds more
+# for each new set of space sizes, so the least recently used are dropped past this.
+PATH_CACHE_SIZE = 1024
+
+_expressions = OrderedDict()
+_path_cache_counts = {"hits": 0, "misses": 0}
+
+def einsum(subscripts: str, *operands, **kwargs):
+    """
+    Evaluate a contraction with opt_einsum, planning the contraction path only once.
+
+    The planned contraction is cached on the subscripts and the shapes and dtypes of the operands,
+    so repeated calls (every iteration of a solver) replay the stored path instead of searching again.
+    Only the PATH_CACHE_SIZE most recently used paths are kept.
+    Keyword arguments are forwarded to opt_einsum.contract and bypass the cache.
+    Packed operands are contracted on their packed axes where possible, and unpacked otherwise. See packed.contract_packed.
+    If every operand is an IrrepTensor, the contraction
+    is done block by block. Otherwise, blocked operands are unpacked.
+    A FactorizedBlock operand is contracted through its Cholesky vectors. See cholesky.expand_factorized.
+    """
+    if any(isinstance(operand, FactorizedBlock) for operand in operands):
+        expanded = expand_factorized(subscripts, operands)
+        if expanded is not None:
+            result = 0
+            for weight, term_subscripts, term_operands in expanded:
+                result = result + weight * einsum(term_subscripts, *term_operands, **kwargs)
+            return result
+        operands = tuple(np.asarray(operand) if isinstance(operand, FactorizedBlock) else operand for operand in operands)
+    subscripts, operands = contract_packed(subscripts, operands)
+    if is_blocked(operands) and not kwargs and parse_subscripts(subscripts, len(operands)) is not None:
+        return contract_blocks(subscripts, *operands)
+    operands = tuple(unblock(operand) for operand in operands)
+    if kwargs:
+        return contract(subscripts, *operands, **kwargs)
+    key = (subscripts,) + tuple((np.shape(operand), np.result_type(operand)) for operand in operands)
+    try:
+        expression = _expressions[key]
+    except KeyError:
+        _path_cache_counts["misses"] += 1
+        expression = contract_expression(subscripts, *(np.shape(operand) for operand in operands))
+        _expressions[key] = expression
+        if len(_expressions) > PATH_CACHE_SIZE:
+            _expressions.popitem(last=False)
+    else:
+        _path_cache_counts["hits"] += 1
+        _expressions.move_to_end(key)
+    return expression(*operands)
+
+def einsum_add(target, subscripts: str, *operands, weight=1, antisymmetrizer: tuple = ()):
+    """
+    Return target + weight * einsum(subscripts, *operands), antisymmetrized like antisymmetrize_axes_plus.
+    This is the form of a generated term: i["r2"] = mla.einsum_add(i["r2"], "...", i["g_oovv"], i["t2"], weight=-1/2).
+    The weight scales the smallest operand instead of the result, and the result is added into an array target
+    in place, so the result of the contraction is the only tensor of the target's size that is written.
+    """
+    # Rewrite packed operands first, so the weight doesn't scale a copy of one.
+    subscripts, operands = contract_packed(subscripts, operands)
+    if weight != 1:
+        k = min(range(len(operands)), key=lambda k: scaling_size(operands[k]))
+        operands = operands[:k] + (weight * operands[k],) + operands[k + 1:]
+    return accumulate(target, einsum(subscripts, *operands), antisymmetrizer)
+
+def scaling_size(operand) -> int:
+    """ Return the number of stored values that scaling operand writes: none for a scalar or a FactorizedBlock,
+    whose term weights are scaled instead, and otherwise the stored elements, e.g. only the unique ones of a
+    PackedTensor or the allowed blocks of an IrrepTensor. """
+    if isinstance(operand, FactorizedBlock) or np.ndim(operand) == 0:
+        return 0
+    return operand.nbytes // operand.dtype.itemsize
+
+def accumulate(target, value, antisymmetrizer: tuple = ()):
+    """
+    Return target + value, antisymmetrized like antisymmetrize_axes_plus(value, *antisymmetrizer).
+    An array target is added to in place, and the terms of the last antisymmetrizer are added to it one by one,
+    without a buffer for them. Other targets, like the 0 an intermediate is reset to or a read-only view,
+    are added to out of place.
+    """
+    if not (isinstance(target, np.ndarray) and isinstance(value, np.ndarray) and target.shape == value.shape
+            and np.result_type(target, value) == target.dtype and target.flags.writeable):
+        if antisymmetrizer:
+            value = antisymmetrize_axes_plus(value, *antisymmetrizer)
+        return target + value
+    if not antisymmetrizer:
+        target += value
+        return target
+    if len(antisymmetrizer) > 1:
+        value = antisymmetrize_axes_plus(value, *antisymmetrizer[:-1])
+    for axes, parity in row_permutations(tuple(tuple(block) for block in antisymmetrizer[-1]), value.ndim):
+        if parity == 1:
+            target += value.transpose(axes)
+        else:
+            target -= value.transpose(axes)
+    return target
+
+def path_cache_info() -> PathCacheInfo:
+    """ Return the hit and miss counts of the contraction path cache, and the number of stored paths. """
+    return PathCacheInfo(_path_cache_counts["hits"], _path_cache_counts["misses"], len(_expressions))
 
-einsum = contract
+def clear_path_cache():
+    """ Forget all planned contraction paths and reset the counters. Useful between molecules. """
+    _expressions.clear()
+    _path_cache_counts["hits"] = _path_cache_counts["misses"] = 0
 
 def contra_transform(tensor: np.ndarray, matrix: np.ndarray, exclude: set[int] =set()) -> np.ndarray:
     """
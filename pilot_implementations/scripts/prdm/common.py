@@ -3,9 +3,14 @@ from pilot_implementations import multilinear as mla
 from pilot_implementations.math_util.convergence import DirectSumDiis
 import numpy as np
 import re
+from functools import wraps
 from math import factorial
 import collections as col
 
+# The minimum and maximum number of vectors DIIS extrapolates with. The solvers' diis_directory option
+# keeps the vectors on disk instead of in memory.
+DIIS_SUBSPACE = (3, 9)
+
 def simultaneous_step(inter, diagonal_dict):
     # Identify all strings with a t.
     strings = [key[1:] for key in inter if key.startswith("t")]
@@ -40,24 +45,215 @@ def simultaneous_step_SI(inter, diagonal_dict):
         inter[f"t{string}"] = t
 
 
+def stored_keys(inter, keys) -> list:
+    """ Return the keys of the blocks inter stores, in order and once each. ClosedShellIntermediates store one
+    block of each pair related by flipping all spins, so a flipped key is replaced by the key of its stored block. """
+    if isinstance(inter, mla.ClosedShellIntermediates):
+        keys = (mla.integrals.closed_shell_key(key)[0] for key in keys)
+    return list(dict.fromkeys(keys))
+
+def stores(inter, key) -> bool:
+    """ Whether inter stores the block key, rather than reading it from its spin flip. See stored_keys. """
+    return stored_keys(inter, [key]) == [key]
+
+@mla.plan.declare_writes(lambda inter, *keys: set(stored_keys(inter, keys)))
+def zero_blocks(inter, *keys):
+    """ Reset intermediates, like RDM blocks or residuals, to zero before they're accumulated into.
+    An array left by the last iteration is zeroed in place, so the generated code accumulates into it again,
+    and each block is allocated once, by the first iteration. Either way the key is written, so a tracking
+    container sees the reset. Of a closed-shell reference, only the stored blocks are reset. See stored_keys. """
+    for key in stored_keys(inter, keys):
+        value = inter.get(key)
+        if isinstance(value, np.ndarray):
+            value.fill(0)
+        elif hasattr(value, "blocks"):
+            for block in value.blocks.values():
+                block.fill(0)
+        else:
+            value = 0
+        inter[key] = value
+
+
+class Intermediates(mla.LazyIntegrals):
+    """
+    Intermediates that record which keys each tracked function reads and writes, so that a function is only
+    run again once something it depends on has changed. A function's inputs are the keys it reads, less those it
+    writes, and its outputs are the keys it writes. Writing or dropping a key, e.g. taking a step in the amplitudes
+    or refreshing the integrals after an orbital rotation, puts every function that read it out of date, and with
+    them every function that read their outputs. Writing an output from outside its function does the same to the
+    function. Until then, a tracked function returns what it returned last without running, and reading one of
+    its outputs after it goes out of date runs it first. So integral-only quantities, like the Fock matrix, are
+    computed once per set of orbitals, however many times they're asked for.
+
+    Only functions that recompute their outputs from their inputs can be tracked: the compute_intermediates,
+    compute_energy and residual functions of a method, or assemble_fock_block_diagonal. A generated function adds
+    to outputs other functions add to, and compute_step keeps DIIS state, so those are run as they are, and their
+    reads and writes count towards the tracked function that calls them.
+    """
+
+    def __init__(self, intermediates: dict, provider, factorized: bool = False):
+        self.records = {} # Tracked function -> (inputs, outputs) of its last run
+        self.results = {} # Tracked function -> what its last run returned
+        self.readers = col.defaultdict(set) # Key -> tracked functions with the key as an input
+        self.producers = {} # Key -> tracked function that wrote it last
+        self.stale = set() # Tracked functions with an input or output changed since they ran
+        self.running = [] # (function, reads, writes) of each tracked function running, innermost last
+        super().__init__(intermediates, provider, factorized)
+
+    def __getitem__(self, key):
+        producer = self.producers.get(key)
+        if producer in self.stale and not self.is_running(producer):
+            self.evaluate(producer)
+        for _, reads, _ in self.running:
+            reads.add(key)
+        return super().__getitem__(key)
+
+    def __missing__(self, key):
+        # Transforming an integral block doesn't change it, so it isn't a write.
+        value = self.provider(key)
+        dict.__setitem__(self, key, value)
+        self.provided.add(key)
+        return value
+
+    def __contains__(self, key):
+        for _, reads, _ in self.running:
+            reads.add(key)
+        return super().__contains__(key)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.changed(key)
+        for _, _, writes in self.running:
+            writes.add(key)
+        if self.running:
+            self.producers[key] = self.running[-1][0]
+        else:
+            self.producers.pop(key, None)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.changed(key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pop(self, key, *default):
+        if dict.__contains__(self, key):
+            self.changed(key)
+        return super().pop(key, *default)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def track(self, function):
+        return tracked(function)
+
+    def is_running(self, function) -> bool:
+        return any(running is function for running, _, _ in self.running)
+
+    def changed(self, key):
+        """ Put the functions that depend on key out of date. """
+        pending = list(self.readers.get(key, ()))
+        producer = self.producers.get(key)
+        if producer is not None and not self.is_running(producer):
+            pending.append(producer)
+        while pending:
+            function = pending.pop()
+            if function in self.stale:
+                continue
+            self.stale.add(function)
+            for output in self.records.get(function, ((), ()))[1]:
+                pending.extend(self.readers.get(output, ()))
+
+    def evaluate(self, function):
+        """ Return function(self), running it only if it hasn't run or has gone out of date since. """
+        if function in self.records and function not in self.stale:
+            inputs, outputs = self.records[function]
+        else:
+            self.running.append((function, set(), set()))
+            try:
+                result = function(self)
+            finally:
+                _, reads, outputs = self.running.pop()
+            inputs = reads - outputs
+            for key in self.records.get(function, ((), ()))[0]:
+                self.readers[key].discard(function)
+            for key in inputs:
+                self.readers[key].add(function)
+            self.records[function] = (inputs, outputs)
+            self.results[function] = result
+            self.stale.discard(function)
+        # A tracked function called by another is part of it, whether or not it had to run.
+        for _, reads, writes in self.running:
+            reads.update(inputs)
+            writes.update(outputs)
+        return self.results[function]
+
+
+class ClosedShellIntermediates(mla.ClosedShellIntermediates, Intermediates):
+    """ Intermediates of a closed-shell reference, tracked by the keys of the blocks that are stored.
+    See multilinear.ClosedShellIntermediates. """
+
+
+class ClosedShellDispatch:
+    """
+    The functions of a generated unrestricted module, each of which calls its counterpart in a module generated
+    with compute.restricted instead when given ClosedShellIntermediates, so only the stored blocks are computed.
+    A function the restricted module lacks, like those of singles, falls back to the unrestricted one,
+    whose writes of flipped blocks are dropped.
+    """
+
+    def __init__(self, unrestricted, restricted):
+        self.unrestricted = unrestricted
+        self.restricted = restricted
+
+    def __getattr__(self, name):
+        general = getattr(self.unrestricted, name)
+        closed_shell = getattr(self.restricted, name, general)
+        def dispatch(inter):
+            return (closed_shell if isinstance(inter, mla.ClosedShellIntermediates) else general)(inter)
+        return dispatch
+
+
+def tracked(function):
+    """ Decorate a function of the intermediates to run through Intermediates.evaluate when they're tracked. """
+    @wraps(function)
+    def wrapper(inter):
+        if isinstance(inter, Intermediates):
+            return inter.evaluate(function)
+        return function(inter)
+    return wrapper
+
+def holds(inter, key) -> bool:
+    """ Return whether key is in inter. Unlike `key in inter`, this doesn't record a read of the block, so a tracked
+    function that only checks for a block, like the Fock build for rdm_ov, isn't rerun each time the block is written. """
+    if not isinstance(inter, Intermediates):
+        return key in inter
+    running, inter.running = inter.running, []
+    try:
+        return key in inter
+    finally:
+        inter.running = running
+
+def is_factorized(inter) -> bool:
+    """ Return whether the integrals of inter come from Cholesky vectors, so only the b blocks are read. """
+    return getattr(inter, "factorized", False)
+
 def initialize_intermediates_hf(orbitals, ranks=[2]):
-    ncor = sum(x.shape[1] for x in orbitals["c"])
     nocc = sum(x.shape[1] for x in orbitals["o"])
     nvir = sum(x.shape[1] for x in orbitals["v"])
-    nfrz = sum(x.shape[1] for x in orbitals["w"])
-    intermed = {"dsd": DirectSumDiis(3, 9)}
+    intermed = {"dsd": DirectSumDiis(*DIIS_SUBSPACE)}
     for rank in ranks:
-        intermed[f"t{rank}"] = mla.read_tensor(f"t{rank}", rank, nocc, nvir)
+        intermed[f"t{rank}"] = np.zeros((nocc,) * rank + (nvir,) * rank)
     return intermed
 
 def initialize_intermediates(orbitals, ranks=[2]):
-    ncor = sum(x.shape[1] for x in orbitals["c"])
     nocc = sum(x.shape[1] for x in orbitals["o"])
     nvir = sum(x.shape[1] for x in orbitals["v"])
-    nfrz = sum(x.shape[1] for x in orbitals["w"])
-    intermed = {"dsd": DirectSumDiis(3, 9), "t1ov": np.zeros((nocc, nvir))}
+    intermed = {"dsd": DirectSumDiis(*DIIS_SUBSPACE), "t1ov": np.zeros((nocc, nvir))}
     for rank in ranks:
-        intermed[f"t{rank}"] = mla.read_tensor(f"t{rank}", rank, nocc, nvir)
+        intermed[f"t{rank}"] = np.zeros((nocc,) * rank + (nvir,) * rank)
     return intermed
 
 def initialize_intermediates_SI(orbitals, ranks=[2]):
@@ -65,12 +261,12 @@ def initialize_intermediates_SI(orbitals, ranks=[2]):
     nob = orbitals["o"][1].shape[1]
     nva = orbitals["v"][0].shape[1]
     nvb = orbitals["v"][1].shape[1]
-    intermed = {"dsd": DirectSumDiis(3, 9), "t1_ov_α": np.zeros((noa, nva)), "t1_ov_β": np.zeros((nob, nvb))}
+    intermed = {"dsd": DirectSumDiis(*DIIS_SUBSPACE), "t1_ov_α": np.zeros((noa, nva)), "t1_ov_β": np.zeros((nob, nvb))}
     for rank in ranks:
         for i in range(rank + 1):
             spinstr = "α" * (rank - i) + "β" * i
             shape = [noa] * (rank - i) + [nob] * i + [nva] * (rank - i) + [nvb] * i
-            intermed[f"t{rank}_{spinstr}"] = mla.read_tensor_general(f"t{rank}_{spinstr}", shape)
+            intermed[f"t{rank}_{spinstr}"] = np.zeros(shape)
     return intermed
 
 def initialize_intermediates_hf_SI(orbitals, ranks=[2]):
@@ -78,30 +274,49 @@ def initialize_intermediates_hf_SI(orbitals, ranks=[2]):
     nob = orbitals["o"][1].shape[1]
     nva = orbitals["v"][0].shape[1]
     nvb = orbitals["v"][1].shape[1]
-    intermed = {"dsd": DirectSumDiis(3, 9)}
+    intermed = {"dsd": DirectSumDiis(*DIIS_SUBSPACE)}
     for rank in ranks:
         for i in range(rank + 1):
             spinstr = "α" * (rank - i) + "β" * i
             shape = [noa] * (rank - i) + [nob] * i + [nva] * (rank - i) + [nvb] * i
-            intermed[f"t{rank}_{spinstr}"] = mla.read_tensor_general(f"t{rank}_{spinstr}", shape)
+            intermed[f"t{rank}_{spinstr}"] = np.zeros(shape)
     return intermed
 
 def hermitian_rdm_energy(i):
     sum_en = einsum("ij, ji", i["h_oo"], i["rdm_oo"]) + einsum("ab, ba", i["h_vv"], i["rdm_vv"])
+    if "rdm_ov" in i:
+        sum_en += 2 * einsum("ia, ia", i["h_ov"], i["rdm_ov"])
+    if is_factorized(i):
+        return sum_en + factorized_rdm_energy(i)
     sum_en += 0.5 * einsum("IJ AB, IJ AB", i["g_oovv"], i["rdm_oovv"])
     sum_en += 0.25 * einsum("IJ KL, IJ KL", i["g_oooo"], i["rdm_oooo"])
     sum_en += 0.25 * einsum("AB CD, AB CD", i["g_vvvv"], i["rdm_vvvv"])
     sum_en += einsum("IA JB, IA JB", i["g_ovov"], i["rdm_ovov"])
-    if "rdm_ov" in i:
-        sum_en += 2 * einsum("ia, ia", i["h_ov"], i["rdm_ov"])
     if "rdm_ooov" in i:
         sum_en += einsum("IJ KA, IJ KA", i["g_ooov"], i["rdm_ooov"])
         sum_en += einsum("IA BC, IA BC", i["g_ovvv"], i["rdm_ovvv"])
     return sum_en
 
+def factorized_rdm_energy(i):
+    """ The two-electron part of hermitian_rdm_energy from the Cholesky vectors, without any g block.
+    Each antisymmetrized integral against an antisymmetric RDM counts its direct term twice. """
+    b_oo, b_ov, b_vv = i["b_oo"], i["b_ov"], i["b_vv"]
+    sum_en = einsum("QIA, QJB, IJAB", b_ov, b_ov, i["rdm_oovv"])
+    sum_en += 0.5 * einsum("QIK, QJL, IJKL", b_oo, b_oo, i["rdm_oooo"])
+    sum_en += 0.5 * einsum("QAC, QBD, ABCD", b_vv, b_vv, i["rdm_vvvv"])
+    sum_en += einsum("QIJ, QAB, IAJB", b_oo, b_vv, i["rdm_ovov"]) - einsum("QIB, QJA, IAJB", b_ov, b_ov, i["rdm_ovov"])
+    if "rdm_ooov" in i:
+        sum_en += 2 * einsum("QIK, QJA, IJKA", b_oo, b_ov, i["rdm_ooov"])
+        sum_en += 2 * einsum("QIB, QAC, IABC", b_ov, b_vv, i["rdm_ovvv"])
+    return sum_en
+
 def hermitian_rdm_energy_SI(i):
     sum_en = einsum("ij, ji", i["h_oo_α"], i["rdm_oo_α"]) + einsum("ab, ba", i["h_vv_α"], i["rdm_vv_α"])
     sum_en += einsum("ij, ji", i["h_oo_β"], i["rdm_oo_β"]) + einsum("ab, ba", i["h_vv_β"], i["rdm_vv_β"])
+    if "rdm_ov_α" in i:
+        sum_en += 2 * einsum("ia, ia", i["h_ov_α"], i["rdm_ov_α"]) + 2 * einsum("ia, ia", i["h_ov_β"], i["rdm_ov_β"])
+    if is_factorized(i):
+        return sum_en + factorized_rdm_energy_SI(i)
     sum_en += 0.5 * einsum("IJ AB, IJ AB", i["g_oovv_αα"], i["rdm_oovv_αα"])
     sum_en += 2 * einsum("IJ AB, IJ AB", i["g_oovv_αβ"], i["rdm_oovv_αβ"])
     sum_en += 0.5 * einsum("IJ AB, IJ AB", i["g_oovv_ββ"], i["rdm_oovv_ββ"])
@@ -125,7 +340,32 @@ def hermitian_rdm_energy_SI(i):
         sum_en += 2 * einsum("IA BC, IA BC", i["g_ovvv_αβ"], i["rdm_ovvv_αβ"])
         sum_en += 2 * einsum("AI BC, AI BC", i["g_vovv_αβ"], i["rdm_vovv_αβ"])
         sum_en += einsum("IA BC, IA BC", i["g_ovvv_ββ"], i["rdm_ovvv_ββ"])
-    if "rdm_ov_α" in i:
-        sum_en += 2 * einsum("ia, ia", i["h_ov_α"], i["rdm_ov_α"]) + 2 * einsum("ia, ia", i["h_ov_β"], i["rdm_ov_β"])
+    return sum_en
+
+def factorized_rdm_energy_SI(i):
+    """ The two-electron part of hermitian_rdm_energy_SI from the Cholesky vectors, without any g block. """
+    sum_en = 0
+    for spin in ("αα", "ββ"):
+        b_oo, b_ov, b_vv = (i[f"b_{x}_{spin[0]}"] for x in ("oo", "ov", "vv"))
+        sum_en += einsum("QIA, QJB, IJAB", b_ov, b_ov, i[f"rdm_oovv_{spin}"])
+        sum_en += 0.5 * einsum("QIK, QJL, IJKL", b_oo, b_oo, i[f"rdm_oooo_{spin}"])
+        sum_en += 0.5 * einsum("QAC, QBD, ABCD", b_vv, b_vv, i[f"rdm_vvvv_{spin}"])
+        sum_en += einsum("QIJ, QAB, IAJB", b_oo, b_vv, i[f"rdm_ovov_{spin}"]) - einsum("QIB, QJA, IAJB", b_ov, b_ov, i[f"rdm_ovov_{spin}"])
+        if "rdm_ooov_αα" in i:
+            sum_en += 2 * einsum("QIK, QJA, IJKA", b_oo, b_ov, i[f"rdm_ooov_{spin}"])
+            sum_en += 2 * einsum("QIB, QAC, IABC", b_ov, b_vv, i[f"rdm_ovvv_{spin}"])
+    a_oo, a_ov, a_vv = (i[f"b_{x}_α"] for x in ("oo", "ov", "vv"))
+    b_oo, b_ov, b_vv = (i[f"b_{x}_β"] for x in ("oo", "ov", "vv"))
+    sum_en += 2 * einsum("QIA, QJB, IJAB", a_ov, b_ov, i["rdm_oovv_αβ"])
+    sum_en += einsum("QIK, QJL, IJKL", a_oo, b_oo, i["rdm_oooo_αβ"])
+    sum_en += einsum("QAC, QBD, ABCD", a_vv, b_vv, i["rdm_vvvv_αβ"])
+    sum_en += einsum("QIJ, QAB, IAJB", a_oo, b_vv, i["rdm_ovov_αβ"])
+    sum_en += 2 * einsum("QIB, QJA, IABJ", a_ov, b_ov, i["rdm_ovvo_αβ"])
+    sum_en += einsum("QAB, QIJ, AIBJ", a_vv, b_oo, i["rdm_vovo_αβ"])
+    if "rdm_ooov_αα" in i:
+        sum_en += 2 * einsum("QIK, QJA, IJKA", a_oo, b_ov, i["rdm_ooov_αβ"])
+        sum_en += 2 * einsum("QIA, QJK, IJAK", a_ov, b_oo, i["rdm_oovo_αβ"])
+        sum_en += 2 * einsum("QIB, QAC, IABC", a_ov, b_vv, i["rdm_ovvv_αβ"])
+        sum_en += 2 * einsum("QAB, QIC, AIBC", a_vv, b_ov, i["rdm_vovv_αβ"])
     return sum_en
 
@@ -1,13 +1,13 @@
 from functools import partial
 from pilot_implementations.scripts.prdm import common
-from pilot_implementations.scripts.prdm import unrestricted_param as param
+from pilot_implementations.scripts.prdm import restricted_param, unrestricted_param
 from pilot_implementations.scripts.prdm.taylor.proc import build_intermed_SI
 from . import proc
 
+param = common.ClosedShellDispatch(unrestricted_param, restricted_param)
+
 def residual(intermed):
-    intermed["r2_αα"] = 0
-    intermed["r2_αβ"] = 0
-    intermed["r2_ββ"] = 0
+    common.zero_blocks(intermed, "r2_αα", "r2_αβ", "r2_ββ")
     param.D2_cumulant_residual(intermed)
     param.D2_opdm_residual(intermed)
     # There are no opdm product terms until D4.
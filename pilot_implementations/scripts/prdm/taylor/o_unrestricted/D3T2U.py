@@ -1,15 +1,14 @@
 from functools import partial
 from pilot_implementations.scripts.prdm import common
-from pilot_implementations.scripts.prdm import unrestricted_param as param
+from pilot_implementations.scripts.prdm import restricted_param, unrestricted_param
 from pilot_implementations.scripts.prdm.taylor.proc import build_intermed_SI
 from . import proc, D3U
 
+param = common.ClosedShellDispatch(unrestricted_param, restricted_param)
+
 def residual(intermed):
     D3U.residual(intermed)
-    intermed["r3_ααα"] = 0
-    intermed["r3_ααβ"] = 0
-    intermed["r3_αββ"] = 0
-    intermed["r3_βββ"] = 0
+    common.zero_blocks(intermed, "r3_ααα", "r3_ααβ", "r3_αββ", "r3_βββ")
     param.T2_cumulant_residual(intermed)
     param.T2_opdm_residual_U(intermed)
 
@@ -29,7 +28,7 @@ def intermed(i):
 simultaneous = partial(proc.simultaneous,
                        compute_intermediates = intermed,
                        compute_amplitude_residual = residual,
-                       initialize_intermediates = lambda x: common.initialize_intermediates_SI(x, [2, 3])
+                       initialize_intermediates = partial(common.initialize_intermediates_SI, ranks=[2, 3])
                       )
 simultaneous.SI = True
 
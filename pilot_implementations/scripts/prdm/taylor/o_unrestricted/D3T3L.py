@@ -1,9 +1,11 @@
 from functools import partial
 from pilot_implementations.scripts.prdm import common
-from pilot_implementations.scripts.prdm import unrestricted_param as param
+from pilot_implementations.scripts.prdm import restricted_param, unrestricted_param
 from pilot_implementations.scripts.prdm.taylor.proc import build_intermed_SI
 from . import proc, DT2L
 
+param = common.ClosedShellDispatch(unrestricted_param, restricted_param)
+
 def residual(intermed):
     DT2L.residual(intermed)
     param.T3_cumulant_residual_L(intermed)
@@ -23,7 +25,7 @@ def intermed(i):
 simultaneous = partial(proc.simultaneous,
                        compute_intermediates = intermed,
                        compute_amplitude_residual = residual,
-                       initialize_intermediates = lambda x: common.initialize_intermediates_SI(x, [2, 3])
+                       initialize_intermediates = partial(common.initialize_intermediates_SI, ranks=[2, 3])
                       )
 simultaneous.SI = True
 
@@ -30,9 +30,7 @@ def zero_rdms(inter, ov):
     elif ov is not False:
         raise Exception
 
-    for string in strings:
-        inter[f"rdm_{string}"] = 0
-        inter[f"c_{string}"] = 0
+    common.zero_blocks(inter, *(f"{kind}_{string}" for string in strings for kind in ("rdm", "c")))
 
 def zero_rdms_SI(inter, ov):
     strings = {
@@ -54,93 +52,150 @@ def zero_rdms_SI(inter, ov):
     elif ov is not False:
         raise Exception
 
-    for string in strings:
-        inter[f"rdm_{string}"] = 0
-        inter[f"c_{string}"] = 0
+    common.zero_blocks(inter, *(f"{kind}_{string}" for string in strings for kind in ("rdm", "c")))
+
+def add_delta_product(target, size: int, matrix: np.ndarray, delta_axes: tuple[int, int], matrix_axes: tuple[int, int], weight=1):
+    """
+    Return target + weight * δ(delta_axes) matrix(matrix_axes) for a four-index target, where δ is the identity
+    of dimension size. E.g. kappa ⊗ rdm_vv for rdm_ovov is add_delta_product(target, nocc, rdm_vv, (0, 2), (1, 3)).
+    An array target is added to in place, through a diagonal view, so the product is never formed.
+    """
+    labels = "".join("x" if axis in delta_axes else "yz"[matrix_axes.index(axis)] for axis in range(4))
+    if isinstance(target, np.ndarray):
+        view = np.einsum(f"{labels}->xyz", target)
+        view += weight * matrix
+        return target
+    # A scalar or a tensor stored in blocks, which can't be viewed. Form the product and add it.
+    product = np.zeros(tuple(size if x == "x" else matrix.shape["yz".index(x)] for x in labels))
+    return target + add_delta_product(product, size, matrix, delta_axes, matrix_axes, weight)
+
+# Terms of products of a Kronecker delta and a matrix, as (delta axes, matrix axes, weight) for add_delta_product.
+# einsum("pr, qs -> pqrs", kappa, matrix) is DIRECT, and einsum("pr, qs -> pqrs", matrix, kappa) is TRANSPOSED.
+# The antisymmetrized terms are those of mla.antisymmetrize_axes applied to DIRECT over the axis pairs named.
+DIRECT = (((0, 2), (1, 3), 1),)
+TRANSPOSED = (((1, 3), (0, 2), 1),)
+ANTISYMMETRIZED_01 = DIRECT + (((1, 2), (0, 3), -1),)
+ANTISYMMETRIZED_23 = DIRECT + (((0, 3), (1, 2), -1),)
+ANTISYMMETRIZED_01_23 = ANTISYMMETRIZED_01 + (((0, 3), (1, 2), -1), ((1, 3), (0, 2), 1))
+
+def add_delta_products(inter, key, size, matrix, terms):
+    if not common.stores(inter, key):
+        # The spin flip of a block a closed-shell reference stores. Its terms are those of the stored block.
+        return
+    for delta_axes, matrix_axes, weight in terms:
+        inter[key] = add_delta_product(inter[key], size, matrix, delta_axes, matrix_axes, weight)
 
 def rdm_construct(inter):
-    kappa = np.eye(inter["rdm_oo"].shape[0])
-    inter["rdm_oovv"] += inter["c_oovv"]
-    inter["rdm_oooo"] += inter["c_oooo"]
-    inter["rdm_oooo"] += mla.antisymmetrize_axes(einsum("pr, qs -> pqrs", kappa, kappa), (2, 3))
-    inter["rdm_oooo"] += mla.antisymmetrize_axes(einsum("pr, qs -> pqrs", kappa, inter["rdm_oo"]), (0, 1), (2, 3))
-    inter["rdm_vvvv"] += inter["c_vvvv"]
-    inter["rdm_ovov"] += inter["c_ovov"] + einsum("p r, q s -> pqrs", kappa, inter["rdm_vv"])
+    nocc = inter["rdm_oo"].shape[0]
+    kappa = np.eye(nocc)
+    add_cumulants(inter, "oovv", "oooo")
+    add_delta_products(inter, "rdm_oooo", nocc, kappa, ANTISYMMETRIZED_23)
+    add_delta_products(inter, "rdm_oooo", nocc, inter["rdm_oo"], ANTISYMMETRIZED_01_23)
+    add_cumulants(inter, "vvvv", "ovov")
+    add_delta_products(inter, "rdm_ovov", nocc, inter["rdm_vv"], DIRECT)
     inter["rdm_oo"] += kappa
     if "c_ooov" in inter:
-        inter["rdm_ooov"] += inter["c_ooov"]
+        add_cumulants(inter, "ooov")
         if "rdm_ov" in inter:
-            inter["rdm_ooov"] += mla.antisymmetrize_axes(einsum("p r, q s -> pqrs", kappa, inter["rdm_ov"]), (0, 1))
-        inter["rdm_ovvv"] += inter["c_ovvv"]
+            add_delta_products(inter, "rdm_ooov", nocc, inter["rdm_ov"], ANTISYMMETRIZED_01)
+        add_cumulants(inter, "ovvv")
+
+def add_cumulants(inter, *strings):
+    """ Add each cumulant block c_string into rdm_string, like a generated term: in place if both are arrays, and
+    out of place otherwise, so a cumulant stored by symmetry block keeps the RDM block stored that way too.
+    A closed-shell reference adds only into the stored blocks, since the cumulant of a spin-flipped block is that
+    of the stored one. """
+    for string in strings:
+        key = f"rdm_{string}"
+        if common.stores(inter, key):
+            inter[key] = mla.accumulate(inter[key], inter[f"c_{string}"])
 
 def rdm_construct_SI(inter):
-    kappa_a = np.eye(inter["rdm_oo_α"].shape[0])
-    kappa_b = np.eye(inter["rdm_oo_β"].shape[0])
-    inter["rdm_oovv_αα"] += inter["c_oovv_αα"]
-    inter["rdm_oovv_αβ"] += inter["c_oovv_αβ"]
-    inter["rdm_oovv_ββ"] += inter["c_oovv_ββ"]
-    inter["rdm_oooo_αα"] += inter["c_oooo_αα"]
-    inter["rdm_oooo_αβ"] += inter["c_oooo_αβ"]
-    inter["rdm_oooo_ββ"] += inter["c_oooo_ββ"]
-    inter["rdm_oooo_αα"] += mla.antisymmetrize_axes(einsum("pr, qs -> pqrs", kappa_a, kappa_a), (2, 3))
-    inter["rdm_oooo_αβ"] += einsum("pr, qs -> pqrs", kappa_a, kappa_b)
-    inter["rdm_oooo_ββ"] += mla.antisymmetrize_axes(einsum("pr, qs -> pqrs", kappa_b, kappa_b), (2, 3))
-    inter["rdm_oooo_αα"] += mla.antisymmetrize_axes(einsum("pr, qs -> pqrs", kappa_a, inter["rdm_oo_α"]), (0, 1), (2, 3))
-    inter["rdm_oooo_αβ"] += einsum("pr, qs -> pqrs", inter["rdm_oo_α"], kappa_b)
-    inter["rdm_oooo_αβ"] += einsum("pr, qs -> pqrs", kappa_a, inter["rdm_oo_β"])
-    inter["rdm_oooo_ββ"] += mla.antisymmetrize_axes(einsum("pr, qs -> pqrs", kappa_b, inter["rdm_oo_β"]), (0, 1), (2, 3))
-    inter["rdm_vvvv_αα"] += inter["c_vvvv_αα"]
-    inter["rdm_vvvv_αβ"] += inter["c_vvvv_αβ"]
-    inter["rdm_vvvv_ββ"] += inter["c_vvvv_ββ"]
-    inter["rdm_ovov_αα"] += inter["c_ovov_αα"] + einsum("p r, q s -> pqrs", kappa_a, inter["rdm_vv_α"])
-    inter["rdm_ovov_αβ"] += inter["c_ovov_αβ"] + einsum("p r, q s -> pqrs", kappa_a, inter["rdm_vv_β"])
-    inter["rdm_ovvo_αβ"] += inter["c_ovvo_αβ"]
-    inter["rdm_vovo_αβ"] += inter["c_vovo_αβ"] + einsum("p r, q s -> pqrs", inter["rdm_vv_α"], kappa_b)
-    inter["rdm_ovov_ββ"] += inter["c_ovov_ββ"] + einsum("p r, q s -> pqrs", kappa_b, inter["rdm_vv_β"])
+    noa = inter["rdm_oo_α"].shape[0]
+    nob = inter["rdm_oo_β"].shape[0]
+    kappa_a = np.eye(noa)
+    kappa_b = np.eye(nob)
+    add_cumulants(inter, "oovv_αα", "oovv_αβ", "oovv_ββ", "oooo_αα", "oooo_αβ", "oooo_ββ")
+    add_delta_products(inter, "rdm_oooo_αα", noa, kappa_a, ANTISYMMETRIZED_23)
+    add_delta_products(inter, "rdm_oooo_αβ", noa, kappa_b, DIRECT)
+    add_delta_products(inter, "rdm_oooo_ββ", nob, kappa_b, ANTISYMMETRIZED_23)
+    add_delta_products(inter, "rdm_oooo_αα", noa, inter["rdm_oo_α"], ANTISYMMETRIZED_01_23)
+    add_delta_products(inter, "rdm_oooo_αβ", nob, inter["rdm_oo_α"], TRANSPOSED)
+    add_delta_products(inter, "rdm_oooo_αβ", noa, inter["rdm_oo_β"], DIRECT)
+    add_delta_products(inter, "rdm_oooo_ββ", nob, inter["rdm_oo_β"], ANTISYMMETRIZED_01_23)
+    add_cumulants(inter, "vvvv_αα", "vvvv_αβ", "vvvv_ββ", "ovov_αα", "ovov_αβ", "ovvo_αβ", "vovo_αβ", "ovov_ββ")
+    add_delta_products(inter, "rdm_ovov_αα", noa, inter["rdm_vv_α"], DIRECT)
+    add_delta_products(inter, "rdm_ovov_αβ", noa, inter["rdm_vv_β"], DIRECT)
+    add_delta_products(inter, "rdm_vovo_αβ", nob, inter["rdm_vv_α"], TRANSPOSED)
+    add_delta_products(inter, "rdm_ovov_ββ", nob, inter["rdm_vv_β"], DIRECT)
     inter["rdm_oo_α"] += kappa_a
-    inter["rdm_oo_β"] += kappa_b
+    if common.stores(inter, "rdm_oo_β"):
+        inter["rdm_oo_β"] += kappa_b
     if "c_ooov_αα" in inter:
-        inter["rdm_ooov_αα"] += inter["c_ooov_αα"]
-        inter["rdm_ooov_αβ"] += inter["c_ooov_αβ"]
-        inter["rdm_oovo_αβ"] += inter["c_oovo_αβ"]
-        inter["rdm_ooov_ββ"] += inter["c_ooov_ββ"]
+        add_cumulants(inter, "ooov_αα", "ooov_αβ", "oovo_αβ", "ooov_ββ")
         if "rdm_ov_α" in inter:
-            inter["rdm_ooov_αα"] += mla.antisymmetrize_axes(einsum("p r, q s -> pqrs", kappa_a, inter["rdm_ov_α"]), (0, 1))
-            inter["rdm_ooov_αβ"] += einsum("p r, q s -> pqrs", kappa_a, inter["rdm_ov_β"])
-            inter["rdm_oovo_αβ"] += einsum("p r, q s -> pqrs", inter["rdm_ov_α"], kappa_b)
-            inter["rdm_ooov_ββ"] += mla.antisymmetrize_axes(einsum("p r, q s -> pqrs", kappa_b, inter["rdm_ov_β"]), (0, 1))
-        inter["rdm_ovvv_αα"] += inter["c_ovvv_αα"]
-        inter["rdm_ovvv_αβ"] += inter["c_ovvv_αβ"]
-        inter["rdm_vovv_αβ"] += inter["c_vovv_αβ"]
-        inter["rdm_ovvv_ββ"] += inter["c_ovvv_ββ"]
+            add_delta_products(inter, "rdm_ooov_αα", noa, inter["rdm_ov_α"], ANTISYMMETRIZED_01)
+            add_delta_products(inter, "rdm_ooov_αβ", noa, inter["rdm_ov_β"], DIRECT)
+            add_delta_products(inter, "rdm_oovo_αβ", nob, inter["rdm_ov_α"], TRANSPOSED)
+            add_delta_products(inter, "rdm_ooov_ββ", nob, inter["rdm_ov_β"], ANTISYMMETRIZED_01)
+        add_cumulants(inter, "ovvv_αα", "ovvv_αβ", "vovv_αβ", "ovvv_ββ")
 
+@common.tracked
 def assemble_fock_block_diagonal(inter):
+    if common.is_factorized(inter):
+        return assemble_fock_block_diagonal_factorized(inter)
     inter["f_oo"] = inter["h_oo"] + einsum("Ii Ji -> IJ", inter["g_oooo"])
     inter["f_vv"] = inter["h_vv"] + einsum("iA iB -> AB", inter["g_ovov"])
-    if "rdm_ov" in inter:
+    if common.holds(inter, "rdm_ov"):
         inter["f_ov"] = inter["h_ov"] + einsum("iI iA -> IA", inter["g_ooov"])
 
+def assemble_fock_block_diagonal_factorized(inter):
+    """ Build the Fock matrix from the Cholesky vectors, as Coulomb minus exchange, without any g block. """
+    J = einsum("Qii -> Q", inter["b_oo"])
+    inter["f_oo"] = inter["h_oo"] + einsum("QIJ, Q -> IJ", inter["b_oo"], J) - einsum("QIi, QiJ -> IJ", inter["b_oo"], inter["b_oo"])
+    inter["f_vv"] = inter["h_vv"] + einsum("QAB, Q -> AB", inter["b_vv"], J) - einsum("QiA, QiB -> AB", inter["b_ov"], inter["b_ov"])
+    if common.holds(inter, "rdm_ov"):
+        inter["f_ov"] = inter["h_ov"] + einsum("QIA, Q -> IA", inter["b_ov"], J) - einsum("QIi, QiA -> IA", inter["b_oo"], inter["b_ov"])
+
+@common.tracked
 def assemble_fock_block_diagonal_SI(inter):
+    if common.is_factorized(inter):
+        return assemble_fock_block_diagonal_factorized_SI(inter)
     inter["f_oo_α"] = inter["h_oo_α"] + einsum("Ii Ji -> IJ", inter["g_oooo_αα"]) + einsum("Ii Ji -> IJ", inter["g_oooo_αβ"])
     inter["f_oo_β"] = inter["h_oo_β"] + einsum("Ii Ji -> IJ", inter["g_oooo_ββ"]) + einsum("iI iJ -> IJ", inter["g_oooo_αβ"])
     inter["f_vv_α"] = inter["h_vv_α"] + einsum("iA iB -> AB", inter["g_ovov_αα"]) + einsum("Ai Bi -> AB", inter["g_vovo_αβ"])
     inter["f_vv_β"] = inter["h_vv_β"] + einsum("iA iB -> AB", inter["g_ovov_ββ"]) + einsum("iA iB -> AB", inter["g_ovov_αβ"])
-    if "rdm_ov_α" in inter:
+    if common.holds(inter, "rdm_ov_α"):
         inter["f_ov_α"] = inter["h_ov_α"] + einsum("iI iA -> IA", inter["g_ooov_αα"]) + einsum("Ii Ai -> IA", inter["g_oovo_αβ"])
         inter["f_ov_β"] = inter["h_ov_β"] + einsum("iI iA -> IA", inter["g_ooov_ββ"]) + einsum("iI iA -> IA", inter["g_ooov_αβ"])
 
+def assemble_fock_block_diagonal_factorized_SI(inter):
+    J = einsum("Qii -> Q", inter["b_oo_α"]) + einsum("Qii -> Q", inter["b_oo_β"])
+    for spin in "αβ":
+        b_oo, b_ov, b_vv = (inter[f"b_{x}_{spin}"] for x in ("oo", "ov", "vv"))
+        inter[f"f_oo_{spin}"] = inter[f"h_oo_{spin}"] + einsum("QIJ, Q -> IJ", b_oo, J) - einsum("QIi, QiJ -> IJ", b_oo, b_oo)
+        inter[f"f_vv_{spin}"] = inter[f"h_vv_{spin}"] + einsum("QAB, Q -> AB", b_vv, J) - einsum("QiA, QiB -> AB", b_ov, b_ov)
+        if common.holds(inter, "rdm_ov_α"):
+            inter[f"f_ov_{spin}"] = inter[f"h_ov_{spin}"] + einsum("QIA, Q -> IA", b_ov, J) - einsum("QIi, QiA -> IA", b_oo, b_ov)
+
+def fock_diagonal(key, sign, inter):
+    """ Return sign times the diagonal of the Fock block key, for the Jacobi step of simultaneous_step. """
+    return sign * np.diagonal(inter[key])
+
+# Module-level functions rather than lambdas, so the solvers of a method can be pickled, e.g. for the worker
+# processes of runner.batch and slow_fd.hellmann_test.
 diagonal_dict = {
-        "o": lambda x: np.diagonal(x["f_oo"]),
-        "v": lambda x: - np.diagonal(x["f_vv"]),
+        "o": partial(fock_diagonal, "f_oo", 1),
+        "v": partial(fock_diagonal, "f_vv", -1),
 }
 
 simultaneous_step = partial(common.simultaneous_step, diagonal_dict = diagonal_dict)
 
 diagonal_spin_dict = {
-        "oα": lambda x: np.diagonal(x["f_oo_α"]),
-        "vα": lambda x: - np.diagonal(x["f_vv_α"]),
-        "oβ": lambda x: np.diagonal(x["f_oo_β"]),
-        "vβ": lambda x: - np.diagonal(x["f_vv_β"])
+        "oα": partial(fock_diagonal, "f_oo_α", 1),
+        "vα": partial(fock_diagonal, "f_vv_α", -1),
+        "oβ": partial(fock_diagonal, "f_oo_β", 1),
+        "vβ": partial(fock_diagonal, "f_vv_β", -1)
         }
 
 simultaneous_step_SI = partial(common.simultaneous_step_SI, diagonal_dict = diagonal_spin_dict)
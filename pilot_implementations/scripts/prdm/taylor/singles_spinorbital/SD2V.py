@@ -5,8 +5,7 @@ from pilot_implementations.scripts.prdm.taylor.proc import build_intermed
 from . import proc
 
 def residual(intermed):
-    intermed["r1"] = 0
-    intermed["r2"] = 0
+    common.zero_blocks(intermed, "r1", "r2")
     param.D2_cumulant_residual(intermed)
     param.D2_opdm_residual(intermed)
     param.S2_cumulant_residual(intermed)
@@ -32,5 +31,5 @@ def intermed(i):
 simultaneous = partial(proc.simultaneous,
                        compute_intermediates = intermed,
                        compute_amplitude_residual = residual,
-                       initialize_intermediates = lambda x: common.initialize_intermediates_hf(x, [1, 2])
+                       initialize_intermediates = partial(common.initialize_intermediates_hf, ranks=[1, 2])
                       ) 
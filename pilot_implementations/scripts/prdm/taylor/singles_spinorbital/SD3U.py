@@ -30,5 +30,5 @@ def intermed(i):
 simultaneous = partial(proc.simultaneous,
                        compute_intermediates = intermed,
                        compute_amplitude_residual = residual,
-                       initialize_intermediates = lambda x: common.initialize_intermediates_hf(x, [1, 2])
+                       initialize_intermediates = partial(common.initialize_intermediates_hf, ranks=[1, 2])
                       ) 
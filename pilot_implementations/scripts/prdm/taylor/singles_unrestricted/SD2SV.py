@@ -1,17 +1,16 @@
 from functools import partial
 from pilot_implementations.scripts.prdm import common
-from pilot_implementations.scripts.prdm import unrestricted_param as param
+from pilot_implementations.scripts.prdm import restricted_param, unrestricted_param
 from pilot_implementations.scripts.prdm.taylor.proc import build_intermed_SI
 from . import proc
 
+param = common.ClosedShellDispatch(unrestricted_param, restricted_param)
+
 def residual(intermed):
-    intermed["r2_αα"] = 0 
-    intermed["r2_αβ"] = 0 
-    intermed["r2_ββ"] = 0 
+    common.zero_blocks(intermed, "r2_αα", "r2_αβ", "r2_ββ")
     param.D2_cumulant_residual(intermed)
     param.D2_opdm_residual(intermed)
-    intermed["r1_α"] = 0
-    intermed["r1_β"] = 0
+    common.zero_blocks(intermed, "r1_α", "r1_β")
     param.S2_cumulant_residual(intermed)
     param.S2_opdm_residual_SV(intermed)
     param.S2_opdm_product_residual(intermed)
@@ -34,5 +33,5 @@ def intermed(i):
 simultaneous = partial(proc.simultaneous,
                        compute_intermediates = intermed,
                        compute_amplitude_residual = residual,
-                       initialize_intermediates = lambda x: common.initialize_intermediates_hf_SI(x, [1, 2])
+                       initialize_intermediates = partial(common.initialize_intermediates_hf_SI, ranks=[1, 2])
                       )
@@ -1,12 +1,36 @@
 from ..qc_codes import psi as program
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import inspect
 import itertools
 import numpy as np
 from .. import math_util, chem
 from scipy import linalg as spla
 from .. import multilinear as mla
+from .prdm import common as prdm_common
 from pilot_implementations.multilinear.tensor import einsum
 from pilot_implementations.math_util.solvers.spinorbital import proc as spinorbital_proc
 
+# Options of subspace that are passed on to the solver, and their defaults.
+SOLVER_OPTIONS = {
+    "check_minima": False, "minima_tolerance": 5e-9, "compile_plan": False, "packed": False, "integral_threads": 1,
+    "restricted": False, "orbital_irreps": None, "diis_directory": None, "memory_log": False,
+}
+
+def solver_options(solver, options: dict) -> dict:
+    """ Return the options the solver takes. Any other option must be at its default, or None if it has none,
+    or a ValueError is raised, since the solver would ignore it, e.g. restricted for a spin orbital solver.
+    The container that tracks the intermediates is only passed to solvers that take one. """
+    parameters = inspect.signature(solver).parameters
+    unsupported = [key for key, value in options.items() if key not in parameters and key != "container"
+                   and value is not None and value != SOLVER_OPTIONS.get(key)]
+    if unsupported:
+        function = solver
+        while isinstance(function, functools.partial):
+            function = function.func
+        raise ValueError(f"{function.__module__}.{function.__qualname__} doesn't take the options {', '.join(unsupported)}.")
+    return {key: value for key, value in options.items() if key in parameters}
+
 def subspace(molecule, solver, test=False, comp_grad=False, e_thresh=1e-14, r_thresh=1e-9, **kwargs):
     CHARGE = molecule["charge"]
     NUM_UNPAIRED = molecule["num_unpaired"]
@@ -19,34 +43,59 @@ def subspace(molecule, solver, test=False, comp_grad=False, e_thresh=1e-14, r_th
     h_ao = program.core_hamiltonian(BASIS, GEOM)
     r_ao = program.repulsion(BASIS, GEOM)
 
-    h_aso = mla.to_spinorb(h_ao, electron_indices=((0, 1),))
-    r_aso = mla.to_spinorb(r_ao, electron_indices=((0, 2), (1, 3)))
-    g_aso = r_aso - np.transpose(r_aso, (0, 1, 3, 2))
-
     try:
         orbitals = program.read_orbitals(BASIS, GEOM)
     except AssertionError:
         orbitals = program.unrestricted_orbitals(BASIS, GEOM, CHARGE, NUM_UNPAIRED, **kwargs)
     en_nuc = chem.nuc.energy(GEOM)
+    # Frozen orbitals are left out of the correlation treatment. See multilinear.freeze.
+    if kwargs.get("frozen_core") or kwargs.get("frozen_virtual"):
+        orbitals = mla.freeze(orbitals, kwargs.get("frozen_core", 0), kwargs.get("frozen_virtual", 0))
+    frozen = any(x.shape[1] for space in ("c", "w") for x in orbitals.get(space, ()))
+    # Frozen orbitals aren't variational. Only the spin orbital back-transform solves for their response.
+    if comp_grad and frozen and hasattr(solver, "SI"):
+        raise ValueError("Gradients with frozen orbitals are only implemented for the spin orbital solvers.")
+
+    # Start from the amplitudes of an earlier solution, if a guess store is given. See math_util.solvers.common.GuessStore.
+    store = kwargs.get("guess_store")
+    molecule_key = (CHARGE, NUM_UNPAIRED, BASIS, tuple(atoms))
+    guess = kwargs.get("guess")
+    if guess is None and store is not None:
+        guess = store.read(solver, molecule_key, orbitals)
 
-    intermed, orbitals = solver(en_nuc, h_ao, r_ao, orbitals, e_thresh=e_thresh, r_thresh=r_thresh, check_minima=kwargs.get("check_minima", False))
+    # Solve with Cholesky vectors in place of the dense integrals, if asked. Nothing after this reads the dense ones,
+    # so they're freed once factorized. The gradient uses the derivative integrals, which are always dense.
+    if kwargs.get("cholesky"):
+        r_ao = mla.CholeskyVectors.from_dense(r_ao, kwargs["cholesky"])
+    # Track what each method function reads and writes, to skip work whose inputs haven't changed. See prdm.common.Intermediates.
+    container = None
+    if kwargs.get("track_intermediates", True):
+        container = prdm_common.ClosedShellIntermediates if kwargs.get("restricted", False) else prdm_common.Intermediates
+    options = {key: kwargs.get(key, default) for key, default in SOLVER_OPTIONS.items()}
+    options.update(e_thresh=e_thresh, r_thresh=r_thresh, guess=guess, container=container)
+    reference = orbitals
+    intermed, orbitals = solver(en_nuc, h_ao, r_ao, orbitals, **solver_options(solver, options))
+    if store is not None:
+        store.write(solver, molecule_key, orbitals, intermed)
 
     if comp_grad and not hasattr(solver, "SI"):
         nx = program.nuclear_potential_deriv(GEOM)
-        oei = spinorbital_proc.backtransform_hermitian_opdm(orbitals, intermed)
-        tei = spinorbital_proc.backtransform_hermitian_tpdm(orbitals, intermed)
-        gei = spinorbital_proc.backtransform_hermitian_gfm(orbitals, intermed)
+        # Back-transform to spatial AOs, summed over spin, so the derivative integrals are used as they come.
+        # The spin orbital AO integrals are 16 times larger and mostly zero.
+        # With frozen orbitals, the densities also hold the frozen core and the response of the reference orbitals.
+        if frozen:
+            oei, tei, gei = spinorbital_proc.backtransform_frozen(h_ao, r_ao, reference, orbitals, intermed)
+        else:
+            oei = spinorbital_proc.backtransform_hermitian_opdm(orbitals, intermed, spin_summed=True)
+            tei = spinorbital_proc.backtransform_hermitian_tpdm(orbitals, intermed, spin_summed=True)
+            gei = spinorbital_proc.backtransform_hermitian_gfm(orbitals, intermed, spin_summed=True)
         grad = np.zeros(nx.shape)
         for atom in range(len(GEOM)):
             hx_ao = program.core_hamiltonian_grad(BASIS, GEOM, atom)
             rx_ao = program.repulsion_grad(BASIS, GEOM, atom)
             sx_ao = program.overlap_grad(BASIS, GEOM, atom)
             for i, (h, r, s) in enumerate(zip(hx_ao, rx_ao, sx_ao)):
-                hx_aso = mla.to_spinorb(h, electron_indices=((0,1), ))
-                sx_aso = mla.to_spinorb(s, electron_indices=((0,1), ))
-                rx_aso = mla.to_spinorb(r, electron_indices=((0,2), (1,3)))
-                gx_aso = rx_aso - np.transpose(rx_aso, (0, 1, 3, 2))
-                grad[atom][i] = math_util.solvers.common.perturbation_gradient(gei, hx_aso, gx_aso, sx_aso, nx[atom][i], oei, tei)
+                grad[atom][i] = math_util.solvers.common.perturbation_gradient(gei, h, r, s, nx[atom][i], oei, tei)
         print(grad)
         intermed["gradient"] = grad
     elif comp_grad and hasattr(solver, "SI"):
@@ -256,13 +305,51 @@ def subspace(molecule, solver, test=False, comp_grad=False, e_thresh=1e-14, r_th
                 if rdm_label in intermed:
                     prefactor = 1 if label[0] == label[1] else 2
                     intermed["mu"] -= einsum("pq x, pq -> x", block, intermed[rdm_label]) * prefactor
+            if "cc" in p:
+                # The frozen core is fully occupied.
+                intermed["mu"] -= np.trace(p["cc"])
         elif test:
             backtransformed_opdm = einsum("pq, Pp, Qq -> PQ", intermed["rdm_oo_α"], orbitals["o"][0], orbitals["o"][0]) + (
                 einsum("pq, Pp, Qq -> PQ", intermed["rdm_oo_β"], orbitals["o"][1], orbitals["o"][1])) + (
                 einsum("pq, Pp, Qq -> PQ", intermed["rdm_vv_α"], orbitals["v"][0], orbitals["v"][0])) + (
                 einsum("pq, Pp, Qq -> PQ", intermed["rdm_vv_β"], orbitals["v"][1], orbitals["v"][1]))
+            if "c" in orbitals:
+                backtransformed_opdm += sum(x @ x.T for x in orbitals["c"])
             intermed["mu"] = -einsum("pq x, pq -> x", p_ao, backtransformed_opdm)
-        intermed["deriv"] = math_util.hellmann_test(solver, h_ao, p_ao, r_ao, orbitals, r_thresh=1e-6)
+        # Each displaced point starts from the amplitudes converged here.
+        intermed["deriv"] = math_util.hellmann_test(solver, h_ao, p_ao, r_ao, orbitals, r_thresh=1e-6,
+                num_workers=kwargs.get("fd_workers", 1), guess=math_util.solvers.common.amplitudes(intermed))
 
     return intermed, orbitals
 
+
+def batch(molecules, solver, num_workers=1, warm_start=True, **kwargs):
+    """
+    Run subspace for each of a list of molecules, like the points of a scan or of a finite difference stencil,
+    and return the list of its results, in order. Options are passed to subspace for every point.
+
+    The molecules are split into num_workers runs of neighboring points, each solved by its own process.
+    Within a run, if warm_start, each point starts from the converged amplitudes of the point before it,
+    kept in a new GuessStore, or in the guess_store option if one is given.
+    With more than one worker, the solver and the options are pickled, as the solvers of the method modules can be.
+    """
+    num_workers = max(1, min(num_workers, len(molecules)))
+    size = -(-len(molecules) // num_workers)
+    chunks = [molecules[i:i + size] for i in range(0, len(molecules), size)]
+    if num_workers == 1:
+        return _run_chunk(chunks[0] if chunks else [], solver, warm_start, kwargs)
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        futures = [pool.submit(_run_chunk, chunk, solver, warm_start, kwargs, detach=True) for chunk in chunks]
+        return [result for future in futures for result in future.result()]
+
+def _run_chunk(molecules, solver, warm_start, kwargs, detach=False):
+    """ Solve the molecules in order, as batch does within one process. If detach, return the intermediates
+    as plain dicts, without the integral providers, so they can be sent between processes. """
+    results = []
+    options = dict(kwargs)
+    if warm_start:
+        options.setdefault("guess_store", math_util.solvers.common.GuessStore())
+    for molecule in molecules:
+        intermed, orbitals = subspace(molecule, solver, **options)
+        results.append((dict(intermed) if detach else intermed, orbitals))
+    return results
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+from pilot_implementations.math_util.convergence import DirectSumDiis
+
+@pytest.mark.parametrize("on_disk", [False, True])
+def test_diis(tmp_path, on_disk):
+    # Jacobi steps on a linear system, extrapolated over more steps than the ring buffer holds, in chunks of rows.
+    rng = np.random.default_rng(7)
+    A = np.eye(30) + 0.3 * rng.random((30, 30)) / np.sqrt(30)
+    b = rng.random(30)
+    diis = DirectSumDiis(3, 5, tmp_path if on_disk else None, chunk_size=7)
+    t1, t2 = np.zeros(6), np.zeros((6, 4))
+    for _ in range(12):
+        r = b - A @ np.concatenate([t1, t2.ravel()])
+        t1 += r[:6]
+        t2 += r[6:].reshape(6, 4)
+        new = diis.diis((r[:6], r[6:].reshape(6, 4)), (t1, t2))
+        assert new[0] is t1 and new[1] is t2
+    assert np.allclose(np.concatenate([t1, t2.ravel()]), np.linalg.solve(A, b))
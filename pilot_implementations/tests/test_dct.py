@@ -92,4 +92,3 @@ def test_template(inp):
     np.testing.assert_approx_equal(vals["energy"], inp["energy"], significant=10)
     if inp["test"]:
         np.testing.assert_allclose(vals["mu"], vals["deriv"], atol=1.0e-10)
-
@@ -21,7 +21,9 @@ np.set_printoptions(precision=10)
     pytest.param({"solver": taylor.o_spinorbital.D2.simultaneous}, id="UCCD2"),
     pytest.param({"solver": taylor.o_unrestricted.D2.simultaneous}, id="UCCD2_SI"),
     pytest.param({"solver": taylor.o_spinorbital.DT2U.simultaneous}, id="UCCDT2"),
-    pytest.param({"solver": taylor.o_unrestricted.DT2U.simultaneous}, id="UCCDT2_SI")
+    pytest.param({"solver": taylor.o_unrestricted.DT2U.simultaneous}, id="UCCDT2_SI"),
+    pytest.param({"solver": taylor.o_spinorbital.D2.simultaneous, "frozen_core": 1}, id="UCCD2_FC"),
+    pytest.param({"solver": o_dct.spinorbital.odc12.simultaneous, "frozen_core": 1, "frozen_virtual": 1}, id="LDCTD2_FC_FV")
     ]
 )
 def test_gradient(inp):
@@ -58,7 +60,8 @@ def test_gradient(inp):
             "geom": geom_arr,
             "basis": psi4.core.get_global_option("basis")
         }
-        vals = pilot.subspace(molecule=mol_dict, solver=inp["solver"], comp_grad=True, e_thresh=1e-9, r_thresh=1e-9, **kwargs)[0]
+        vals = pilot.subspace(molecule=mol_dict, solver=inp["solver"], comp_grad=True, e_thresh=1e-9, r_thresh=1e-9,
+            frozen_core=inp.get("frozen_core", 0), frozen_virtual=inp.get("frozen_virtual", 0), **kwargs)[0]
         psi4.core.set_variable('CURRENT ENERGY', vals["energy"])
         basis = psi4.core.BasisSet.build(molecule, 'BASIS', mol_dict["basis"], quiet=True)
         wfn = psi4.core.Wavefunction(molecule, basis)
@@ -0,0 +1,527 @@
+from collections import OrderedDict
+from copy import deepcopy
+import importlib.util
+import sys
+import textwrap
+
+import numpy as np
+import pytest
+
+from pilot_implementations import multilinear as mla
+from pilot_implementations.multilinear.tensor import einsum
+from pilot_implementations.scripts.prdm import common
+
+def generated_module(tmp_path, source):
+    """ Import source as a module of generated code, which the planner recognizes by its _param suffix. """
+    path = tmp_path / "test_param.py"
+    path.write_text(textwrap.dedent(source))
+    spec = importlib.util.spec_from_file_location("test_param", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def antisymmetric_tensor(shape, *pairs):
+    tensor = np.random.default_rng(0).random(shape)
+    return mla.antisymmetrize_axes(tensor, *pairs)
+
+def test_path_cache():
+    a, b = np.ones((3, 4)), np.ones((4, 5))
+    mla.clear_path_cache()
+    assert mla.path_cache_info() == (0, 0, 0)
+    einsum("ij, jk -> ik", a, b)
+    assert mla.path_cache_info() == (0, 1, 1)
+    assert np.allclose(einsum("ij, jk -> ik", a, b), 4)
+    assert mla.path_cache_info() == (1, 1, 1)
+    # A new shape or dtype is planned again. Keyword arguments go straight to opt_einsum.
+    einsum("ij, jk -> ik", np.ones((3, 4)), np.ones((4, 6)))
+    einsum("ij, jk -> ik", a, b.astype(complex))
+    einsum("ij, jk -> ik", a, b, optimize="greedy")
+    assert mla.path_cache_info() == (1, 3, 3)
+    mla.clear_path_cache()
+    assert mla.path_cache_info() == (0, 0, 0)
+
+def test_path_cache_size(monkeypatch):
+    monkeypatch.setattr(mla.tensor, "PATH_CACHE_SIZE", 2)
+    mla.clear_path_cache()
+    first, second, third = (np.ones((n, n)) for n in (2, 3, 4))
+    einsum("ij, jk -> ik", first, first)
+    einsum("ij, jk -> ik", second, second)
+    # Using the first path makes the second the least recently used, so it goes when a third is planned.
+    einsum("ij, jk -> ik", first, first)
+    einsum("ij, jk -> ik", third, third)
+    assert mla.path_cache_info() == (1, 3, 2)
+    einsum("ij, jk -> ik", first, first)
+    einsum("ij, jk -> ik", second, second)
+    assert mla.path_cache_info() == (2, 4, 2)
+    mla.clear_path_cache()
+
+def test_packed_round_trip():
+    t2 = antisymmetric_tensor((4, 4, 6, 6), (0, 1), (2, 3))
+    packed = mla.packed.pack(t2, ((0, 1), (2, 3)))
+    assert packed.data.shape == (6, 15)
+    assert np.allclose(packed.unpack(), t2)
+    assert np.allclose(np.asarray(packed), t2)
+
+def test_packed_rank_three():
+    tensor = mla.antisymmetrize_axes_plus(np.random.default_rng(0).random((3, 5, 5, 5)), ((1,), (2,), (3,)))
+    packed = mla.packed.pack(tensor, ((1, 2, 3),))
+    assert packed.data.shape == (3, 10)
+    assert np.allclose(packed.unpack(), tensor)
+
+def test_packed_arithmetic():
+    t2 = antisymmetric_tensor((4, 4, 6, 6), (0, 1), (2, 3))
+    packed = mla.packed.pack(t2, ((0, 1), (2, 3)))
+    assert np.allclose((2 * packed - t2).unpack(), t2)
+    packed += t2
+    assert np.allclose(packed.unpack(), 2 * t2)
+    assert np.isclose(packed.vdot(t2), 2 * np.vdot(t2, t2))
+    assert np.isclose(packed.norm(), 2 * np.linalg.norm(t2))
+    assert np.isclose(einsum("ijab, ijab ->", packed, t2), 2 * np.vdot(t2, t2))
+
+def test_packed_groups():
+    assert mla.packed.antisymmetric_groups("vvvv") == ((0, 1), (2, 3))
+    assert mla.packed.antisymmetric_groups("ooov") == ((0, 1),)
+    assert mla.packed.antisymmetric_groups("ovov") == ()
+    with pytest.raises(ValueError):
+        mla.PackedTensor(np.zeros(6), (4, 5), ((0, 1),))
+
+def test_packed_contraction():
+    g = antisymmetric_tensor((5, 5, 4, 4), (0, 1), (2, 3))
+    t2 = antisymmetric_tensor((3, 3, 5, 5), (0, 1), (2, 3))
+    x = np.random.default_rng(1).random((3, 5))
+    y = np.random.default_rng(2).random((3, 5, 4, 4))
+    packed = mla.packed.pack(g, ((0, 1), (2, 3)))
+    # Both pairs summed with t2, one pair summed and one kept, and each index of a pair summed with a different operand.
+    for subscripts, operands in [("abcd, ijab -> ijcd", (packed, t2)), ("ijab, abcd -> ijcd", (t2, packed)),
+                                 ("abcd, ijba -> ijcd", (packed, t2)), ("abcd, ia, jbcd -> ij", (packed, x, y))]:
+        dense = [g if operand is packed else operand for operand in operands]
+        assert np.allclose(einsum(subscripts, *operands), np.einsum(subscripts, *dense))
+    # Only the pairs that can't be contracted directly are unpacked, and only for that contraction.
+    assert mla.packed.contract_packed("ijab, abcd -> ijcd", (t2, packed))[1][1].shape == (10, 4, 4)
+    assert mla.packed.contract_packed("abcd, ia, jbcd -> ij", (packed, x, y))[1][0].shape == (5, 5, 6)
+    assert packed.unpack() is not packed.unpack()
+    intermed = {"g": packed, "t2": t2, "r2": np.zeros((3, 3, 4, 4))}
+    mla.plan.Contraction("r2", "ijab, abcd -> ijcd", ("t2", "g"), -1 / 2, (), True, False)(intermed)
+    assert np.allclose(intermed["r2"], -np.einsum("ijab, abcd -> ijcd", t2, g) / 2)
+    assert vars(packed).keys() == {"data", "shape", "groups"}
+
+def test_antisymmetrize_axes_plus():
+    tensor = np.random.default_rng(0).random((3, 3, 4, 4))
+    expected = tensor - tensor.transpose(1, 0, 2, 3)
+    expected = expected - expected.transpose(0, 1, 3, 2)
+    assert np.allclose(mla.antisymmetrize_axes_plus(tensor, ((0,), (1,)), ((3,), (2,))), expected)
+    out = np.empty(tensor.shape)
+    assert mla.antisymmetrize_axes_plus(tensor, ((0,), (1,)), ((3,), (2,)), out=out) is out
+    assert np.allclose(out, expected)
+    # P(i/jk) on a tensor already antisymmetric in jk
+    tensor = mla.antisymmetrize_axes(np.random.default_rng(1).random((3, 3, 3)), (1, 2))
+    expected = tensor - tensor.transpose(1, 0, 2) - tensor.transpose(2, 1, 0)
+    assert np.allclose(mla.antisymmetrize_axes_plus(tensor, ((0,), (1, 2))), expected)
+
+def test_integral_transformer():
+    rng = np.random.default_rng(0)
+    n = 6
+    h_ao = rng.random((n, n))
+    h_ao = h_ao + h_ao.T
+    r_ao = rng.random((n, n, n, n))
+    r_ao = r_ao + r_ao.transpose(2, 1, 0, 3)
+    r_ao = r_ao + r_ao.transpose(0, 3, 2, 1)
+    r_ao = r_ao + r_ao.transpose(1, 0, 3, 2)
+    orbitals = OrderedDict(o=(rng.random((n, 2)), rng.random((n, 1))), v=(rng.random((n, 4)), rng.random((n, 5))))
+    strings = ["oo", "ov", "vv", "oooo", "oovv", "ovov", "ooov", "vvvv"]
+    transformer = mla.IntegralTransformer(h_ao, r_ao)
+    assert transformer.update(orbitals) == {(space, spin) for space in "ov" for spin in "αβ"}
+    blocks = transformer.request_asym(strings)
+    expected = mla.request_asym(h_ao, orbitals, strings[:3]) | mla.request_asym(r_ao, orbitals, strings[3:])
+    for string in strings:
+        assert np.allclose(blocks[string], expected[string])
+    # The unrestricted blocks are the spin blocks of the spin orbital ones.
+    assert np.allclose(transformer.antisymmetrized("ovov", "αα"), blocks["ovov"][:2, :4, :2, :4])
+    assert np.allclose(transformer.antisymmetrized("ovov", "αβ"), blocks["ovov"][:2, 4:, :2, 4:])
+
+    # Unchanged orbitals reuse every block. Changed orbitals only recompute the blocks that depend on them.
+    assert not transformer.update(deepcopy(orbitals))
+    assert transformer.request_asym(["oooo"])["oooo"] is blocks["oooo"]
+    orbitals["v"] = (orbitals["v"][0] + 1e-3, orbitals["v"][1])
+    assert transformer.update(orbitals) == {("v", "α")}
+    assert transformer.request_asym(["oooo"])["oooo"] is blocks["oooo"]
+    assert np.allclose(transformer.request_asym(["oovv"])["oovv"], mla.request_asym(r_ao, orbitals, ["oovv"])["oovv"])
+
+def test_packed_integrals():
+    # The transformer keeps a packed block in place of the dense one, not next to it.
+    rng = np.random.default_rng(13)
+    r_ao = rng.random((5, 5, 5, 5))
+    r_ao = r_ao + r_ao.transpose(1, 0, 3, 2)
+    orbitals = OrderedDict(o=(rng.random((5, 2)), rng.random((5, 2))), v=(rng.random((5, 3)), rng.random((5, 3))))
+    transformer, reference = mla.IntegralTransformer(np.eye(5), r_ao), mla.IntegralTransformer(np.eye(5), r_ao)
+    transformer.update(orbitals)
+    reference.update(orbitals)
+    g_vvvv = transformer.spinorbital_block("g_vvvv", packed=True)
+    assert isinstance(g_vvvv, mla.PackedTensor) and np.allclose(g_vvvv.unpack(), reference.spinorbital("vvvv"))
+    assert transformer.spinorbital_block("g_vvvv", packed=True) is g_vvvv
+    assert isinstance(transformer.spinorbital_block("g_ovov", packed=True), np.ndarray)
+    assert sorted(kind for kind, _ in transformer.cache if kind != "half") == ["g", "packed"]
+
+def test_lazy_integrals():
+    rng = np.random.default_rng(1)
+    n = 5
+    r_ao = rng.random((n, n, n, n))
+    r_ao = r_ao + r_ao.transpose(2, 1, 0, 3)
+    r_ao = r_ao + r_ao.transpose(0, 3, 2, 1)
+    r_ao = r_ao + r_ao.transpose(1, 0, 3, 2)
+    orbitals = OrderedDict(o=(rng.random((n, 2)), rng.random((n, 2))), v=(rng.random((n, 3)), rng.random((n, 3))))
+    transformer = mla.IntegralTransformer(np.eye(n), r_ao)
+    transformer.update(orbitals)
+    intermediates = mla.LazyIntegrals({"t2": 0}, transformer.unrestricted_block)
+    assert "g_oovv_αβ" not in intermediates
+    block = intermediates["g_oovv_αβ"]
+    assert np.allclose(block, einsum("pqrs, pP, qQ, rR, sS -> PQRS", r_ao, orbitals["o"][0], orbitals["o"][1], orbitals["v"][0], orbitals["v"][1]))
+    assert np.allclose(intermediates["g_vvoo_αβ"], block.transpose(2, 3, 0, 1))
+    assert intermediates.provided == {"g_oovv_αβ", "g_vvoo_αβ"}
+    with pytest.raises(KeyError):
+        intermediates["rdm_oo"]
+    intermediates.refresh()
+    assert "g_oovv_αβ" not in intermediates and "t2" in intermediates
+
+def test_closed_shell_intermediates():
+    rng = np.random.default_rng(4)
+    n = 5
+    r_ao = rng.random((n, n, n, n))
+    r_ao = r_ao + r_ao.transpose(2, 1, 0, 3)
+    r_ao = r_ao + r_ao.transpose(0, 3, 2, 1)
+    r_ao = r_ao + r_ao.transpose(1, 0, 3, 2)
+    Co, Cv = rng.random((n, 2)), rng.random((n, 3))
+    orbitals = OrderedDict(o=(Co, Co.copy()), v=(Cv, Cv.copy()))
+    transformer = mla.IntegralTransformer(rng.random((n, n)), r_ao)
+    transformer.update(orbitals)
+    unrestricted = mla.LazyIntegrals({}, transformer.unrestricted_block)
+    t2_αα = antisymmetric_tensor((2, 2, 3, 3), (0, 1), (2, 3))
+    intermediates = mla.ClosedShellIntermediates({"t2_αα": t2_αα, "t2_ββ": None}, transformer.unrestricted_block)
+    assert "t2_ββ" in intermediates and list(intermediates) == ["t2_αα"]
+    assert np.allclose(intermediates["t2_ββ"], t2_αα)
+    for key in ["h_vv_β", "g_oooo_ββ", "g_vovo_αβ", "g_oovo_αβ", "g_vovv_αβ", "g_ovvo_αβ", "g_ovov_αβ"]:
+        assert np.allclose(intermediates[key], unrestricted[key])
+    assert intermediates.provided == {"h_vv_α", "g_oooo_αα", "g_ovov_αβ", "g_ooov_αβ", "g_ovvv_αβ", "g_ovvo_αβ"}
+    # The block with fewer beta indices is the one stored. Writing the other one does nothing.
+    intermediates["t2_ββ"] = 0
+    assert intermediates["t2_αα"] is t2_αα
+    # The other one is a read-only view, which a generated term adds to out of place.
+    flipped = intermediates["g_vovo_αβ"]
+    assert np.shares_memory(flipped, intermediates["g_ovov_αβ"]) and not flipped.flags.writeable
+    stored = intermediates["g_ovov_αβ"].copy()
+    intermediates["g_vovo_αβ"] = mla.einsum_add(flipped, "ia, jb -> aibj", np.ones((2, 3)), np.ones((2, 3)))
+    assert np.array_equal(intermediates["g_ovov_αβ"], stored)
+    assert mla.integrals.closed_shell_key("t3_αββ") == ("t3_ααβ", (2, 0, 1, 5, 3, 4))
+
+def test_integral_transform_stages():
+    rng = np.random.default_rng(2)
+    n = 6
+    r_ao = rng.random((n, n, n, n))
+    r_ao = r_ao + r_ao.transpose(2, 1, 0, 3)
+    r_ao = r_ao + r_ao.transpose(0, 3, 2, 1)
+    r_ao = r_ao + r_ao.transpose(1, 0, 3, 2)
+    orbitals = OrderedDict(o=(rng.random((n, 2)), rng.random((n, 1))), v=(rng.random((n, 4)), rng.random((n, 5))))
+    keys = ["g_vovo_αβ", "g_oovv_αα", "g_vvoo_αα", "g_ovvv_ββ", "h_ov_β"]
+    transformer = mla.IntegralTransformer(np.eye(n), r_ao)
+    transformer.update(orbitals)
+    blocks = transformer.transform(keys, transformer.unrestricted_block, num_threads=2)
+    assert list(blocks) == keys
+    Coa, Cob = orbitals["o"]
+    Cva, Cvb = orbitals["v"]
+    assert np.allclose(blocks["g_vovo_αβ"], einsum("pqrs, pP, qQ, rR, sS -> PQRS", r_ao, Cva, Cob, Cva, Cob))
+    assert np.allclose(blocks["g_vvoo_αα"], blocks["g_oovv_αα"].transpose(2, 3, 0, 1))
+    expected = einsum("pqrs, pP, qQ, rR, sS -> PQRS", r_ao, Cob, Cvb, Cvb, Cvb)
+    assert np.allclose(blocks["g_ovvv_ββ"], expected - expected.swapaxes(2, 3))
+    assert np.allclose(blocks["h_ov_β"], Cob.T @ Cvb)
+    assert not transformer.quarters
+
+def test_irrep_tensor():
+    rng = np.random.default_rng(5)
+    occ, vir = np.array([0, 0, 1, 3]), np.array([0, 1, 1, 2, 3, 3, 0])
+    irreps = {"o": (occ, occ), "v": (vir, vir)}
+    t2 = mla.IrrepTensor.from_dense(antisymmetric_tensor((4, 4, 7, 7), (0, 1), (2, 3)), (occ, occ, vir, vir))
+    g = mla.IrrepTensor.from_dense(rng.random((4, 4, 7, 7)), mla.symmetry.key_irreps("g_oovv_αβ", irreps))
+    assert t2.nbytes < np.asarray(t2).nbytes / 3
+    assert np.allclose(mla.IrrepTensor.from_dense(np.asarray(t2), t2.irreps).unpack(), np.asarray(t2))
+    dense_t2, dense_g = np.asarray(t2), np.asarray(g)
+    # Contractions are done block by block, with or without an explicit output.
+    result = einsum("ij ab, kj ab -> ik", t2, g)
+    assert isinstance(result, mla.IrrepTensor)
+    assert np.allclose(np.asarray(result), einsum("ij ab, kj ab -> ik", dense_t2, dense_g))
+    assert np.isclose(einsum("IJ AB, IJ AB", t2, g), einsum("IJ AB, IJ AB", dense_t2, dense_g))
+    # A dense operand unpacks the blocked ones.
+    t1 = rng.random((4, 7))
+    assert np.allclose(einsum("ij ab, kb -> ijak", t2, t1), einsum("ij ab, kb -> ijak", dense_t2, t1))
+    # Arithmetic with dense arrays keeps the blocks.
+    hess = rng.random((4, 4, 7, 7)) + 1
+    step = t2 + g / hess
+    assert isinstance(step, mla.IrrepTensor)
+    assert np.allclose(np.asarray(step), np.asarray(mla.IrrepTensor.from_dense(dense_t2 + dense_g / hess, t2.irreps)))
+    assert isinstance(hess + t2, mla.IrrepTensor) and np.allclose(np.asarray(hess - t2), np.asarray(-(t2 - hess)))
+    # Arithmetic in place on a dense array unpacks the blocks into it.
+    array = hess.copy()
+    array += t2
+    assert isinstance(array, np.ndarray) and np.allclose(array, hess + dense_t2)
+    assert np.isclose(t2.vdot(g), np.vdot(dense_t2, dense_g)) and np.isclose(t2.norm(), np.linalg.norm(dense_t2))
+    assert np.allclose(np.asarray(mla.antisymmetrize_axes_plus(g, ((0,), (1,)))), mla.antisymmetrize_axes_plus(dense_g, ((0,), (1,))))
+    # The transformer blocks two-electron integrals when it knows the irreps.
+    orbitals = OrderedDict(o=(rng.random((5, 4)), rng.random((5, 4))), v=(rng.random((5, 7)), rng.random((5, 7))))
+    blocked = mla.IntegralTransformer(np.eye(5), rng.random((5, 5, 5, 5)), irreps=irreps)
+    blocked.update(orbitals)
+    dense = mla.IntegralTransformer(np.eye(5), blocked.r_ao)
+    dense.update(orbitals)
+    assert isinstance(blocked.spinorbital_block("g_oovv"), mla.IrrepTensor)
+    assert np.allclose(np.asarray(blocked.unrestricted_block("g_vovo_αβ")), np.asarray(mla.IrrepTensor.from_dense(dense.unrestricted_block("g_vovo_αβ"), mla.symmetry.key_irreps("g_vovo_αβ", irreps))))
+
+def test_cholesky_vectors():
+    rng = np.random.default_rng(3)
+    n = 5
+    factors = rng.random((n, n, 8))
+    factors = factors + factors.transpose(1, 0, 2)
+    r_ao = einsum("prQ, qsQ -> pqrs", factors, factors)
+    vectors = mla.CholeskyVectors.from_dense(r_ao, 1e-12)
+    assert vectors.naux <= 8
+    assert np.allclose(vectors.to_dense(), r_ao)
+    orbitals = OrderedDict(o=(rng.random((n, 2)), rng.random((n, 1))), v=(rng.random((n, 3)), rng.random((n, 4))))
+    dense = mla.IntegralTransformer(np.eye(n), r_ao)
+    factorized = mla.IntegralTransformer(np.eye(n), vectors)
+    for transformer in (dense, factorized):
+        transformer.update(orbitals)
+    for spaces in ("oooo", "ovov", "ovvv", "vvvv"):
+        assert np.allclose(dense.spinorbital(spaces), factorized.spinorbital(spaces))
+        assert np.allclose(dense.antisymmetrized(spaces, "αβ"), factorized.antisymmetrized(spaces, "αβ"))
+    assert not any(kind == "half" for kind, _ in factorized.cache)
+    assert np.allclose(mla.request_asym(vectors, orbitals, ["oovv"])["oovv"], dense.spinorbital("oovv"))
+    with pytest.raises(ValueError, match="two-electron"):
+        mla.request_asym(vectors, orbitals, ["oo", "oovv"])
+
+    # Blocks with three virtual indices or more stay as vectors, and are contracted through them.
+    g_vvvv, g_ovvv = factorized.spinorbital("vvvv"), factorized.antisymmetrized("ovvv", "αα")
+    assert isinstance(g_vvvv, mla.cholesky.FactorizedBlock) and isinstance(factorized.spinorbital("oovv"), np.ndarray)
+    # Every pair of its indices shares the same vv vectors.
+    assert g_vvvv.shape == (7, 7, 7, 7) and g_vvvv.nbytes == vectors.naux * 7 * 7 * 8
+    t2 = antisymmetric_tensor((3, 3, 7, 7), (0, 1), (2, 3))
+    expected = np.einsum("abcd, ijcd -> ijab", dense.spinorbital("vvvv"), t2)
+    assert np.allclose(einsum("ab cd, ij cd -> ij ab", g_vvvv, t2), expected)
+    assert np.allclose(mla.einsum_add(np.zeros_like(t2), "cd ab, ij cd -> ij ab", g_vvvv.transpose(2, 3, 0, 1), t2, weight=-1/2), -expected / 2)
+    term = mla.plan.Contraction("r2", "ab cd, ij cd -> ij ab", ("g_vvvv", "t2"), 1/2, (), True, False)
+    intermed = {"g_vvvv": g_vvvv, "t2": t2, "r2": np.zeros_like(t2)}
+    term(intermed)
+    assert np.allclose(intermed["r2"], expected / 2)
+    t1 = rng.random((2, 3))
+    assert np.allclose(einsum("ia bc, ib -> ac", g_ovvv, t1), np.einsum("iabc, ib -> ac", dense.antisymmetrized("ovvv", "αα"), t1))
+    closed_shell = mla.ClosedShellIntermediates({}, factorized.unrestricted_block)
+    assert np.allclose(closed_shell["g_vovv_αβ"], dense.antisymmetrized("ovvv", "αβ").transpose(1, 0, 3, 2))
+
+def test_mso_to_spatial():
+    rng = np.random.default_rng(4)
+    n = 4
+    ci = (rng.random((n, 2)), rng.random((n, 1)))
+    cv = (rng.random((n, 2)), rng.random((n, 3)))
+    tensor = rng.random((3, 5, 3, 5))
+    aso = mla.mso_to_aso(tensor, (ci, cv, ci, cv)).reshape(2, n, 2, n, 2, n, 2, n)
+    # Sum the spin orbital AO tensor over the spins of each electron.
+    expected = sum(aso[s, :, t, :, s, :, t, :] for s in range(2) for t in range(2))
+    assert np.allclose(mla.mso_to_spatial(tensor, (ci, cv, ci, cv), ((0, 2), (1, 3))), expected)
+    expected = sum(aso[s, :, t, :, t, :, s, :] for s in range(2) for t in range(2))
+    assert np.allclose(mla.mso_to_spatial(tensor, (ci, cv, ci, cv), ((0, 3), (1, 2))), expected)
+
+def test_frozen_core():
+    rng = np.random.default_rng(5)
+    n = 6
+    h_ao = rng.random((n, n))
+    h_ao = h_ao + h_ao.T
+    factors = rng.random((n, n, 10))
+    factors = factors + factors.transpose(1, 0, 2)
+    r_ao = einsum("prQ, qsQ -> pqrs", factors, factors)
+    orbitals = OrderedDict(o=(rng.random((n, 3)), rng.random((n, 2))), v=(rng.random((n, 3)), rng.random((n, 4))))
+    frozen = mla.freeze(orbitals, 1, 2)
+    assert list(frozen) == ["c", "o", "v", "w"]
+    assert [x.shape[1] for space in frozen.values() for x in space] == [1, 1, 2, 1, 1, 2, 2, 2]
+    assert np.allclose(frozen["c"][1], orbitals["o"][1][:, :1]) and np.allclose(frozen["w"][0], orbitals["v"][0][:, 1:])
+
+    # The core enters the correlated orbitals as a potential, and the energy as a constant.
+    reference = mla.IntegralTransformer(h_ao, r_ao)
+    reference.update(OrderedDict(x=frozen["c"], o=frozen["o"]))
+    g_xoxo = reference.spinorbital("xoxo")
+    g_xxxx = reference.spinorbital("xxxx")
+    core_energy = np.trace(reference.spinorbital_one_electron("xx")) + 0.5 * einsum("ijij ->", g_xxxx)
+    for r in (r_ao, mla.CholeskyVectors.from_dense(r_ao, 1e-12)):
+        transformer = mla.IntegralTransformer(h_ao, r)
+        transformer.update(frozen)
+        assert np.isclose(transformer.core_energy(), core_energy)
+        expected = reference.spinorbital_one_electron("oo") + einsum("cicj -> ij", g_xoxo)
+        assert np.allclose(transformer.spinorbital_one_electron("oo"), expected)
+        assert np.allclose(transformer.one_electron(("o", "β"), ("o", "β")), expected[2:, 2:])
+
+def test_einsum_add():
+    rng = np.random.default_rng(8)
+    f_oo, t2 = rng.random((3, 3)), rng.random((3, 3, 4, 4))
+    antisymmetrizer = (((1,), (0,)), ((3,), (2,)))
+    expected = -2 * mla.antisymmetrize_axes_plus(einsum("Ii, JiAB -> IJAB", f_oo, t2), *antisymmetrizer)
+    # The first term of an iteration adds to the 0 of the reset. Later terms add into that array in place.
+    target = mla.einsum_add(0, "Ii, JiAB -> IJAB", f_oo, t2, weight=-2, antisymmetrizer=antisymmetrizer)
+    assert np.allclose(target, expected)
+    result = mla.einsum_add(target, "Ii, JiAB -> IJAB", f_oo, t2, weight=-2, antisymmetrizer=antisymmetrizer[:1])
+    assert result is target
+    assert np.allclose(result, expected - 2 * mla.antisymmetrize_axes_plus(einsum("Ii, JiAB -> IJAB", f_oo, t2), *antisymmetrizer[:1]))
+    # An identity contraction may return a view of its operand, which must not be aliased or modified.
+    copy = mla.einsum_add(0, "IJAB -> IJAB", t2)
+    copy += 1
+    assert not np.allclose(copy, t2)
+
+def test_weighted_operand_types():
+    # The weight scales a scalar, a FactorizedBlock's term weights or a PackedTensor's unique elements alike.
+    rng = np.random.default_rng(12)
+    vectors, t2 = rng.random((5, 3, 3)), antisymmetric_tensor((2, 2, 3, 3), (0, 1), (2, 3))
+    g_vvvv = mla.cholesky.FactorizedBlock.antisymmetrized(vectors, vectors, vectors, vectors)
+    packed = mla.packed.pack(np.asarray(g_vvvv), ((0, 1), (2, 3)))
+    assert [mla.tensor.scaling_size(x) for x in (2.0, np.float64(2), g_vvvv, packed, t2)] == [0, 0, 0, 9, t2.size]
+    for subscripts, operands in [("IJab, -> IJab", (t2, 2.0)), ("abAB, IJab -> IJAB", (g_vvvv, t2)),
+                                 ("abAB, IJab -> IJAB", (packed, t2))]:
+        expected = -0.5 * np.einsum(subscripts, *(np.asarray(x) for x in operands))
+        assert np.allclose(mla.einsum_add(0, subscripts, *operands, weight=-0.5), expected)
+        intermed = {"r2": np.zeros_like(t2)} | {f"x{k}": x for k, x in enumerate(operands)}
+        mla.plan.Contraction("r2", subscripts, tuple(f"x{k}" for k in range(len(operands))), -0.5, (), True, False)(intermed)
+        assert np.allclose(intermed["r2"], expected)
+
+def test_compiled_function(tmp_path):
+    param = generated_module(tmp_path, """
+        from pilot_implementations import multilinear as mla
+        from pilot_implementations.multilinear.tensor import einsum
+
+        def cumulant(i):
+            i["c_oovv"] = -1/2 * einsum("IJ AB -> IJ AB", i["t2"]).copy()
+
+        def residual(i):
+            i["r2"] = mla.einsum_add(i["r2"], "IJ ij, ij AB -> IJ AB", i["g_oooo"], i["t2"])
+            i["r2"] = mla.einsum_add(i["r2"], "I i, Ji AB -> IJ AB", i["f_oo"], i["c_oovv"], weight=2, antisymmetrizer=(((0,), (1,)),))
+            i["r2"] = mla.einsum_add(i["r2"], "IJ AB -> IJ AB", i["g_oovv"], weight=2)
+        """)
+
+    def method(i):
+        common.zero_blocks(i, "r2")
+        param.cumulant(i)
+        param.residual(i)
+
+    rng = np.random.default_rng(5)
+    t2 = antisymmetric_tensor((3, 3, 4, 4), (0, 1), (2, 3))
+    provided = {"g_oooo": rng.random((3, 3, 3, 3)), "g_oovv": rng.random((3, 3, 4, 4)), "f_oo": rng.random((3, 3))}
+    expected, intermed = {"t2": t2, **provided}, {"t2": t2, **provided}
+    compiled = mla.plan.CompiledFunction(method)
+    for step in range(3):
+        method(expected)
+        compiled(intermed)
+        assert np.allclose(intermed["r2"], expected["r2"]) and np.allclose(intermed["c_oovv"], expected["c_oovv"])
+        expected["t2"] = intermed["t2"] = 2 * intermed["t2"]
+    assert [type(step).__name__ for step in compiled.plan] == ["Statement", "Contraction", "Contraction", "Contraction", "Contraction"]
+
+    # A function that can't be planned warns, naming itself and the reason, and runs as it is.
+    def branching(i):
+        if "r2" in i:
+            method(i)
+
+    compiled = mla.plan.CompiledFunction(branching)
+    with pytest.warns(UserWarning, match="(?s)branching.*straight-line"):
+        compiled(intermed)
+    assert compiled.plan is branching
+    method(expected)
+    assert np.allclose(intermed["r2"], expected["r2"])
+
+def test_compiled_intermediate(tmp_path):
+    # The form code_generator.cse prints a shared intermediate in.
+    param = generated_module(tmp_path, """
+        from pilot_implementations import multilinear as mla
+
+        def intermediates(i):
+            i["x1"] = mla.einsum("Ii ab, Ji ab -> IJ", i["t2"], i["t2"])
+        """)
+    t2 = np.random.default_rng(7).random((3, 3, 4, 4))
+    intermed = {"t2": t2}
+    plan = mla.plan.compile(param.intermediates, intermed)
+    step, = plan
+    assert isinstance(step, mla.plan.Contraction) and not step.accumulate
+    intermed["t2"] = 2 * t2
+    plan(intermed)
+    assert np.allclose(intermed["x1"], 4 * einsum("Ii ab, Ji ab -> IJ", t2, t2))
+
+def test_compiled_factorized(tmp_path):
+    param = generated_module(tmp_path, """
+        import numpy as np
+        from pilot_implementations import multilinear as mla
+        from pilot_implementations.multilinear.tensor import einsum
+
+        def residual(i):
+            # Scaling: o**3*v**2
+            temp1 = np.tensordot(i["f_oo"], i["t2"], axes=([1], [1]))
+            temp = 2 * temp1.transpose(0, 1, 2, 3)
+            i["r2"] = mla.accumulate(i["r2"], temp, (((0,), (1,)),))
+            # Scaling: o**4*v**2
+            temp1 = einsum("IjKj, KLAB -> ILAB", i["g_oooo"], i["t2"])
+            temp = -1/2 * temp1
+            i["r2"] = mla.accumulate(i["r2"], temp)
+        """)
+
+    def method(i):
+        common.zero_blocks(i, "r2")
+        param.residual(i)
+
+    rng = np.random.default_rng(6)
+    provided = {"t2": rng.random((3, 3, 4, 4)), "g_oooo": rng.random((3, 3, 3, 3)), "f_oo": rng.random((3, 3))}
+    expected, intermed = dict(provided), dict(provided)
+    calls = []
+    profiler = lambda frame, event, arg: calls.append(event)
+    compiled = mla.plan.CompiledFunction(method)
+    sys.setprofile(profiler)
+    try:
+        compiled(intermed)
+        # The trace hands the profiler back.
+        assert sys.getprofile() is profiler
+    finally:
+        sys.setprofile(None)
+    for step in range(2):
+        method(expected)
+        assert np.allclose(intermed["r2"], expected["r2"])
+        compiled(intermed)
+    assert [type(step).__name__ for step in compiled.plan] == ["Statement", "PairwiseTerm", "PairwiseTerm"]
+    assert compiled.plan.steps[1].operands == ("f_oo", "t2")
+    # Like any term, a factorized term of fixed operands is contracted once.
+    assert [type(step).__name__ for step in compiled.plan.hoist(lambda key: key != "t2")][1:] == ["PairwiseTerm"] * 2
+    assert [type(step).__name__ for step in compiled.plan.hoist(lambda key: True)][1:] == ["FixedTerm"] * 2
+
+def test_plan_hoist(tmp_path):
+    rng = np.random.default_rng(9)
+    g_oovv, g_vvvv, t2 = rng.random((2, 2, 3, 3)), rng.random((3, 3, 3, 3)), rng.random((2, 2, 3, 3))
+    term = lambda subscripts, operands, weight: mla.plan.Contraction("r2", subscripts, operands, weight, (), True, False)
+    plan = mla.plan.Plan([mla.plan.SetConstant("r2", 0), term("IJ AB -> IJ AB", ("g_oovv",), 2),
+        term("IJ ab, ab AB -> IJ AB", ("t2", "g_vvvv"), 0.5)]).hoist(lambda key: key.startswith("g"))
+    assert [type(step).__name__ for step in plan] == ["SetConstant", "FixedTerm", "Contraction"]
+    intermed = {"g_oovv": g_oovv, "g_vvvv": g_vvvv, "t2": t2}
+    plan(intermed)
+    assert np.allclose(intermed["r2"], 2 * g_oovv + 0.5 * einsum("IJ ab, ab AB -> IJ AB", t2, g_vvvv))
+    # The fixed term is added from its first value. The others are contracted every time.
+    intermed["g_oovv"] = np.zeros_like(g_oovv)
+    intermed["t2"] = 2 * t2
+    plan(intermed)
+    assert np.allclose(intermed["r2"], 2 * g_oovv + einsum("IJ ab, ab AB -> IJ AB", t2, g_vvvv))
+    # A statement may write the integrals, unless it declares what it writes, like zero_blocks.
+    def statement(source):
+        return mla.plan.Statement(source, compile(source, "<test>", "eval"), {"common": common}, {"i": intermed})
+    plan = mla.plan.Plan([statement("i.update(g_oovv=i['t2'])"), term("IJ AB -> IJ AB", ("g_oovv",), 2)])
+    assert [type(step).__name__ for step in plan.hoist(lambda key: key.startswith("g"))] == ["Statement", "Contraction"]
+
+    param = generated_module(tmp_path, """
+        from pilot_implementations import multilinear as mla
+
+        def residual(i):
+            i["r2"] = mla.einsum_add(i["r2"], "IJ AB -> IJ AB", i["g_oovv"], weight=2)
+        """)
+
+    def residual(i):
+        common.zero_blocks(i, "r2")
+        param.residual(i)
+
+    intermed["g_oovv"] = g_oovv
+    plan = mla.plan.compile(residual, intermed).hoist(lambda key: key.startswith("g"))
+    assert [type(step).__name__ for step in plan] == ["Statement", "FixedTerm"]
+    assert plan.steps[0].writes == {"r2"}
@@ -0,0 +1,218 @@
+from collections import OrderedDict
+from functools import partial
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from pilot_implementations import multilinear as mla
+from pilot_implementations.math_util.solvers import spinorbital, unrestricted
+from pilot_implementations.multilinear.tensor import einsum
+from pilot_implementations.scripts.prdm import common, restricted_param, spinorbital_param
+
+def closed_shell_model(n=6, nocc=2, ao_irreps=None):
+    """ Integrals of a small closed-shell model, its RHF orbitals, the same for both spins, and their irreps.
+    Given the irrep of each AO, the integrals are totally symmetric. """
+    rng = np.random.default_rng(3)
+    ao_irreps = np.zeros(n, dtype=int) if ao_irreps is None else np.asarray(ao_irreps)
+    h_ao = (np.diag(np.arange(n) - 3.0) + 0.1 * rng.random((n, n))) * (ao_irreps[:, None] == ao_irreps)
+    h_ao = h_ao + h_ao.T
+    auxiliary_irreps = np.arange(8) % (ao_irreps.max() + 1)
+    b = 0.1 * rng.random((8, n, n)) * ((ao_irreps[:, None] ^ ao_irreps) == auxiliary_irreps[:, None, None])
+    r_ao = einsum("Qpr, Qqs -> pqrs", b + b.transpose(0, 2, 1), b + b.transpose(0, 2, 1))
+    fock = h_ao
+    for _ in range(100):
+        coefficients = np.linalg.eigh(fock)[1]
+        density = coefficients[:, :nocc] @ coefficients[:, :nocc].T
+        fock = h_ao + 2 * einsum("pqrs, qs -> pr", r_ao, density) - einsum("pqsr, qs -> pr", r_ao, density)
+    irreps = ao_irreps[np.argmax(np.abs(coefficients), axis=0)]
+    occupied, virtual = coefficients[:, :nocc], coefficients[:, nocc:]
+    orbitals = OrderedDict(o=(occupied, occupied.copy()), v=(virtual, virtual.copy()))
+    return h_ao, r_ao, orbitals, OrderedDict(o=(irreps[:nocc],) * 2, v=(irreps[nocc:],) * 2)
+
+def test_restricted_iterations():
+    # Orbital-optimized D2 of a closed-shell reference, through every iteration of a restricted container: residuals,
+    # RDMs and cumulants are reset and rebuilt in the stored blocks only. It must match the spin-orbital energy.
+    proc = pytest.importorskip("pilot_implementations.scripts.prdm.taylor.proc")
+    h_ao, r_ao, orbitals, _ = closed_shell_model()
+
+    def method(param, residuals, build):
+        def residual(i):
+            common.zero_blocks(i, *residuals)
+            param.D2_cumulant_residual(i)
+            param.D2_opdm_residual(i)
+        return dict(compute_intermediates=partial(build, param.D2_cumulant, param.D2_opdm, lambda i: None),
+                    compute_amplitude_residual=residual)
+
+    expected, _ = spinorbital.simultaneous(0.0, h_ao, r_ao, orbitals,
+        compute_energy=common.hermitian_rdm_energy, compute_orbital_residual=spinorbital.hermitian_block_orbital_gradient,
+        compute_step=proc.simultaneous_step, initialize_intermediates=common.initialize_intermediates,
+        **method(spinorbital_param, ["r2"], proc.build_intermed))
+    for container in (mla.ClosedShellIntermediates, common.ClosedShellIntermediates):
+        intermediates, _ = unrestricted.simultaneous(0.0, h_ao, r_ao, orbitals, restricted=True, container=container,
+            compute_energy=common.hermitian_rdm_energy_SI, compute_orbital_residual=unrestricted.hermitian_block_orbital_gradient,
+            compute_step=proc.simultaneous_step_SI, initialize_intermediates=common.initialize_intermediates_SI,
+            **method(restricted_param, ["r2_αα", "r2_αβ", "r2_ββ"], proc.build_intermed_SI))
+        assert np.isclose(intermediates["energy"], expected["energy"], atol=1e-10)
+        assert set(intermediates) >= {"rdm_oovv_αα", "rdm_oooo_αβ", "rdm_oo_α"}
+        assert not {"rdm_oovv_ββ", "rdm_vovo_αβ", "rdm_oo_β", "r2_ββ"} & set(intermediates)
+
+@pytest.mark.parametrize("ao_irreps", [None, [0, 0, 1, 0, 1, 1, 0]], ids=["trivial", "C2"])
+def test_orbital_irreps(ao_irreps):
+    # SD2L with amplitudes, integrals and RDMs stored by irrep block, and a dense t1, against the dense energy.
+    SD2L = pytest.importorskip("pilot_implementations.scripts.prdm.taylor.singles_spinorbital.SD2L")
+    h_ao, r_ao, orbitals, irreps = closed_shell_model(n=7, ao_irreps=ao_irreps)
+    expected, _ = SD2L.simultaneous(0.0, h_ao, r_ao, orbitals)
+    for compile_plan in (False, True):
+        intermediates, _ = SD2L.simultaneous(0.0, h_ao, r_ao, orbitals, orbital_irreps=irreps, compile_plan=compile_plan)
+        assert np.isclose(intermediates["energy"], expected["energy"], atol=1e-10)
+        assert isinstance(intermediates["t2"], mla.IrrepTensor) and isinstance(intermediates["rdm_oovv"], mla.IrrepTensor)
+        assert isinstance(intermediates["t1"], np.ndarray)
+
+@pytest.mark.parametrize("restricted", [False, True], ids=["spinorbital", "restricted"])
+def test_cholesky_energy(restricted):
+    # With Cholesky vectors, the container tells the glue to build the Fock matrix and energy from the b blocks.
+    proc = pytest.importorskip("pilot_implementations.scripts.prdm.taylor.proc")
+    h_ao, r_ao, orbitals, _ = closed_shell_model()
+    if restricted:
+        options = dict(solver=unrestricted.simultaneous, param=restricted_param, residuals=["r2_αα", "r2_αβ", "r2_ββ"],
+            build=proc.build_intermed_SI, compute_energy=common.hermitian_rdm_energy_SI,
+            compute_orbital_residual=unrestricted.hermitian_block_orbital_gradient, compute_step=proc.simultaneous_step_SI,
+            initialize_intermediates=common.initialize_intermediates_SI, restricted=True)
+    else:
+        options = dict(solver=spinorbital.simultaneous, param=spinorbital_param, residuals=["r2"], build=proc.build_intermed,
+            compute_energy=common.hermitian_rdm_energy, compute_orbital_residual=spinorbital.hermitian_block_orbital_gradient,
+            compute_step=proc.simultaneous_step, initialize_intermediates=common.initialize_intermediates)
+    solver, param, residuals, build = (options.pop(key) for key in ("solver", "param", "residuals", "build"))
+
+    def residual(i):
+        common.zero_blocks(i, *residuals)
+        param.D2_cumulant_residual(i)
+        param.D2_opdm_residual(i)
+    options.update(compute_intermediates=partial(build, param.D2_cumulant, param.D2_opdm, lambda i: None), compute_amplitude_residual=residual)
+
+    expected, _ = solver(0.0, h_ao, r_ao, orbitals, **options)
+    intermediates, _ = solver(0.0, h_ao, mla.CholeskyVectors.from_dense(r_ao, 1e-12), orbitals, **options)
+    assert np.isclose(intermediates["energy"], expected["energy"], atol=1e-10)
+    assert intermediates.factorized and not expected.factorized and "factorized" not in intermediates
+
+def test_zero_blocks_closed_shell():
+    # Flipped keys reset the stored block, once, however many times they are zeroed.
+    r2 = np.ones((2, 2, 3, 3))
+    intermediates = mla.ClosedShellIntermediates({"r2_αα": r2}, None)
+    for _ in range(2):
+        common.zero_blocks(intermediates, "r2_αα", "r2_ββ", "rdm_oo_β")
+    assert intermediates["r2_αα"] is r2 and not r2.any()
+    assert list(intermediates) == ["r2_αα", "rdm_oo_α"] and intermediates["rdm_oo_β"] == 0
+    assert common.stored_keys(intermediates, ["r2_ββ", "r2_αα", "r2_αβ"]) == ["r2_αα", "r2_αβ"]
+    assert common.stored_keys({}, ["r2_ββ", "r2_αα"]) == ["r2_ββ", "r2_αα"]
+
+def test_closed_shell_dispatch():
+    unrestricted = SimpleNamespace(D2_opdm=lambda i: i.update(rdm_oo_α=1, rdm_oo_β=1), S2_opdm_U=lambda i: i.update(rdm_ov_α=2))
+    restricted = SimpleNamespace(D2_opdm=lambda i: i.update(rdm_oo_α=1))
+    param = common.ClosedShellDispatch(unrestricted, restricted)
+    intermediates = mla.ClosedShellIntermediates({}, None)
+    param.D2_opdm(intermediates)
+    param.S2_opdm_U(intermediates)
+    assert dict(intermediates) == {"rdm_oo_α": 1, "rdm_ov_α": 2}
+    intermediates = {}
+    param.D2_opdm(intermediates)
+    assert intermediates == {"rdm_oo_α": 1, "rdm_oo_β": 1}
+
+def test_tracked_intermediates():
+    provided = {"h_oo": np.eye(2), "g_oooo": np.ones((2, 2, 2, 2))}
+    calls = []
+
+    @common.tracked
+    def fock(i):
+        calls.append("fock")
+        i["f_oo"] = i["h_oo"] + einsum("Ii Ji -> IJ", i["g_oooo"])
+
+    @common.tracked
+    def residual(i):
+        calls.append("residual")
+        common.zero_blocks(i, "r2")
+        fock(i)
+        i["r2"] = i["r2"] + einsum("IJ, JK -> IK", i["f_oo"], i["t2"])
+        return np.linalg.norm(i["r2"])
+
+    t2 = np.ones((2, 2))
+    expected = residual({"t2": t2, **provided})
+    calls.clear()
+    intermediates = common.Intermediates({"t2": t2}, provided.__getitem__)
+    assert residual(intermediates) == residual(intermediates) == expected
+    assert calls == ["residual", "fock"]
+    assert intermediates.records[residual.__wrapped__] == ({"t2", "h_oo", "g_oooo"}, {"r2", "f_oo"})
+    # A new step reruns the residual, which zeroes the r2 it wrote last time, but not the integral-only Fock matrix.
+    intermediates["t2"] = 2 * t2
+    assert np.isclose(residual(intermediates), 2 * expected)
+    assert calls == ["residual", "fock", "residual"]
+    # Dropping the integrals of old orbitals puts both out of date. Reading the Fock matrix rebuilds only it.
+    provided["h_oo"] = 2 * np.eye(2)
+    intermediates.refresh()
+    assert np.allclose(intermediates["f_oo"], 2 * np.eye(2) + 2)
+    assert calls[-1] == "fock"
+    residual(intermediates)
+    assert calls[-2:] == ["fock", "residual"]
+    # Writing an output from outside its function disowns it, and the function runs again when next called.
+    intermediates["f_oo"] = np.zeros((2, 2))
+    assert np.allclose(intermediates["f_oo"], 0)
+    fock(intermediates)
+    assert calls[-1] == "fock" and np.allclose(intermediates["f_oo"], 2 * np.eye(2) + 2)
+
+    # A closed-shell reference tracks the stored block for both spin flips.
+    @common.tracked
+    def trace(i):
+        calls.append("trace")
+        return np.trace(i["f_oo_β"])
+
+    closed_shell = common.ClosedShellIntermediates({"f_oo_α": t2}, provided.__getitem__)
+    assert trace(closed_shell) == trace(closed_shell) == 2
+    closed_shell["f_oo_α"] = 3 * t2
+    assert trace(closed_shell) == 6
+    assert calls.count("trace") == 2
+
+def test_reused_rdm_blocks():
+    proc = pytest.importorskip("pilot_implementations.scripts.prdm.taylor.proc")
+    rng = np.random.default_rng(4)
+    rdm_oooo, r2 = rng.random((3, 3, 3, 3)), rng.random((3, 3, 4, 4))
+    inter = {"rdm_oooo": rdm_oooo, "r2": r2, "r1": 1.0}
+    common.zero_blocks(inter, "rdm_oooo", "r2", "r1", "r3")
+    assert inter["rdm_oooo"] is rdm_oooo and inter["r2"] is r2
+    assert not rdm_oooo.any() and not r2.any() and inter["r1"] == inter["r3"] == 0
+    # The delta products are added through a view of an array target, and formed for a scalar one, as they used to be.
+    kappa, rdm_oo, rdm_ov = np.eye(3), rng.random((3, 3)), rng.random((3, 4))
+    for matrix, terms, expected in [
+            (kappa, proc.ANTISYMMETRIZED_23, mla.antisymmetrize_axes(einsum("pr, qs -> pqrs", kappa, kappa), (2, 3))),
+            (rdm_oo, proc.ANTISYMMETRIZED_01_23, mla.antisymmetrize_axes(einsum("pr, qs -> pqrs", kappa, rdm_oo), (0, 1), (2, 3))),
+            (rdm_oo, proc.TRANSPOSED, einsum("pr, qs -> pqrs", rdm_oo, kappa)),
+            (rdm_ov, proc.ANTISYMMETRIZED_01, mla.antisymmetrize_axes(einsum("pr, qs -> pqrs", kappa, rdm_ov), (0, 1)))]:
+        start = rng.random(expected.shape)
+        inter = {"array": start.copy(), "scalar": 0}
+        array = inter["array"]
+        proc.add_delta_products(inter, "array", 3, matrix, terms)
+        proc.add_delta_products(inter, "scalar", 3, matrix, terms)
+        assert inter["array"] is array
+        assert np.allclose(array, start + expected) and np.allclose(inter["scalar"], expected)
+
+def test_tracked_fock_with_ov(monkeypatch):
+    # SD2L has an ov block of the 1-RDM, which is zeroed and rebuilt every iteration. The Fock matrix only checks for it.
+    SD2L = pytest.importorskip("pilot_implementations.scripts.prdm.taylor.singles_spinorbital.SD2L")
+    proc = pytest.importorskip("pilot_implementations.scripts.prdm.taylor.proc")
+    rng = np.random.default_rng(1)
+    n = 6
+    h_ao = np.diag(np.arange(n) - 3.0) + 0.05 * rng.random((n, n))
+    h_ao = h_ao + h_ao.T
+    r_ao = 0.05 * rng.random((n, n, n, n))
+    r_ao = r_ao + r_ao.transpose(2, 1, 0, 3)
+    r_ao = r_ao + r_ao.transpose(0, 3, 2, 1)
+    r_ao = r_ao + r_ao.transpose(1, 0, 3, 2)
+    orbitals = OrderedDict(o=(np.eye(n)[:, :2],) * 2, v=(np.eye(n)[:, 2:],) * 2)
+    calls = []
+    fock = proc.assemble_fock_block_diagonal.__wrapped__
+    monkeypatch.setattr(proc, "assemble_fock_block_diagonal", common.tracked(lambda i: calls.append(1) or fock(i)))
+    intermediates, _ = SD2L.simultaneous(0.0, h_ao, r_ao, orbitals, container=common.Intermediates)
+    assert "rdm_ov" in intermediates and "f_ov" in intermediates
+    assert len(calls) == 1
+    expected, _ = SD2L.simultaneous(0.0, h_ao, r_ao, orbitals)
+    assert np.isclose(intermediates["energy"], expected["energy"])
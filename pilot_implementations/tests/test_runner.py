@@ -0,0 +1,90 @@
+from collections import OrderedDict
+from copy import deepcopy
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from pilot_implementations.scripts.prdm import common
+
+molecule = {
+    "charge": +1,
+    "num_unpaired": +1,
+    "geom": [
+         ('O', (0.000000000000, 0.000000000000, -0.143225816552)),
+         ('H', (0.000000000000, 1.638036840407, 1.136548822547)),
+         ('H', (0.000000000000, -1.638036840407, 1.136548822547))
+         ],
+    "basis": "sto-3g"
+}
+
+E_D2 = -74.71370634648927
+
+def stub_solver(en_nuc, h_ao, r_ao, orbitals, e_thresh, r_thresh, guess=None, container=None, compile_plan=False):
+    """ Record what a solver is given, in place of solving. The amplitudes are the core Hamiltonian. """
+    intermediates = container({"t2": np.array(h_ao), "guess": dict(guess or {}), "pid": os.getpid()}, lambda key: None)
+    return intermediates, orbitals
+
+def test_batch(monkeypatch):
+    try:
+        from pilot_implementations.scripts import runner
+    except ImportError as error: # The runner needs psi4.
+        pytest.skip(f"Cannot import the runner: {error}")
+    orbitals = OrderedDict(o=(np.eye(2)[:, :1],) * 2, v=(np.eye(2)[:, 1:],) * 2)
+    program = SimpleNamespace(core_hamiltonian=lambda basis, geom: np.full((2, 2), geom[1][1][2]),
+        repulsion=lambda basis, geom: np.zeros((2, 2, 2, 2)), read_orbitals=lambda basis, geom: deepcopy(orbitals))
+    monkeypatch.setattr(runner, "program", program)
+    molecules = [{"charge": 0, "num_unpaired": 0, "basis": "sto-3g", "geom": [("H", (0, 0, 0)), ("H", (0, 0, z))]}
+                 for z in (1.0, 1.2, 1.4, 1.6, 1.8)]
+
+    # Neighboring points go to the same process, and each starts from the point before it in its run.
+    results = runner.batch(molecules, stub_solver, num_workers=2)
+    assert [intermed["t2"][0, 0] for intermed, _ in results] == [1.0, 1.2, 1.4, 1.6, 1.8]
+    assert [intermed["guess"]["t2"][0, 0] if intermed["guess"] else None for intermed, _ in results] == [None, 1.0, 1.2, None, 1.6]
+    pids = [intermed["pid"] for intermed, _ in results]
+    # Each run stays in one process. The pool may hand both runs to the same worker, one after the other.
+    assert pids[0] == pids[1] == pids[2] and pids[3] == pids[4]
+    # Intermediates come back from other processes as plain dicts, without their integral providers.
+    assert all(type(intermed) is dict for intermed, _ in results)
+    serial = runner.batch(molecules, stub_solver, compile_plan=True)
+    assert [intermed["guess"]["t2"][0, 0] if intermed["guess"] else None for intermed, _ in serial] == [None, 1.0, 1.2, 1.4, 1.6]
+    assert all(isinstance(intermed, common.Intermediates) for intermed, _ in serial)
+
+    # An option the solver doesn't take is refused, unless it's left at its default.
+    with pytest.raises(ValueError, match="restricted"):
+        runner.subspace(molecules[0], stub_solver, restricted=True)
+    runner.subspace(molecules[0], stub_solver, restricted=False, packed=False)
+
+def test_batch_method(monkeypatch):
+    # A real method's solver, a partial with its glue functions, is sent to the workers. They agree with a serial run.
+    try:
+        from pilot_implementations.scripts import runner
+    except ImportError as error: # The runner needs psi4.
+        pytest.skip(f"Cannot import the runner: {error}")
+    SD2L = pytest.importorskip("pilot_implementations.scripts.prdm.taylor.singles_spinorbital.SD2L")
+    rng = np.random.default_rng(1)
+    n = 5
+    h_ao = np.diag(np.arange(n) - 3.0) + 0.05 * rng.random((n, n))
+    r_ao = 0.05 * rng.random((n, n, n, n))
+    r_ao = r_ao + r_ao.transpose(2, 1, 0, 3)
+    r_ao = r_ao + r_ao.transpose(0, 3, 2, 1)
+    r_ao = r_ao + r_ao.transpose(1, 0, 3, 2)
+    orbitals = OrderedDict(o=(np.eye(n)[:, :2],) * 2, v=(np.eye(n)[:, 2:],) * 2)
+    program = SimpleNamespace(core_hamiltonian=lambda basis, geom: geom[1][1][2] * (h_ao + h_ao.T),
+        repulsion=lambda basis, geom: r_ao, read_orbitals=lambda basis, geom: deepcopy(orbitals))
+    monkeypatch.setattr(runner, "program", program)
+    molecules = [{"charge": 0, "num_unpaired": 0, "basis": "sto-3g", "geom": [("H", (0, 0, 0)), ("H", (0, 0, z))]}
+                 for z in (1.0, 1.1, 1.2)]
+    serial = runner.batch(molecules, SD2L.simultaneous)
+    parallel = runner.batch(molecules, SD2L.simultaneous, num_workers=2)
+    assert np.allclose([intermed["energy"] for intermed, _ in parallel], [intermed["energy"] for intermed, _ in serial])
+
+def test_batch_odc12():
+    import pilot_implementations as pilot
+    from pilot_implementations.scripts import o_dct
+    # Two workers take the points in runs of two and one. The repeated points start from converged amplitudes.
+    results = pilot.batch([molecule] * 3, solver=o_dct.spinorbital.odc12.simultaneous, num_workers=2)
+    assert len(results) == 3
+    for vals, _ in results:
+        np.testing.assert_approx_equal(vals["energy"], E_D2, significant=10)
@@ -0,0 +1,43 @@
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+from pilot_implementations.math_util.slow_fd import central_difference, hellmann_test
+
+def sine_exp(x):
+    return np.array([np.sin(x[0]) * np.exp(x[1]), x[0] ** 2])
+
+@pytest.mark.parametrize("nder, npts", [(1, 9), (2, 5)])
+def test_central_difference(nder, npts):
+    x = np.array([0.3, -0.2])
+    sin, cos, exp = np.sin(x[0]), np.cos(x[0]), np.exp(x[1])
+    if nder == 1:
+        expected = [[cos * exp, 2 * x[0]], [sin * exp, 0]]
+    else:
+        expected = [[-sin * exp, 2], [sin * exp, 0]]
+    points = []
+    serial = central_difference(lambda y: points.append(y) or sine_exp(y), x, 1e-2, npts=npts, nder=nder)
+    assert np.allclose(serial, expected, atol=1e-6)
+    # f(x) is evaluated once, and only for an even derivative, though roundoff leaves an odd one a center weight of ~1e-16.
+    assert len(points) == 2 * (npts - 1) + (nder % 2 == 0)
+    # The workers evaluate the same stencil, and a known f(x) is used instead of evaluating the center.
+    assert np.allclose(central_difference(sine_exp, x, 1e-2, npts=npts, nder=nder, num_workers=2), serial)
+    assert np.allclose(central_difference(sine_exp, x, 1e-2, npts=npts, nder=nder, value=sine_exp(x)), serial)
+
+def test_hellmann_workers():
+    # A method's solver is sent to the worker processes, so its partial must pickle. They agree with the serial stencil.
+    SD2L = pytest.importorskip("pilot_implementations.scripts.prdm.taylor.singles_spinorbital.SD2L")
+    rng = np.random.default_rng(1)
+    n = 5
+    h_ao = np.diag(np.arange(n) - 3.0) + 0.05 * rng.random((n, n))
+    h_ao = h_ao + h_ao.T
+    r_ao = 0.05 * rng.random((n, n, n, n))
+    r_ao = r_ao + r_ao.transpose(2, 1, 0, 3)
+    r_ao = r_ao + r_ao.transpose(0, 3, 2, 1)
+    r_ao = r_ao + r_ao.transpose(1, 0, 3, 2)
+    p_ao = rng.random((n, n, 3))
+    p_ao = p_ao + p_ao.transpose(1, 0, 2)
+    orbitals = OrderedDict(o=(np.eye(n)[:, :2],) * 2, v=(np.eye(n)[:, 2:],) * 2)
+    serial = hellmann_test(SD2L.simultaneous, h_ao, p_ao, r_ao, orbitals)
+    assert np.allclose(hellmann_test(SD2L.simultaneous, h_ao, p_ao, r_ao, orbitals, num_workers=2), serial, atol=1e-8)
@@ -0,0 +1,110 @@
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+from pilot_implementations import multilinear as mla
+from pilot_implementations.math_util.convergence import DirectSumDiis
+from pilot_implementations.math_util.solvers.common import GuessStore, check_stationary, memory_report, perturbation_gradient
+from pilot_implementations.math_util.solvers.spinorbital import proc
+from pilot_implementations.multilinear.tensor import einsum
+
+def antisymmetric_tensor(shape, *pairs):
+    tensor = np.random.default_rng(0).random(shape)
+    return mla.antisymmetrize_axes(tensor, *pairs)
+
+def test_guess_store():
+    rng = np.random.default_rng(6)
+    n = 6
+    orbitals = OrderedDict(o=(rng.random((n, 2)), rng.random((n, 1))), v=(rng.random((n, 2)), rng.random((n, 3))))
+    t2 = antisymmetric_tensor((3, 3, 5, 5), (0, 1), (2, 3))
+    t1 = rng.random((3, 5))
+    t2_ab = rng.random((2, 1, 2, 3))
+    store = GuessStore()
+    store.write("odc12", "h2o+", orbitals, {"t2": t2, "t1ov": t1, "t2_αβ": t2_ab, "r2": t2})
+    assert store.read("odc12", "h2o", orbitals) == {}
+    guess = store.read("odc13", "h2o+", orbitals)
+    assert set(guess) == {"t2", "t1ov", "t2_αβ"} and np.allclose(guess["t2"], t2)
+
+    # Flip the first alpha occupied orbital and the last beta virtual, i.e. spin orbitals o0 and v4.
+    orbitals["o"][0][:, 0] *= -1
+    orbitals["v"][1][:, 2] *= -1
+    guess = store.read("odc12", "h2o+", orbitals)
+    o, v = np.array([-1, 1, 1]), np.array([1, 1, 1, 1, -1])
+    assert np.allclose(guess["t2"], einsum("ijab, i, j, a, b -> ijab", t2, o, o, v, v))
+    assert np.allclose(guess["t1ov"], einsum("ia, i, a -> ia", t1, o, v))
+    assert np.allclose(guess["t2_αβ"], einsum("ijab, i, b -> ijab", t2_ab, o[:2], v[2:]))
+
+def test_check_stationary():
+    # A quadratic energy, stationary at antisymmetric amplitudes, only sees the antisymmetric part of a step.
+    # Its residuals are the derivatives by the unique amplitudes, (n!)^2 times those by the full tensor.
+    minimum = {"t1": np.ones((2, 3)), "t2": antisymmetric_tensor((2, 2, 3, 3), (0, 1), (2, 3))}
+    energy = lambda x: sum(np.sum((x[key] - value) ** 2) for key, value in minimum.items()) + np.sum(x["t2"])
+    def residual(x):
+        x["r1"] = 2 * (x["t1"] - minimum["t1"])
+        x["r2"] = 8 * (x["t2"] - minimum["t2"])
+    intermediates = {key: value.copy() for key, value in minimum.items()}
+    check_stationary(intermediates, lambda x: None, energy, residual)
+    assert all(np.array_equal(intermediates[key], value) for key, value in minimum.items())
+    # The residual is the gradient, but isn't small.
+    intermediates["t1"] += 1e-3
+    with pytest.raises(AssertionError, match="not solved"):
+        check_stationary(intermediates, lambda x: None, energy, residual)
+    check_stationary(intermediates, lambda x: None, energy, residual, tolerance=1)
+    # The residual is small, but isn't the gradient.
+    with pytest.raises(AssertionError, match="not the gradient"):
+        check_stationary(intermediates, lambda x: None, energy, lambda x: x.update(r1=0 * x["t1"], r2=0 * x["t2"]))
+
+def test_frozen_gradient():
+    # A model whose integrals and overlap depend on x. The gradient with a frozen core and frozen virtual must match
+    # finite differences of the energy, which include the change of the UHF orbitals they're frozen from.
+    method = pytest.importorskip("pilot_implementations.scripts.prdm.taylor.singles_spinorbital.SD2L")
+    rng = np.random.default_rng(3)
+    n, na, nb = 7, 3, 2
+    symmetric = lambda x: x + x.T
+    s0, s1 = np.eye(n) + 0.05 * symmetric(rng.random((n, n))), 0.05 * symmetric(rng.random((n, n)))
+    h0, h1 = np.diag(np.arange(n) - 4.0) + 0.1 * symmetric(rng.random((n, n))), 0.1 * symmetric(rng.random((n, n)))
+    b0, b1 = 0.12 * rng.random((12, n, n)), 0.04 * rng.random((12, n, n))
+    b0, b1 = b0 + b0.transpose(0, 2, 1), b1 + b1.transpose(0, 2, 1)
+    r1 = einsum("Qpr, Qqs -> pqrs", b1, b0) + einsum("Qpr, Qqs -> pqrs", b0, b1)
+
+    def solve(x):
+        b = b0 + x * b1
+        h_ao, r_ao = h0 + x * h1, einsum("Qpr, Qqs -> pqrs", b, b)
+        values, vectors = np.linalg.eigh(s0 + x * s1)
+        orthogonalizer = vectors / np.sqrt(values)
+        densities = [np.zeros((n, n))] * 2
+        for _ in range(200):
+            potential = proc.spin_potential(r_ao, densities)
+            coefficients = [orthogonalizer @ np.linalg.eigh(orthogonalizer.T @ (h_ao + v) @ orthogonalizer)[1] for v in potential]
+            new = [c[:, :m] @ c[:, :m].T for c, m in zip(coefficients, (na, nb))]
+            if max(np.abs(a - b).max() for a, b in zip(new, densities)) < 1e-13:
+                break
+            densities = [0.5 * (a + b) for a, b in zip(new, densities)]
+        orbitals = OrderedDict(o=tuple(c[:, :m] for c, m in zip(coefficients, (na, nb))),
+                               v=tuple(c[:, m:] for c, m in zip(coefficients, (na, nb))))
+        reference = mla.freeze(orbitals, 1, 1)
+        intermed, orbitals = method.simultaneous(0.0, h_ao, r_ao, reference, e_thresh=1e-12, r_thresh=1e-10)
+        return h_ao, r_ao, reference, orbitals, intermed
+
+    oei, tei, gei = proc.backtransform_frozen(*solve(0.0))
+    step = 1e-4
+    difference = (solve(step)[-1]["energy"] - solve(-step)[-1]["energy"]) / (2 * step)
+    assert np.isclose(perturbation_gradient(gei, h1, r1, s1, 0.0, oei, tei), difference, atol=1e-7)
+
+def test_memory_report(tmp_path):
+    diis = DirectSumDiis(2, 4)
+    t2, r2 = np.ones((2, 2, 3, 3)), np.zeros((2, 2, 3, 3))
+    diis.diis(r2, t2)
+    diis.diis(r2, t2)
+    intermediates = {"t2": t2, "t1_ov_α": np.ones((2, 3)), "r2": r2, "rdm_oo": np.eye(2), "g_oovv": np.ones((2, 2, 3, 3)),
+        "dsd": diis, "energy": -1.0}
+    report = memory_report(intermediates)
+    assert report.sizes["t1_ov_α"] == 48 and report.sizes["energy"] == 0
+    assert report.totals == {"t": 336, "r": 288, "rdm": 32, "g": 288, "diis": 128 + 2 * 4 * 288, "energy": 0}
+    assert report.total == sum(report.totals.values()) and report.peak is None
+    # DIIS vectors kept on disk don't count.
+    on_disk = DirectSumDiis(2, 4, directory=tmp_path)
+    on_disk.diis(r2, t2)
+    on_disk.diis(r2, t2)
+    assert memory_report({"dsd": on_disk}).total == 128